@@ -8,6 +8,7 @@ import numpy as np
 import logging
 from fairseq import checkpoint_utils
 from vc_infer_pipeline import VC
+from index_cache import index_cache
 import traceback
 from config import Config
 from lib.infer_pack.models import (
@@ -51,6 +52,7 @@ def get_vc(sid):
             print("clean_empty_cache")
             del net_g, n_spk, vc, hubert_model, tgt_sr  # ,cpt
             hubert_model = net_g = n_spk = vc = hubert_model = tgt_sr = None
+            index_cache.clear()
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             ###楼下不这么折腾清理不干净
@@ -85,6 +85,14 @@ class Config:
             self.noautoopen,
             self.paperspace,
             self.is_cli,
+            self.hubert_batch_size,
+            self.extract_batch_size,
+            self.f0_cache_dir,
+            self.index_mem_mb,
+            self.index_family,
+            self.index_recall,
+            self.index_drift,
+            self.index_full_rebuild,
         ) = self.arg_parse()
 
         self.x_pad, self.x_query, self.x_center, self.x_max = self.device_config()
@@ -114,6 +122,58 @@ class Config:
             action="store_true",
             help="Use the CLI instead of setting up a gradio UI. This flag will launch an RVC text interface where you can execute functions from infer-web.py!",
         )
+        parser.add_argument(
+            "--hubert_batch_size",
+            type=int,
+            default=1,
+            help="Number of inference segments sent through hubert in one padded batch "
+            "(opt-in: the padding shifts the output slightly)",
+        )
+        parser.add_argument(
+            "--extract_batch_size",
+            type=int,
+            default=1,
+            help="Number of training files sent through hubert in one padded batch "
+            "during feature extraction",
+        )
+        parser.add_argument(
+            "--f0_cache_dir",
+            type=str,
+            default="",
+            help="Directory for the on-disk f0 cache, empty to keep it in memory only",
+        )
+        parser.add_argument(
+            "--index_mem_mb",
+            type=int,
+            default=2048,
+            help="Memory budget in MB for the features loaded at once by train_index",
+        )
+        parser.add_argument(
+            "--index_family",
+            type=str,
+            default="auto",
+            choices=["auto", "ivf_flat", "ivf_pq", "opq_ivf_pq", "hnsw"],
+            help="Retrieval index type built by train_index. auto is IVF Flat, or a "
+            "smaller IVF PQ above 5e4 vectors if it reaches --index_recall",
+        )
+        parser.add_argument(
+            "--index_recall",
+            type=float,
+            default=0.9,
+            help="Target recall@8 used to pick the index nprobe/efSearch",
+        )
+        parser.add_argument(
+            "--index_drift",
+            type=float,
+            default=0.25,
+            help="Relative growth of the distance to the nearest centroid of new "
+            "features above which train_index retrains instead of appending",
+        )
+        parser.add_argument(
+            "--index_full_rebuild",
+            action="store_true",
+            help="Always retrain the index from scratch in train_index",
+        )
         cmd_opts = parser.parse_args()
 
         cmd_opts.port = cmd_opts.port if 0 <= cmd_opts.port <= 65535 else 7865
@@ -126,6 +186,14 @@ class Config:
             cmd_opts.noautoopen,
             cmd_opts.paperspace,
             cmd_opts.is_cli,
+            cmd_opts.hubert_batch_size,
+            cmd_opts.extract_batch_size,
+            cmd_opts.f0_cache_dir,
+            cmd_opts.index_mem_mb,
+            cmd_opts.index_family,
+            cmd_opts.index_recall,
+            cmd_opts.index_drift,
+            cmd_opts.index_full_rebuild,
         )
 
     # has_mps is only available in nightly pytorch (for now) and MasOS 12.3+.
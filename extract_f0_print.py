@@ -10,9 +10,20 @@ import torch
 from torch import Tensor  # Fork Feature. Used for pitch prediction for torch crepe.
 import scipy.signal as signal  # Fork Feature hybrid inference
 import tqdm
+from f0_pool import (
+    compute_pm_f0,
+    compute_harvest_f0,
+    compute_dio_f0,
+    harvest_parallel,
+    run_f0_jobs,
+    median_f0,
+    start_pool,
+)
 
 logging.getLogger("numba").setLevel(logging.WARNING)
-from multiprocessing import Process
+from multiprocessing import Process, Queue, cpu_count
+from rmvpe_server import RMVPEServer, RMVPEClient, RMVPEServerDied
+from job_scheduler import WorkQueue, file_weight
 
 exp_dir = sys.argv[1]
 f = open("%s/extract_f0_feature.log" % exp_dir, "a+")
@@ -30,6 +41,8 @@ def printt(strr):
 
 
 n_p = int(sys.argv[2])
+# 已经开了n_p个进程分文件, 每个进程里的harvest只再切剩下的核
+harvest_parts = max(1, cpu_count() // n_p)
 f0method = sys.argv[3]
 extraction_crepe_hop_length = 0
 try:
@@ -69,143 +82,156 @@ class FeatureInput(object):
         s = s.split("hybrid")[1]
         s = s.replace("[", "").replace("]", "")
         methods = s.split("+")
-        f0_computation_stack = []
+        f0_methods = []
 
         print("Calculating f0 pitch estimations for methods: %s" % str(methods))
         x = x.astype(np.float32)
         x /= np.quantile(np.abs(x), 0.999)
-        # Get f0 calculations for all methods specified
+        # pm/harvest/dio进进程池, crepe在当前线程里同时跑
+        frame_period = 1000 * self.hop / self.fs
+        jobs = []
         for method in methods:
-            f0 = None
             if method == "pm":
-                f0 = (
-                    parselmouth.Sound(x, self.fs)
-                    .to_pitch_ac(
-                        time_step=time_step / 1000,
-                        voicing_threshold=0.6,
-                        pitch_floor=f0_min,
-                        pitch_ceiling=f0_max,
+                jobs.append(
+                    (
+                        compute_pm_f0,
+                        (x, self.fs, time_step, f0_min, f0_max, p_len),
+                        True,
                     )
-                    .selected_array["frequency"]
                 )
-                pad_size = (p_len - len(f0) + 1) // 2
-                if pad_size > 0 or p_len - len(f0) - pad_size > 0:
-                    f0 = np.pad(
-                        f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
-                    )
             elif method == "crepe":
-                # Pick a batch size that doesn't cause memory errors on your gpu
-                torch_device_index = 0
-                torch_device = None
-                if torch.cuda.is_available():
-                    torch_device = torch.device(
-                        f"cuda:{torch_device_index % torch.cuda.device_count()}"
-                    )
-                elif torch.backends.mps.is_available():
-                    torch_device = torch.device("mps")
-                else:
-                    torch_device = torch.device("cpu")
-                model = "full"
-                batch_size = 512
-                # Compute pitch using first gpu
-                audio = torch.tensor(np.copy(x))[None].float()
-                f0, pd = torchcrepe.predict(
-                    audio,
-                    self.fs,
-                    160,
-                    self.f0_min,
-                    self.f0_max,
-                    model,
-                    batch_size=batch_size,
-                    device=torch_device,
-                    return_periodicity=True,
-                )
-                pd = torchcrepe.filter.median(pd, 3)
-                f0 = torchcrepe.filter.mean(f0, 3)
-                f0[pd < 0.1] = 0
-                f0 = f0[0].cpu().numpy()
-                f0 = f0[1:]  # Get rid of extra first frame
+                jobs.append((self.get_f0_official_crepe, (x,), False))
             elif method == "mangio-crepe":
-                # print("Performing crepe pitch extraction. (EXPERIMENTAL)")
-                # print("CREPE PITCH EXTRACTION HOP LENGTH: " + str(crepe_hop_length))
-                x = x.astype(np.float32)
-                x /= np.quantile(np.abs(x), 0.999)
-                torch_device_index = 0
-                torch_device = None
-                if torch.cuda.is_available():
-                    torch_device = torch.device(
-                        f"cuda:{torch_device_index % torch.cuda.device_count()}"
-                    )
-                elif torch.backends.mps.is_available():
-                    torch_device = torch.device("mps")
-                else:
-                    torch_device = torch.device("cpu")
-                audio = torch.from_numpy(x).to(torch_device, copy=True)
-                audio = torch.unsqueeze(audio, dim=0)
-                if audio.ndim == 2 and audio.shape[0] > 1:
-                    audio = torch.mean(audio, dim=0, keepdim=True).detach()
-                audio = audio.detach()
-                # print(
-                #     "Initiating f0 Crepe Feature Extraction with an extraction_crepe_hop_length of: " +
-                #     str(crepe_hop_length)
-                # )
-                # Pitch prediction for pitch extraction
-                pitch: Tensor = torchcrepe.predict(
-                    audio,
-                    self.fs,
-                    crepe_hop_length,
-                    self.f0_min,
-                    self.f0_max,
-                    "full",
-                    batch_size=crepe_hop_length * 2,
-                    device=torch_device,
-                    pad=True,
+                jobs.append(
+                    (self.get_f0_mangio_crepe, (x, p_len, crepe_hop_length), False)
                 )
-                p_len = p_len or x.shape[0] // crepe_hop_length
-                # Resize the pitch
-                source = np.array(pitch.squeeze(0).cpu().float().numpy())
-                source[source < 0.001] = np.nan
-                target = np.interp(
-                    np.arange(0, len(source) * p_len, len(source)) / p_len,
-                    np.arange(0, len(source)),
-                    source,
-                )
-                f0 = np.nan_to_num(target)
             elif method == "harvest":
-                f0, t = pyworld.harvest(
-                    x.astype(np.double),
-                    fs=self.fs,
-                    f0_ceil=self.f0_max,
-                    f0_floor=self.f0_min,
-                    frame_period=1000 * self.hop / self.fs,
+                jobs.append(
+                    (
+                        compute_harvest_f0,
+                        (
+                            x.astype(np.double),
+                            self.fs,
+                            self.f0_max,
+                            self.f0_min,
+                            frame_period,
+                        ),
+                        True,
+                    )
                 )
-                f0 = pyworld.stonemask(x.astype(np.double), f0, t, self.fs)
-                f0 = signal.medfilt(f0, 3)
-                f0 = f0[1:]
             elif method == "dio":
-                f0, t = pyworld.dio(
-                    x.astype(np.double),
-                    fs=self.fs,
-                    f0_ceil=self.f0_max,
-                    f0_floor=self.f0_min,
-                    frame_period=1000 * self.hop / self.fs,
+                jobs.append(
+                    (
+                        compute_dio_f0,
+                        (
+                            x.astype(np.double),
+                            self.fs,
+                            self.f0_max,
+                            self.f0_min,
+                            frame_period,
+                        ),
+                        True,
+                    )
                 )
-                f0 = pyworld.stonemask(x.astype(np.double), f0, t, self.fs)
+            else:
+                printt("Unknown f0 method in hybrid: %s" % method)
+                continue
+            f0_methods.append(method)
+        f0_computation_stack = run_f0_jobs(jobs)
+
+        for i, (method, f0) in enumerate(zip(f0_methods, f0_computation_stack)):
+            if method == "crepe":
+                f0 = f0[1:]  # Get rid of extra first frame
+            elif method in ["harvest", "dio"]:
                 f0 = signal.medfilt(f0, 3)
                 f0 = f0[1:]
-            f0_computation_stack.append(f0)
+            f0_computation_stack[i] = f0
 
         for fc in f0_computation_stack:
             print(len(fc))
 
         # print("Calculating hybrid median f0 from the stack of: %s" % str(methods))
+        return median_f0(f0_computation_stack, p_len)
+
+    def get_f0_official_crepe(self, x):
+        # Pick a batch size that doesn't cause memory errors on your gpu
+        torch_device_index = 0
+        torch_device = None
+        if torch.cuda.is_available():
+            torch_device = torch.device(
+                f"cuda:{torch_device_index % torch.cuda.device_count()}"
+            )
+        elif torch.backends.mps.is_available():
+            torch_device = torch.device("mps")
+        else:
+            torch_device = torch.device("cpu")
+        model = "full"
+        batch_size = 512
+        # Compute pitch using first gpu
+        audio = torch.tensor(np.copy(x))[None].float()
+        f0, pd = torchcrepe.predict(
+            audio,
+            self.fs,
+            160,
+            self.f0_min,
+            self.f0_max,
+            model,
+            batch_size=batch_size,
+            device=torch_device,
+            return_periodicity=True,
+        )
+        pd = torchcrepe.filter.median(pd, 3)
+        f0 = torchcrepe.filter.mean(f0, 3)
+        f0[pd < 0.1] = 0
+        f0 = f0[0].cpu().numpy()
+        return f0
 
-        f0_median_hybrid = None
-        if len(f0_computation_stack) == 1:
-            f0_median_hybrid = f0_computation_stack[0]
+    def get_f0_mangio_crepe(self, x, p_len, crepe_hop_length):
+        # print("Performing crepe pitch extraction. (EXPERIMENTAL)")
+        # print("CREPE PITCH EXTRACTION HOP LENGTH: " + str(crepe_hop_length))
+        x = x.astype(np.float32)
+        x /= np.quantile(np.abs(x), 0.999)
+        torch_device_index = 0
+        torch_device = None
+        if torch.cuda.is_available():
+            torch_device = torch.device(
+                f"cuda:{torch_device_index % torch.cuda.device_count()}"
+            )
+        elif torch.backends.mps.is_available():
+            torch_device = torch.device("mps")
         else:
-            f0_median_hybrid = np.nanmedian(f0_computation_stack, axis=0)
-        return f0_median_hybrid
+            torch_device = torch.device("cpu")
+        audio = torch.from_numpy(x).to(torch_device, copy=True)
+        audio = torch.unsqueeze(audio, dim=0)
+        if audio.ndim == 2 and audio.shape[0] > 1:
+            audio = torch.mean(audio, dim=0, keepdim=True).detach()
+        audio = audio.detach()
+        # print(
+        #     "Initiating f0 Crepe Feature Extraction with an extraction_crepe_hop_length of: " +
+        #     str(crepe_hop_length)
+        # )
+        # Pitch prediction for pitch extraction
+        pitch: Tensor = torchcrepe.predict(
+            audio,
+            self.fs,
+            crepe_hop_length,
+            self.f0_min,
+            self.f0_max,
+            "full",
+            batch_size=crepe_hop_length * 2,
+            device=torch_device,
+            pad=True,
+        )
+        p_len = p_len or x.shape[0] // crepe_hop_length
+        # Resize the pitch
+        source = np.array(pitch.squeeze(0).cpu().float().numpy())
+        source[source < 0.001] = np.nan
+        target = np.interp(
+            np.arange(0, len(source) * p_len, len(source)) / p_len,
+            np.arange(0, len(source)),
+            source,
+        )
+        return np.nan_to_num(target)
 
     def compute_f0(self, path, f0_method, crepe_hop_length):
         x = load_audio(path, self.fs, DoFormant, Quefrency, Timbre)
@@ -228,20 +254,24 @@ class FeatureInput(object):
                     f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
                 )
         elif f0_method == "harvest":
-            f0, t = pyworld.harvest(
+            f0 = harvest_parallel(
                 x.astype(np.double),
-                fs=self.fs,
-                f0_ceil=self.f0_max,
-                f0_floor=self.f0_min,
-                frame_period=1000 * self.hop / self.fs,
+                self.fs,
+                self.f0_max,
+                self.f0_min,
+                1000 * self.hop / self.fs,
+                n_parts=harvest_parts,
             )
-            f0 = pyworld.stonemask(x.astype(np.double), f0, t, self.fs)
         elif f0_method == "rmvpe":
             if hasattr(self, "model_rmvpe") == False:
                 from rmvpe import RMVPE
 
                 print("loading rmvpe model")
-                self.model_rmvpe = RMVPE("rmvpe.pt", is_half=False, device="cuda:0")
+                self.model_rmvpe = RMVPE(
+                    "rmvpe.pt",
+                    is_half=False,
+                    device="cuda:0" if torch.cuda.is_available() else "cpu",
+                )
             f0 = self.model_rmvpe.infer_from_audio(x, thred=0.03)
         elif f0_method == "dio":
             f0, t = pyworld.dio(
@@ -363,41 +393,95 @@ class FeatureInput(object):
         )
         return f0_coarse
 
-    def go(self, paths, f0_method, crepe_hop_length, thread_n):
-        if len(paths) == 0:
-            printt("no-f0-todo")
-        else:
-            with tqdm.tqdm(total=len(paths), leave=True, position=thread_n) as pbar:
-                for idx, (inp_path, opt_path1, opt_path2) in enumerate(paths):
-                    try:
-                        pbar.set_description(
-                            "thread:%s, f0ing, Hop-Length:%s"
-                            % (thread_n, crepe_hop_length)
-                        )
-                        pbar.update(1)
-                        if (
-                            os.path.exists(opt_path1 + ".npy") == True
-                            and os.path.exists(opt_path2 + ".npy") == True
-                        ):
-                            continue
-                        featur_pit = self.compute_f0(
-                            inp_path, f0_method, crepe_hop_length
-                        )
-                        np.save(
-                            opt_path2,
-                            featur_pit,
-                            allow_pickle=False,
-                        )  # nsf
-                        coarse_pit = self.coarse_f0(featur_pit)
-                        np.save(
-                            opt_path1,
-                            coarse_pit,
-                            allow_pickle=False,
-                        )  # ori
-                    except:
-                        printt(
-                            "f0fail-%s-%s-%s" % (idx, inp_path, traceback.format_exc())
-                        )
+    def save_f0(self, featur_pit, opt_path1, opt_path2):
+        np.save(
+            opt_path2,
+            featur_pit,
+            allow_pickle=False,
+        )  # nsf
+        coarse_pit = self.coarse_f0(featur_pit)
+        np.save(
+            opt_path1,
+            coarse_pit,
+            allow_pickle=False,
+        )  # ori
+
+    def go(self, work_queue, f0_method, crepe_hop_length, thread_n, rmvpe_client=None):
+        # 从共享队列里按时长从长到短取文件, 谁空了谁取
+        paths = work_queue.jobs(thread_n)
+        if rmvpe_client is not None:
+            return self.go_rmvpe(paths, thread_n, rmvpe_client)
+        if (f0_method == "harvest" and harvest_parts > 1) or "hybrid" in f0_method:
+            # tqdm的监控线程起来以后get_pool会认为fork不安全, 退回线程池
+            start_pool(harvest_parts)
+        with tqdm.tqdm(leave=True, position=thread_n) as pbar:
+            for idx, (inp_path, opt_path1, opt_path2) in enumerate(paths):
+                try:
+                    pbar.set_description(
+                        "thread:%s, f0ing, Hop-Length:%s" % (thread_n, crepe_hop_length)
+                    )
+                    pbar.update(1)
+                    if (
+                        os.path.exists(opt_path1 + ".npy") == True
+                        and os.path.exists(opt_path2 + ".npy") == True
+                    ):
+                        continue
+                    featur_pit = self.compute_f0(inp_path, f0_method, crepe_hop_length)
+                    self.save_f0(featur_pit, opt_path1, opt_path2)
+                except:
+                    printt("f0fail-%s-%s-%s" % (idx, inp_path, traceback.format_exc()))
+
+    def go_rmvpe(self, paths, thread_n, rmvpe_client, max_inflight=64):
+        # 本进程只读音频和存结果, f0交给RMVPEServer攒batch算
+        pending = {}
+        server_err = None
+
+        def fail_pending(err):
+            for idx, (inp_path, _, _) in pending.items():
+                printt("f0fail-%s-%s-%s" % (idx, inp_path, err))
+            pending.clear()
+
+        def save(idx, featur_pit, err):
+            inp_path, opt_path1, opt_path2 = pending.pop(idx)
+            if err is not None:
+                printt("f0fail-%s-%s-%s" % (idx, inp_path, err))
+                return
+            try:
+                self.save_f0(featur_pit, opt_path1, opt_path2)
+            except:
+                printt("f0fail-%s-%s-%s" % (idx, inp_path, traceback.format_exc()))
+
+        with tqdm.tqdm(leave=True, position=thread_n) as pbar:
+            for idx, (inp_path, opt_path1, opt_path2) in enumerate(paths):
+                pbar.set_description("thread:%s, f0ing, rmvpe server" % thread_n)
+                pbar.update(1)
+                if (
+                    os.path.exists(opt_path1 + ".npy") == True
+                    and os.path.exists(opt_path2 + ".npy") == True
+                ):
+                    continue
+                if server_err is not None:
+                    # server挂了, 剩下的文件照样从队列里取走并记f0fail, 主进程才能结束
+                    printt("f0fail-%s-%s-%s" % (idx, inp_path, server_err))
+                    continue
+                try:
+                    x = load_audio(inp_path, self.fs, DoFormant, Quefrency, Timbre)
+                except:
+                    printt("f0fail-%s-%s-%s" % (idx, inp_path, traceback.format_exc()))
+                    continue
+                pending[idx] = (inp_path, opt_path1, opt_path2)
+                rmvpe_client.submit(idx, x)
+                try:
+                    while len(pending) >= max_inflight:
+                        save(*rmvpe_client.get())
+                except RMVPEServerDied as e:
+                    server_err = str(e)
+                    fail_pending(server_err)
+            try:
+                while pending:
+                    save(*rmvpe_client.get())
+            except RMVPEServerDied as e:
+                fail_pending(str(e))
 
 
 if __name__ == "__main__":
@@ -423,12 +507,35 @@ if __name__ == "__main__":
 
     ps = []
     print("Using f0 method: " + f0method)
+    # rmvpe只在一个进程里加载一次模型, n_p个进程把音频发过去攒batch
+    rmvpe_server = None
+    rmvpe_clients = [None] * n_p
+    if f0method == "rmvpe":
+        rmvpe_inp_q = Queue()
+        rmvpe_opt_qs = [Queue() for _ in range(n_p)]
+        rmvpe_server = RMVPEServer("rmvpe.pt", rmvpe_inp_q, rmvpe_opt_qs)
+        rmvpe_server.start()
+        rmvpe_clients = [
+            RMVPEClient(i, rmvpe_inp_q, rmvpe_opt_qs[i], rmvpe_server.heartbeat)
+            for i in range(n_p)
+        ]
+    if len(paths) == 0:
+        printt("no-f0-todo")
+    work_queue = WorkQueue(paths, n_p, weight=lambda path: file_weight(path[0]))
     for i in range(n_p):
         p = Process(
             target=featureInput.go,
-            args=(paths[i::n_p], f0method, extraction_crepe_hop_length, i),
+            args=(
+                work_queue,
+                f0method,
+                extraction_crepe_hop_length,
+                i,
+                rmvpe_clients[i],
+            ),
         )
         ps.append(p)
         p.start()
-    for i in range(n_p):
-        ps[i].join()
+    work_queue.join(ps, printt)
+    if rmvpe_server is not None:
+        rmvpe_inp_q.put(None)
+        rmvpe_server.join()
@@ -6,6 +6,13 @@ os.environ["PYTORCH_MPS_HIGH_WATERMARK_RATIO"] = "0.0"
 # device=sys.argv[1]
 n_part = int(sys.argv[2])
 i_part = int(sys.argv[3])
+# 可选的最后两个参数: batch_size n_threads, 要么都给要么都不给
+batch_size = 1
+n_threads = 0
+if len(sys.argv) in [8, 9]:
+    batch_size = max(1, int(sys.argv[-2]))
+    n_threads = int(sys.argv[-1])
+    sys.argv = sys.argv[:-2]
 if len(sys.argv) == 6:
     exp_dir = sys.argv[4]
     version = sys.argv[5]
@@ -19,12 +26,18 @@ import torch.nn.functional as F
 import soundfile as sf
 import numpy as np
 from fairseq import checkpoint_utils
+from job_scheduler import FileClaimQueue, file_weight
+from lib.infer_pack.commons import hubert_frames
 
 device = "cpu"
 if torch.cuda.is_available():
     device = "cuda"
 elif torch.backends.mps.is_available():
     device = "mps"
+if n_threads > 0:
+    torch.set_num_threads(n_threads)
+# 同一个batch里最长和最短的长度差不超过10%, 第一层卷积的GroupNorm会把pad的0算进统计量
+max_pad_ratio = 0.1
 
 f = open("%s/extract_f0_feature.log" % exp_dir, "a+")
 
@@ -61,6 +74,43 @@ def readwave(wav_path, normalize=False):
     return feats
 
 
+def extract_batch(batch):
+    """batch: list of (file, out_path, wav), wav from readwave"""
+    lengths = [wav.shape[1] for _, _, wav in batch]
+    feats = torch.zeros(len(batch), max(lengths))
+    padding_mask = torch.ones(len(batch), max(lengths), dtype=torch.bool)
+    for i, (_, _, wav) in enumerate(batch):
+        feats[i, : lengths[i]] = wav[0]
+        padding_mask[i, : lengths[i]] = False
+    inputs = {
+        "source": feats.half().to(device)
+        if device not in ["mps", "cpu"]
+        else feats.to(device),
+        "padding_mask": padding_mask.to(device),
+        "output_layer": 9 if version == "v1" else 12,  # layer 9
+    }
+    with torch.no_grad():
+        logits = model.extract_features(**inputs)
+        feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+    feats = feats.float().cpu().numpy()
+    for i, (file, out_path, _) in enumerate(batch):
+        feat = feats[i, : hubert_frames(lengths[i])]
+        if np.isnan(feat).sum() == 0:
+            np.save(out_path, feat, allow_pickle=False)
+        else:
+            printt("%s-contains nan" % file)
+
+
+def flush(batch):
+    try:
+        extract_batch(batch)
+    except:
+        printt(traceback.format_exc())
+        if len(batch) > 1:  # 整批失败就逐条重试
+            for item in batch:
+                flush([item])
+
+
 # HuBERT model
 printt("load model(s) from {}".format(model_path))
 # if hubert model is exist
@@ -81,13 +131,23 @@ if device not in ["mps", "cpu"]:
     model = model.half()
 model.eval()
 
-todo = sorted(list(os.listdir(wavPath)))[i_part::n_part]
-n = max(1, len(todo) // 10)  # 最多打印十条
+todo = sorted(list(os.listdir(wavPath)))
+# 各part按时长从长到短动态认领文件, 不再固定[i_part::n_part]切分
+work_queue = FileClaimQueue(
+    todo,
+    "%s/.feature_claims" % exp_dir,
+    i_part,
+    n_part,
+    weight=lambda file: file_weight("%s/%s" % (wavPath, file)),
+)
+n = max(1, len(todo) // n_part // 10)  # 最多打印十条
 if len(todo) == 0:
     printt("no-feature-todo")
 else:
-    printt("all-feature-%s" % len(todo))
-    for idx, file in enumerate(todo):
+    printt("all-feature-%s, batch_size-%s" % (len(todo), batch_size))
+    # 认领顺序是从长到短, 相邻的文件长度接近, 直接按顺序攒batch
+    batch = []
+    for idx, file in enumerate(work_queue.jobs()):
         try:
             if file.endswith(".wav"):
                 wav_path = "%s/%s" % (wavPath, file)
@@ -96,28 +156,18 @@ else:
                 if os.path.exists(out_path):
                     continue
 
-                feats = readwave(wav_path, normalize=saved_cfg.task.normalize)
-                padding_mask = torch.BoolTensor(feats.shape).fill_(False)
-                inputs = {
-                    "source": feats.half().to(device)
-                    if device not in ["mps", "cpu"]
-                    else feats.to(device),
-                    "padding_mask": padding_mask.to(device),
-                    "output_layer": 9 if version == "v1" else 12,  # layer 9
-                }
-                with torch.no_grad():
-                    logits = model.extract_features(**inputs)
-                    feats = (
-                        model.final_proj(logits[0]) if version == "v1" else logits[0]
-                    )
-
-                feats = feats.squeeze(0).float().cpu().numpy()
-                if np.isnan(feats).sum() == 0:
-                    np.save(out_path, feats, allow_pickle=False)
-                else:
-                    printt("%s-contains nan" % file)
+                wav = readwave(wav_path, normalize=saved_cfg.task.normalize)
+                if batch and (
+                    len(batch) >= batch_size
+                    or batch[0][2].shape[1] > wav.shape[1] * (1 + max_pad_ratio)
+                ):
+                    flush(batch)
+                    batch = []
+                batch.append((file, out_path, wav))
                 if idx % n == 0:
-                    printt("now-%s,all-%s,%s,%s" % (idx, len(todo), file, feats.shape))
+                    printt("now-%s,all-%s,%s,%s" % (idx, len(todo), file, wav.shape))
         except:
             printt(traceback.format_exc())
+    if batch:
+        flush(batch)
     printt("all-feature-done")
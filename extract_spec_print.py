@@ -0,0 +1,120 @@
+"""
+预先算好0_gt_wavs里每条音频的线性谱, 存成.spec.npy,
+训练第一轮不用再在DataLoader worker里现算现存.spec.pt
+python extract_spec_print.py exp_dir sr n_p
+"""
+import os, sys, traceback, multiprocessing
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append(os.path.join(now_dir, "train"))
+import numpy as np, torch, tqdm
+from mel_processing import spectrogram_torch
+from utils import load_wav_to_torch, get_hparams_from_file
+from job_scheduler import WorkQueue, file_weight
+
+
+def spec_path(wav_path):
+    return wav_path.replace(".wav", ".spec.npy")
+
+
+def save_spec(path, spec):
+    # 先写临时文件再改名, 中断后重跑不会读到半截的文件
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, spec, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+
+class SpecExtractor(object):
+    def __init__(self, sr, batch_size=32):
+        hps = get_hparams_from_file("configs/%sk.json" % (sr // 1000))
+        self.sampling_rate = hps.data.sampling_rate
+        self.filter_length = hps.data.filter_length
+        self.hop_length = hps.data.hop_length
+        self.win_length = hps.data.win_length
+        self.batch_size = batch_size
+
+    def run_batch(self, batch):
+        # batch里的音频一样长, 一次STFT
+        audio = torch.stack([audio for _, audio in batch])
+        spec = spectrogram_torch(
+            audio,
+            self.filter_length,
+            self.sampling_rate,
+            self.hop_length,
+            self.win_length,
+            center=False,
+        )
+        for i, (path, _) in enumerate(batch):
+            save_spec(spec_path(path), spec[i].numpy())
+
+    def flush(self, batch, log):
+        try:
+            self.run_batch(batch)
+        except:
+            log("spec-fail-%s-%s" % (batch[0][0], traceback.format_exc()))
+
+    def go(self, work_queue, thread_n, n_threads, log=print):
+        if n_threads > 0:
+            torch.set_num_threads(n_threads)
+        batch = []
+        for path in tqdm.tqdm(
+            work_queue.jobs(thread_n),
+            position=thread_n,
+            leave=True,
+            desc="spec thread:%s" % thread_n,
+        ):
+            if os.path.exists(spec_path(path)):
+                continue
+            try:
+                audio, sampling_rate = load_wav_to_torch(path)
+                if sampling_rate != self.sampling_rate:
+                    raise ValueError(
+                        "{} SR doesn't match target {} SR".format(
+                            sampling_rate, self.sampling_rate
+                        )
+                    )
+            except:
+                log("spec-fail-%s-%s" % (path, traceback.format_exc()))
+                continue
+            # 队列按文件大小从大到小出, 切出来的等长片段会挨在一起
+            if batch and (
+                len(batch) >= self.batch_size or batch[0][1].shape[0] != audio.shape[0]
+            ):
+                self.flush(batch, log)
+                batch = []
+            batch.append((path, audio))
+        if batch:
+            self.flush(batch, log)
+
+
+def precompute_specs(exp_dir, sr, n_p, noparallel=False, log=print):
+    gt_wavs_dir = "%s/0_gt_wavs" % exp_dir
+    paths = [
+        "%s/%s" % (gt_wavs_dir, name)
+        for name in sorted(os.listdir(gt_wavs_dir))
+        if name.endswith(".wav")
+    ]
+    log("spec-todo-%s" % len(paths))
+    extractor = SpecExtractor(sr)
+    work_queue = WorkQueue(paths, n_p, weight=file_weight)
+    if noparallel or n_p == 1:
+        extractor.go(work_queue, 0, 0, log)
+    else:
+        ps = []
+        for i in range(n_p):
+            p = multiprocessing.Process(
+                target=extractor.go, args=(work_queue, i, 1, log)
+            )
+            ps.append(p)
+            p.start()
+        work_queue.join(ps, log)
+    log("spec-done")
+
+
+if __name__ == "__main__":
+    exp_dir = sys.argv[1]
+    sr = int(sys.argv[2])
+    n_p = int(sys.argv[3])
+    precompute_specs(exp_dir, sr, n_p)
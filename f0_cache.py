@@ -0,0 +1,85 @@
+import os, hashlib, threading, traceback
+from collections import OrderedDict
+
+import numpy as np
+
+
+class F0Cache(object):
+    """
+    Cache of unshifted f0 curves, keyed by a hash of the audio samples plus the
+    extraction parameters. Only the f0 arrays are kept, never the waveforms.
+    The memory tier is an LRU bounded by max_bytes; if cache_dir is set, every
+    entry is also written there as .npy and memory-mapped back on a miss.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def set_dir(self, cache_dir):
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def make_key(audio, method, f0_min, f0_max, hop, filter_radius, *extra):
+        h = hashlib.blake2b(digest_size=20)
+        audio = np.ascontiguousarray(audio)
+        h.update(str(audio.dtype).encode())
+        h.update(audio.view(np.uint8))
+        h.update(repr((method, f0_min, f0_max, hop, filter_radius) + extra).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(self.cache_dir, "%s.npy" % key)
+        if not os.path.exists(path):
+            return None
+        try:
+            f0 = np.load(path, mmap_mode="r")
+        except:
+            traceback.print_exc()
+            return None
+        self._remember(key, f0)
+        return f0
+
+    def put(self, key, f0):
+        f0 = np.array(f0)
+        f0.flags.writeable = False  # 调用方只能拷贝后再改
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, "%s.npy" % key)
+            tmp_path = "%s.%s.tmp" % (path, os.getpid())
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, f0, allow_pickle=False)
+                os.replace(tmp_path, path)
+            except:
+                traceback.print_exc()
+        self._remember(key, f0)
+        return f0
+
+    def _remember(self, key, f0):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = f0
+            self.n_bytes += f0.nbytes
+            while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.n_bytes -= old.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+
+f0_cache = F0Cache()
@@ -0,0 +1,209 @@
+import sys, threading, multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np, parselmouth, pyworld
+
+# pm/harvest/dio是纯CPU的C代码, 丢进进程池; crepe/rmvpe留在调用线程里顺序跑,
+# 用已经加载好的模型, 也避免torchcrepe的全局模型被并发切换
+max_workers = min(multiprocessing.cpu_count(), 8)
+pool = None
+
+
+def fork_is_safe():
+    # CUDA初始化以后或者已经有别的线程(gradio等)在跑时fork, 子进程可能死锁、CUDA状态也是坏的
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_initialized():
+        return False
+    return threading.active_count() == 1
+
+
+def get_pool():
+    """
+    Process pool when it can be forked safely, thread pool otherwise. spawn
+    would re-run the main script in every worker (infer-web.py has no
+    __main__ guard), so long-running entry points call start_pool() first
+    thing, before torch and gradio are up.
+    """
+    global pool
+    if pool is None:
+        if multiprocessing.get_start_method() == "fork" and fork_is_safe():
+            pool = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            pool = ThreadPoolExecutor(max_workers=max_workers)
+        print("f0 pool: %s with %s workers" % (type(pool).__name__, max_workers))
+    return pool
+
+
+def _noop():
+    return None
+
+
+def start_pool(n_workers=None):
+    """先把worker都fork出来, 趁调用方还没import torch、还没起别的线程(tqdm等)"""
+    global max_workers
+    if pool is None and n_workers:
+        max_workers = n_workers
+    futures = [get_pool().submit(_noop) for _ in range(max_workers)]
+    for future in futures:
+        future.result()
+
+
+def compute_pm_f0(x, fs, time_step, f0_min, f0_max, p_len):
+    f0 = (
+        parselmouth.Sound(x, fs)
+        .to_pitch_ac(
+            time_step=time_step / 1000,
+            voicing_threshold=0.6,
+            pitch_floor=f0_min,
+            pitch_ceiling=f0_max,
+        )
+        .selected_array["frequency"]
+    )
+    pad_size = (p_len - len(f0) + 1) // 2
+    if pad_size > 0 or p_len - len(f0) - pad_size > 0:
+        f0 = np.pad(f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant")
+    return f0
+
+
+def compute_harvest_f0(audio, fs, f0max, f0min, frame_period):
+    f0, t = pyworld.harvest(
+        audio,
+        fs=fs,
+        f0_ceil=f0max,
+        f0_floor=f0min,
+        frame_period=frame_period,
+    )
+    f0 = pyworld.stonemask(audio, f0, t, fs)
+    return f0
+
+
+def compute_dio_f0(audio, fs, f0max, f0min, frame_period):
+    f0, t = pyworld.dio(
+        audio,
+        fs=fs,
+        f0_ceil=f0max,
+        f0_floor=f0min,
+        frame_period=frame_period,
+    )
+    f0 = pyworld.stonemask(audio, f0, t, fs)
+    return f0
+
+
+def run_f0_jobs(jobs):
+    """
+    jobs: list of (fn, args, cpu_bound).
+    cpu_bound jobs go to the shared pool, the rest run here meanwhile.
+    Returns the results in job order.
+    """
+    results = [None] * len(jobs)
+    futures = {}
+    for i, (fn, args, cpu_bound) in enumerate(jobs):
+        if cpu_bound and len(jobs) > 1:
+            futures[i] = get_pool().submit(fn, *args)
+    for i, (fn, args, cpu_bound) in enumerate(jobs):
+        if i not in futures:
+            results[i] = fn(*args)
+    for i, future in futures.items():
+        results[i] = future.result()
+    return results
+
+
+def median_f0(f0s, p_len):
+    """nanmedian over estimators after cutting/padding each one to p_len frames."""
+    if len(f0s) == 1:
+        return f0s[0]
+    stack = np.full((len(f0s), p_len), np.nan)
+    for i, f0 in enumerate(f0s):
+        n = min(len(f0), p_len)
+        stack[i, :n] = f0[:n]
+    return np.nan_to_num(np.nanmedian(stack, axis=0))
+
+
+def _harvest_part(shm_name, length, start, end, fs, f0max, f0min, frame_period, refine):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        buf = np.ndarray((length,), dtype=np.double, buffer=shm.buf)
+        audio = buf[start:end].copy()
+        del buf
+    finally:
+        shm.close()
+    if refine:
+        return compute_harvest_f0(audio, fs, f0max, f0min, frame_period)
+    f0, t = pyworld.harvest(
+        audio,
+        fs=fs,
+        f0_ceil=f0max,
+        f0_floor=f0min,
+        frame_period=frame_period,
+    )
+    return f0
+
+
+def harvest_parallel(
+    audio,
+    fs,
+    f0max,
+    f0min,
+    frame_period,
+    n_parts=None,
+    overlap_frames=None,
+    min_part_frames=100,
+    refine=True,
+):
+    """
+    Harvest over n_parts chunks in the shared pool, stitched back on the frame grid.
+    The audio is put in shared memory once; workers only receive sample ranges.
+    Each chunk starts on a frame boundary and carries overlap_frames of context on
+    both sides, which are dropped again when stitching.
+    refine: run stonemask on each chunk, like compute_harvest_f0.
+    """
+    audio = np.ascontiguousarray(audio, dtype=np.double)
+    length = audio.shape[0]
+    hop = int(round(fs * frame_period / 1000))
+    n_frames = length // hop + 1  # 和pyworld.harvest的输出帧数一致
+    if n_parts is None:
+        n_parts = max_workers
+    n_parts = max(1, min(int(n_parts), n_frames // max(1, min_part_frames)))
+    if n_parts == 1 or hop * 1000 != fs * frame_period:
+        if refine:
+            return compute_harvest_f0(audio, fs, f0max, f0min, frame_period)
+        return pyworld.harvest(
+            audio, fs=fs, f0_ceil=f0max, f0_floor=f0min, frame_period=frame_period
+        )[0]
+    if overlap_frames is None:
+        # 两边各留几个最低基频周期的上下文
+        overlap_frames = int(np.ceil(4000.0 / f0min / frame_period)) + 2
+
+    shm = shared_memory.SharedMemory(create=True, size=audio.nbytes)
+    try:
+        buf = np.ndarray((length,), dtype=np.double, buffer=shm.buf)
+        buf[:] = audio
+        del buf
+        bounds = np.linspace(0, n_frames, n_parts + 1).astype(np.int64)
+        parts = []
+        for i in range(n_parts):
+            a, b = int(bounds[i]), int(bounds[i + 1])
+            start = max(0, a - overlap_frames) * hop
+            end = min(length, (b + overlap_frames) * hop)
+            future = get_pool().submit(
+                _harvest_part,
+                shm.name,
+                length,
+                start,
+                end,
+                fs,
+                f0max,
+                f0min,
+                frame_period,
+                refine,
+            )
+            parts.append((a, b, start // hop, future))
+        f0 = np.zeros(n_frames, dtype=np.double)
+        for a, b, first, future in parts:
+            part = future.result()
+            f0[a:b] = part[a - first : b - first]
+    finally:
+        shm.close()
+        shm.unlink()
+    return f0
@@ -8,31 +8,7 @@ sys.path.append(now_dir)
 import multiprocessing
 
 
-class Harvest(multiprocessing.Process):
-    def __init__(self, inp_q, opt_q):
-        multiprocessing.Process.__init__(self)
-        self.inp_q = inp_q
-        self.opt_q = opt_q
-
-    def run(self):
-        import numpy as np, pyworld
-
-        while 1:
-            idx, x, res_f0, n_cpu, ts = self.inp_q.get()
-            f0, t = pyworld.harvest(
-                x.astype(np.double),
-                fs=16000,
-                f0_ceil=1100,
-                f0_floor=50,
-                frame_period=10,
-            )
-            res_f0[idx] = f0
-            if len(res_f0.keys()) >= n_cpu:
-                self.opt_q.put(ts)
-
-
 if __name__ == "__main__":
-    from multiprocessing import Queue
     from queue import Empty
     import numpy as np
     import multiprocessing
@@ -54,11 +30,10 @@ if __name__ == "__main__":
         else ("mps" if torch.backends.mps.is_available() else "cpu")
     )
     current_dir = os.getcwd()
-    inp_q = Queue()
-    opt_q = Queue()
+    import f0_pool
+
     n_cpu = min(cpu_count(), 8)
-    for _ in range(n_cpu):
-        Harvest(inp_q, opt_q).start()
+    f0_pool.start_pool()  # harvest进程在import torch模型之前fork
     from rvc_for_realtime import RVC
 
     class GUIConfig:
@@ -374,8 +349,6 @@ if __name__ == "__main__":
                 self.config.index_path,
                 self.config.index_rate,
                 self.config.n_cpu,
-                inp_q,
-                opt_q,
                 device,
             )
             self.config.samplerate = self.rvc.tgt_sr
@@ -0,0 +1,460 @@
+"""
+Out-of-core builder for the retrieval index of train_index in infer-web.py.
+The 3_feature*/ .npy files are streamed in chunks instead of being
+concatenated (plus a shuffled copy), so the features held in memory at once
+stay within mem_budget_mb, on top of the index itself.
+With family "auto" the index is IVF Flat as before, or above AUTO_PQ_ROWS
+vectors IVF PQ FastScan without RFlat when that reaches the target recall.
+Its nprobe/efSearch is tuned against exact search to reach a target recall@8 on
+the experiment's own frames and stored in the sidecar that index_cache
+applies at load time.
+The sidecar also points to total_fea.npy, stamped with its size and mtime,
+which index_cache memory-maps as the retrieval feature matrix. The file is
+only ever replaced, never rewritten in place, and the cache entries of
+index_dir are dropped first since Windows can't replace a mapped file.
+"""
+import os, glob, traceback
+import numpy as np
+from numpy.lib.format import open_memmap
+import faiss
+from sklearn.cluster import MiniBatchKMeans
+from index_cache import (
+    features_stamp,
+    index_cache,
+    index_meta_path,
+    read_index_meta,
+    write_index_meta,
+)
+
+KMEANS_MIN_ROWS = 2e5  # 超过这么多帧先kmeans成n_centers个中心再建索引
+N_CENTERS = 10000
+BATCH_SIZE_ADD = 8192
+INDEX_FAMILIES = ["auto", "ivf_flat", "ivf_pq", "opq_ivf_pq", "hnsw"]
+AUTO_PQ_ROWS = 5e4  # auto: 超过这么多向量试PQ FastScan, 召回率不够再退回IVF Flat
+INCREMENTAL_FAMILIES = ["ivf_flat", "ivf_pq"]  # 粗聚类中心在原始特征空间里
+SEARCH_K = 8  # VC里index.search的k
+N_QUERIES = 1000
+
+
+def feature_paths(feature_dir):
+    return [
+        "%s/%s" % (feature_dir, name)
+        for name in sorted(os.listdir(feature_dir))
+        if name.endswith(".npy")
+    ]
+
+
+def feature_manifest(paths):
+    """{file name: [frames, bytes]}, what the added index was built from"""
+    manifest = {}
+    for path in paths:
+        n_rows = np.load(path, mmap_mode="r").shape[0]
+        manifest[os.path.basename(path)] = [n_rows, os.path.getsize(path)]
+    return manifest
+
+
+def tmp_npy_path(npy_path):
+    return "%s.%s.tmp.npy" % (npy_path[: -len(".npy")], os.getpid())
+
+
+def feature_shape(paths):
+    # 只读npy头, 不读数据
+    n_rows, dim = 0, None
+    for path in paths:
+        shape = np.load(path, mmap_mode="r").shape
+        n_rows += shape[0]
+        dim = shape[1]
+    return n_rows, dim
+
+
+def iter_features(paths, chunk_rows):
+    """float32 chunks of about chunk_rows rows, in file order"""
+    buf, n_buf = [], 0
+    for path in paths:
+        feats = np.load(path, mmap_mode="r")
+        for i in range(0, feats.shape[0], chunk_rows):
+            buf.append(np.asarray(feats[i : i + chunk_rows], dtype=np.float32))
+            n_buf += buf[-1].shape[0]
+            if n_buf >= chunk_rows:
+                yield np.concatenate(buf, 0)
+                buf, n_buf = [], 0
+    if buf:
+        yield np.concatenate(buf, 0)
+
+
+def reservoir_sample(paths, n_samples, dim, chunk_rows, seed=None):
+    """
+    Uniform random sample of n_samples rows over all files (algorithm R,
+    vectorized per chunk), shuffled. Returns every row when there are fewer.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir = np.empty((n_samples, dim), dtype=np.float32)
+    n_seen = 0
+    for chunk in iter_features(paths, chunk_rows):
+        n_fill = max(0, min(n_samples - n_seen, chunk.shape[0]))
+        reservoir[n_seen : n_seen + n_fill] = chunk[:n_fill]
+        rest = chunk[n_fill:]
+        if rest.shape[0] > 0:
+            # 第t行(从0数)落到[0, t]里的随机一格, 落在水池里就替换
+            t = n_seen + n_fill + np.arange(rest.shape[0])
+            slots = (rng.random(rest.shape[0]) * (t + 1)).astype(np.int64)
+            keep = slots < n_samples
+            # 同一格在这个chunk里被替换多次时, 留最后一次
+            slots, rows = slots[keep][::-1], rest[keep][::-1]
+            slots, first = np.unique(slots, return_index=True)
+            reservoir[slots] = rows[first]
+        n_seen += chunk.shape[0]
+    reservoir = reservoir[: min(n_seen, n_samples)]
+    rng.shuffle(reservoir)  # MiniBatchKMeans按顺序取minibatch
+    return reservoir
+
+
+def factory_string(family, n_ivf, dim, refine=True):
+    # RFlat在索引里另存一份原向量做精排, 召回高但索引比IVF Flat还大;
+    # auto不加RFlat: 融合用的原向量本来就从total_fea.npy里读, 召回率由tune_index把关
+    m = 128 if dim % 128 == 0 else dim // 2  # PQ子空间数要整除维度
+    rflat = ",RFlat" if refine else ""
+    if family == "ivf_flat":
+        return "IVF%s,Flat" % n_ivf
+    if family == "ivf_pq":
+        return "IVF%s,PQ%sx4fs%s" % (n_ivf, m, rflat)
+    if family == "opq_ivf_pq":
+        return "OPQ%s,IVF%s,PQ%sx4fs%s" % (m, n_ivf, m, rflat)
+    if family == "hnsw":
+        return "HNSW32,Flat"
+    raise ValueError("unknown index family %s" % family)
+
+
+def search_param_grid(family, n_ivf):
+    if family == "hnsw":
+        return ["efSearch=%s" % ef for ef in [16, 32, 64, 128, 256, 512]]
+    nprobes = [1]
+    while nprobes[-1] * 2 <= n_ivf:
+        nprobes.append(nprobes[-1] * 2)
+    return ["nprobe=%s" % nprobe for nprobe in nprobes]
+
+
+def exact_knn(queries, base_chunks, k=SEARCH_K):
+    """exact top-k ids over base rows coming in chunks, merged chunk by chunk"""
+    best_d = np.full((queries.shape[0], 0), np.inf, dtype=np.float32)
+    best_i = np.zeros((queries.shape[0], 0), dtype=np.int64)
+    offset = 0
+    for chunk in base_chunks:
+        flat = faiss.IndexFlatL2(chunk.shape[1])
+        flat.add(np.ascontiguousarray(chunk, dtype=np.float32))
+        d, i = flat.search(queries, min(k, chunk.shape[0]))
+        best_d = np.concatenate([best_d, d], 1)
+        best_i = np.concatenate([best_i, i + offset], 1)
+        order = np.argsort(best_d, 1)[:, :k]
+        best_d = np.take_along_axis(best_d, order, 1)
+        best_i = np.take_along_axis(best_i, order, 1)
+        offset += chunk.shape[0]
+    return best_i
+
+
+def recall_at_k(ids, gt_ids):
+    hits = [len(set(a) & set(b)) for a, b in zip(ids.tolist(), gt_ids.tolist())]
+    return sum(hits) / float(gt_ids.size)
+
+
+def tune_search_params(index, family, n_ivf, queries, gt_ids, target_recall):
+    """smallest nprobe/efSearch reaching target_recall, else the largest tried"""
+    params = faiss.ParameterSpace()
+    for search_params in search_param_grid(family, n_ivf):
+        params.set_index_parameters(index, search_params)
+        _, ids = index.search(queries, SEARCH_K)
+        recall = recall_at_k(ids, gt_ids)
+        if recall >= target_recall:
+            break
+    return search_params, recall
+
+
+def tune_index(index, family, paths, total_fea_path, chunk_rows, target_recall):
+    """
+    Tune index on a fixed sample of the experiment's frames (seed 0) against
+    exact search over total_fea.npy. Returns (queries, search_params, recall).
+    """
+    base = np.load(total_fea_path, mmap_mode="r")
+    queries = reservoir_sample(paths, N_QUERIES, base.shape[1], chunk_rows, seed=0)
+    gt_ids = exact_knn(
+        queries,
+        (base[i : i + chunk_rows] for i in range(0, base.shape[0], chunk_rows)),
+    )
+    n_ivf = 0 if family == "hnsw" else faiss.extract_index_ivf(index).nlist
+    search_params, recall = tune_search_params(
+        index, family, n_ivf, queries, gt_ids, target_recall
+    )
+    return queries, search_params, recall
+
+
+def write_added_index(index, added_path, meta):
+    # 先写临时文件再换, 再写sidecar: index_cache按mtime发现索引变了,
+    # 不会拿新的meta(ntotal/nprobe/total_fea)去配旧的索引
+    tmp_path = "%s.%s.tmp" % (added_path, os.getpid())
+    faiss.write_index(index, tmp_path)
+    index_cache.drop_dir(os.path.dirname(added_path))  # 建索引期间又被推理加载了
+    os.replace(tmp_path, added_path)
+    write_index_meta(added_path, meta)
+
+
+def coarse_distance(index, vectors):
+    """mean squared distance of vectors to their nearest IVF centroid"""
+    quantizer = faiss.extract_index_ivf(index).quantizer
+    distances, _ = quantizer.search(vectors, 1)
+    return float(distances.mean())
+
+
+def index_name(prefix, factory, exp_name, version):
+    # nprobe/efSearch在sidecar里, 不进文件名: 追加后重新调参也不用改名,
+    # trained_和added_也只差前缀(infer-web按这个从trained找added)
+    return "%s_%s_%s_%s.index" % (prefix, factory.replace(",", "_"), exp_name, version)
+
+
+def build_index(
+    feature_dir,
+    index_dir,
+    exp_name,
+    version,
+    n_cpu=1,
+    mem_budget_mb=2048,
+    family="auto",
+    target_recall=0.9,
+):
+    """
+    Generator yielding progress messages. Writes total_fea.npy, the trained_
+    and added_ indexes and the added_ index's sidecar into index_dir.
+    Above KMEANS_MIN_ROWS frames the index holds the k-means centers of a
+    reservoir sample, otherwise every frame, added batch by batch from the files.
+    The last message is the file name of the added index.
+    """
+    index_cache.drop_dir(index_dir)
+    paths = feature_paths(feature_dir)
+    n_rows, dim = feature_shape(paths)
+    # 预算一半给采样出来的训练数据, 另一半留给kmeans/faiss训练时的临时内存
+    budget_rows = max(1, mem_budget_mb * 1024**2 // 2 // (dim * 4))
+    chunk_rows = max(1024, min(BATCH_SIZE_ADD * 8, budget_rows // 8))
+    n_sample = min(n_rows, budget_rows)
+    if n_sample < n_rows:
+        yield "sampling %s of %s frames for training" % (n_sample, n_rows)
+
+    centers = None
+    if n_rows > KMEANS_MIN_ROWS:
+        yield "Trying doing kmeans %s shape to 10k centers." % n_rows
+        try:
+            sample = reservoir_sample(paths, n_sample, dim, chunk_rows)
+            centers = (
+                MiniBatchKMeans(
+                    n_clusters=N_CENTERS,
+                    verbose=True,
+                    batch_size=256 * n_cpu,
+                    compute_labels=False,
+                    init="random",
+                )
+                .fit(sample)
+                .cluster_centers_
+            ).astype(np.float32)
+            del sample
+        except:
+            info = traceback.format_exc()
+            print(info)
+            yield info
+
+    # 先写total_fea.npy, 索引从它分批加, 退回IVF Flat重建时不用再读一遍特征文件
+    total_fea_path = "%s/total_fea.npy" % index_dir
+    if centers is not None:
+        np.save(tmp_npy_path(total_fea_path), centers)
+        n_total = centers.shape[0]
+    else:
+        total_fea = open_memmap(
+            tmp_npy_path(total_fea_path),
+            mode="w+",
+            dtype=np.float32,
+            shape=(n_rows, dim),
+        )
+        n_added = 0
+        for chunk in iter_features(paths, BATCH_SIZE_ADD):
+            total_fea[n_added : n_added + chunk.shape[0]] = chunk
+            n_added += chunk.shape[0]
+        total_fea.flush()
+        del total_fea
+        n_total = n_rows
+    os.replace(tmp_npy_path(total_fea_path), total_fea_path)
+    n_ivf = min(int(16 * np.sqrt(n_total)), n_total // 39)
+    auto_pq = family == "auto" and n_total > AUTO_PQ_ROWS
+    if family == "auto":
+        family = "ivf_pq" if auto_pq else "ivf_flat"
+    while 1:
+        factory = factory_string(family, n_ivf, dim, refine=not auto_pq)
+        yield "%s,%s,%s" % ((n_total, dim), n_ivf, factory)
+        index = faiss.index_factory(dim, factory)
+        yield "training index"
+        if family != "hnsw":
+            faiss.extract_index_ivf(index).nprobe = 1
+        if centers is not None:
+            index.train(centers)
+        else:
+            index.train(reservoir_sample(paths, n_sample, dim, chunk_rows))
+        trained_name = index_name("trained", factory, exp_name, version)
+        trained_path = "%s/%s" % (index_dir, trained_name)
+        faiss.write_index(index, trained_path)
+        yield "adding index"
+        total_fea = np.load(total_fea_path, mmap_mode="r")
+        for i in range(0, n_total, BATCH_SIZE_ADD):
+            index.add(np.ascontiguousarray(total_fea[i : i + BATCH_SIZE_ADD]))
+        del total_fea
+
+        yield "tuning search for recall@%s >= %s" % (SEARCH_K, target_recall)
+        queries, search_params, recall = tune_index(
+            index, family, paths, total_fea_path, chunk_rows, target_recall
+        )
+        yield "%s, recall@%s %.3f" % (search_params, SEARCH_K, recall)
+        if not auto_pq or recall >= target_recall:
+            break
+        yield "PQ index below target recall, building IVF Flat instead"
+        os.remove(trained_path)
+        auto_pq = False
+        family = "ivf_flat"
+    added_name = index_name("added", factory, exp_name, version)
+    added_path = "%s/%s" % (index_dir, added_name)
+    meta = {
+        "family": family,
+        "factory": factory,
+        "search_params": search_params,
+        "recall_at_%s" % SEARCH_K: recall,
+        "ntotal": int(index.ntotal),
+        "dim": dim,
+        # 索引里向量按id顺序的原始值, 相对索引所在目录
+        "features": os.path.basename(total_fea_path),
+        "features_stamp": features_stamp(total_fea_path),
+        # update_index用: 建索引用到的特征文件, 以及是否存的是kmeans中心
+        "kmeans": centers is not None,
+        "files": feature_manifest(paths),
+    }
+    if family in INCREMENTAL_FAMILIES:
+        meta["drift_baseline"] = coarse_distance(index, queries)
+    write_added_index(index, added_path, meta)
+    yield "Successful Index Construction，%s" % added_name
+
+
+def find_added_index(index_dir, exp_name, version):
+    """newest added_ index of this experiment that has a file manifest"""
+    paths = glob.glob("%s/added_*_%s_%s.index" % (index_dir, exp_name, version))
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        if "files" in read_index_meta(path):
+            return path
+    return None
+
+
+def append_rows(npy_path, paths, chunk_rows):
+    # npy头里有行数, 只能写个新文件: 旧的按块拷过去, 再接上新特征, 最后换掉
+    old = np.load(npy_path, mmap_mode="r")
+    n_new, dim = feature_shape(paths)
+    tmp_path = tmp_npy_path(npy_path)
+    total_fea = open_memmap(
+        tmp_path, mode="w+", dtype=np.float32, shape=(old.shape[0] + n_new, dim)
+    )
+    for i in range(0, old.shape[0], chunk_rows):
+        total_fea[i : i + chunk_rows] = old[i : i + chunk_rows]
+    n_rows = old.shape[0]
+    for chunk in iter_features(paths, chunk_rows):
+        total_fea[n_rows : n_rows + chunk.shape[0]] = chunk
+        n_rows += chunk.shape[0]
+    total_fea.flush()
+    del total_fea, old
+    os.replace(tmp_path, npy_path)
+
+
+def update_index(
+    feature_dir,
+    index_dir,
+    exp_name,
+    version,
+    n_cpu=1,
+    mem_budget_mb=2048,
+    family="auto",
+    target_recall=0.9,
+    drift_threshold=0.25,
+    full_rebuild=False,
+):
+    """
+    Incremental train_index. Appends only the feature files missing from the
+    manifest of the existing added_ index and keeps its trained centroids.
+    Falls back to build_index when there is no manifest, files were changed
+    or removed, the index holds k-means centers or can't be updated in place,
+    or the new frames are more than drift_threshold farther (relative, mean
+    squared distance) from their nearest centroid than the indexed ones were.
+    """
+    index_cache.drop_dir(index_dir)
+    added_path = find_added_index(index_dir, exp_name, version)
+    meta = read_index_meta(added_path) if added_path else {}
+    paths = feature_paths(feature_dir)
+    manifest = feature_manifest(paths)
+    new_paths = [p for p in paths if os.path.basename(p) not in meta.get("files", {})]
+    n_new = sum(manifest[os.path.basename(p)][0] for p in new_paths)
+
+    reason = None
+    if full_rebuild:
+        reason = "requested"
+    elif added_path is None:
+        reason = "no index with a file manifest yet"
+    elif any(manifest.get(name) != info for name, info in meta["files"].items()):
+        reason = "indexed feature files were changed or removed"
+    elif meta.get("kmeans") or meta["ntotal"] + n_new > KMEANS_MIN_ROWS:
+        reason = "the index holds (or would need) kmeans centers"
+    elif meta["family"] not in INCREMENTAL_FAMILIES or family not in [
+        "auto",
+        meta["family"],
+    ]:
+        reason = "%s index can't be updated in place" % meta["family"]
+    elif not new_paths:
+        yield "index is up to date, %s" % os.path.basename(added_path)
+        return
+    if reason is None:
+        index = faiss.read_index(added_path)
+        dim = meta["dim"]
+        sample = reservoir_sample(new_paths, N_QUERIES * 10, dim, BATCH_SIZE_ADD)
+        drift = coarse_distance(index, sample) / max(meta["drift_baseline"], 1e-9)
+        yield "%s new frames, drift %.3f" % (n_new, drift)
+        if drift > 1 + drift_threshold:
+            reason = "drift %.3f above 1 + %s" % (drift, drift_threshold)
+    if reason is not None:
+        yield "full rebuild: %s" % reason
+        for info in build_index(
+            feature_dir,
+            index_dir,
+            exp_name,
+            version,
+            n_cpu=n_cpu,
+            mem_budget_mb=mem_budget_mb,
+            family=family,
+            target_recall=target_recall,
+        ):
+            yield info
+        return
+
+    yield "adding %s new frames" % n_new
+    for chunk in iter_features(new_paths, BATCH_SIZE_ADD):
+        index.add(chunk)
+    total_fea_path = "%s/total_fea.npy" % index_dir
+    append_rows(total_fea_path, new_paths, BATCH_SIZE_ADD * 8)
+    # 加了新帧以后原来的nprobe/efSearch不一定还够, 在固定的查询样本上重新调
+    yield "tuning search for recall@%s >= %s" % (SEARCH_K, target_recall)
+    _, search_params, recall = tune_index(
+        index, meta["family"], paths, total_fea_path, BATCH_SIZE_ADD * 8, target_recall
+    )
+    yield "%s, recall@%s %.3f" % (search_params, SEARCH_K, recall)
+    meta["search_params"] = search_params
+    meta["recall_at_%s" % SEARCH_K] = recall
+    meta["ntotal"] = int(index.ntotal)
+    meta["files"] = manifest
+    meta["features_stamp"] = features_stamp(total_fea_path)
+    # 以前的文件名里带nprobe, 重新调过参就换成不带的名字
+    new_path = "%s/%s" % (
+        index_dir,
+        index_name("added", meta["factory"], exp_name, version),
+    )
+    write_added_index(index, new_path, meta)
+    if os.path.abspath(new_path) != os.path.abspath(added_path):
+        for path in [added_path, index_meta_path(added_path)]:
+            os.remove(path)
+    yield "Successful Index Update，%s" % os.path.basename(new_path)
@@ -0,0 +1,204 @@
+import os, json, threading, traceback
+from collections import OrderedDict
+
+import numpy as np, faiss, torch
+
+
+def index_meta_path(file_index):
+    return file_index + ".json"
+
+
+def read_index_meta(file_index):
+    """sidecar written by index_builder next to the index, {} for older indexes"""
+    try:
+        with open(index_meta_path(file_index)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_index_meta(file_index, meta):
+    # 推理进程可能正好在读, 写完整再换上去
+    tmp_path = "%s.%s.tmp" % (index_meta_path(file_index), os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=4)
+    os.replace(tmp_path, index_meta_path(file_index))
+
+
+def apply_search_params(index, meta):
+    # 建索引时按目标召回率选好的nprobe/efSearch
+    if meta.get("search_params"):
+        faiss.ParameterSpace().set_index_parameters(index, meta["search_params"])
+
+
+def read_index_mmap(file_index):
+    """(index, mapped), index types that can't be mapped are read as usual"""
+    # 倒排表直接映射文件, 多进程共享页缓存
+    try:
+        return faiss.read_index(file_index, faiss.IO_FLAG_MMAP), True
+    except:
+        return faiss.read_index(file_index), False
+
+
+def features_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_features(file_index, index, meta):
+    """
+    The feature matrix of index as a read-only memmap of the file named in the
+    sidecar, or None for older indexes and files that don't match the index.
+    """
+    if not meta.get("features"):
+        return None
+    path = os.path.join(os.path.dirname(file_index), meta["features"])
+    try:
+        # 同目录下重新建过索引(kmeans中心形状都一样), 或者正写到一半
+        if features_stamp(path) != meta.get("features_stamp"):
+            return None
+        big_npy = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if big_npy.shape != (index.ntotal, index.d):
+        return None
+    return big_npy
+
+
+def device_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+class IndexCache(object):
+    """
+    Process-wide cache of retrieval indexes.
+    The index is memory-mapped and big_npy is the memmap of the total_fea.npy
+    its sidecar points to, so processes serving the same model share pages;
+    for indexes without one the feature matrix is copied out with
+    reconstruct_n. Either way keep (index, big_npy) alive between pipeline
+    calls. get_on_device additionally keeps one copy of big_npy on the
+    inference device per entry.
+    Entries are keyed by (path, mtime, size): rewriting the file invalidates them.
+    Least recently used entries (with their device copy) are dropped once there
+    are more than max_entries, or the bytes held outside the page cache (copied
+    feature matrices, indexes that couldn't be mapped, device copies) exceed
+    max_bytes.
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024 * 1024, max_entries=8):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (index, big_npy, n_bytes)
+        self.device_copies = {}  # key -> big_npy as a tensor on the device
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(file_index):
+        st = os.stat(file_index)
+        return (os.path.abspath(file_index), st.st_mtime_ns, st.st_size)
+
+    def get(self, file_index):
+        key = self.make_key(file_index)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                index, big_npy, _ = self.entries[key]
+                return index, big_npy
+        meta = read_index_meta(file_index)
+        index, mapped = read_index_mmap(file_index)
+        apply_search_params(index, meta)
+        # 映射的页缓存不算, 内存紧时内核会换出; 读进来的索引约等于文件大小
+        n_bytes = 0 if mapped else key[2]
+        big_npy = load_features(file_index, index, meta)
+        if big_npy is None:
+            big_npy = index.reconstruct_n(0, index.ntotal)
+            n_bytes += big_npy.nbytes
+        with self.lock:
+            if key not in self.entries:
+                self._drop_path(key[0])
+                self.entries[key] = (index, big_npy, n_bytes)
+                self.n_bytes += n_bytes
+                self._evict()
+            index, big_npy, _ = self.entries[key]
+        return index, big_npy
+
+    def get_on_device(self, file_index, device, dtype):
+        index, big_npy = self.get(file_index)
+        key = self.make_key(file_index)
+        with self.lock:
+            big_feats = self.device_copies.get(key)
+        if (
+            big_feats is None
+            or big_feats.device != torch.device(device)
+            or big_feats.dtype != dtype
+        ):
+            # memmap只读, 分块拷上去, 不在内存里整份再复制一遍
+            big_feats = torch.empty(big_npy.shape, device=device, dtype=dtype)
+            for i in range(0, big_npy.shape[0], 65536):
+                chunk = np.array(big_npy[i : i + 65536], dtype=np.float32)
+                big_feats[i : i + 65536] = torch.from_numpy(chunk)
+            with self.lock:
+                if key in self.entries:
+                    self._drop_device_copy(key)
+                    self.device_copies[key] = big_feats
+                    self.n_bytes += device_bytes(big_feats)
+                    self._evict()
+        return index, big_feats
+
+    def _drop_device_copy(self, key):
+        big_feats = self.device_copies.pop(key, None)
+        if big_feats is not None:
+            self.n_bytes -= device_bytes(big_feats)
+
+    def _drop(self, key):
+        self.n_bytes -= self.entries.pop(key)[2]
+        self._drop_device_copy(key)
+
+    def _drop_path(self, path):
+        for key in [key for key in self.entries if key[0] == path]:
+            self._drop(key)
+
+    def drop_dir(self, index_dir):
+        """
+        Drop the entries of indexes in index_dir before rewriting files there:
+        Windows can't replace a file that is still memory-mapped.
+        """
+        index_dir = os.path.join(os.path.abspath(index_dir), "")
+        with self.lock:
+            for key in [key for key in self.entries if key[0].startswith(index_dir)]:
+                self._drop(key)
+
+    def _evict(self):
+        # 最近用到的那个无论多大都留着
+        while len(self.entries) > 1 and (
+            self.n_bytes > self.max_bytes or len(self.entries) > self.max_entries
+        ):
+            self._drop(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.device_copies.clear()
+            self.n_bytes = 0
+
+
+index_cache = IndexCache()
+
+
+def load_index(file_index, device=None, dtype=None):
+    """
+    Return (index, big_npy) for file_index, or (None, None) if it can't be read.
+    With a device big_npy comes back as a tensor on it, or as the host array
+    if it doesn't fit there.
+    """
+    if device is not None:
+        try:
+            return index_cache.get_on_device(file_index, device, dtype)
+        except:
+            traceback.print_exc()
+    try:
+        return index_cache.get(file_index)
+    except:
+        traceback.print_exc()
+        return None, None
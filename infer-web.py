@@ -8,6 +8,9 @@ import signal
 
 now_dir = os.getcwd()
 sys.path.append(now_dir)
+import f0_pool
+
+f0_pool.start_pool()  # harvest进程在import torch和起gradio线程之前fork
 import traceback, pdb
 import warnings
 
@@ -42,7 +45,8 @@ from MDXNet import MDXNetDereverb
 from my_utils import load_audio, CSVutil
 from train.process_ckpt import change_info, extract_small_model, merge, show_info
 from vc_infer_pipeline import VC
-from sklearn.cluster import MiniBatchKMeans
+from index_cache import index_cache
+from index_builder import update_index
 
 tmp = os.path.join(now_dir, "TEMP")
 shutil.rmtree(tmp, ignore_errors=True)
@@ -494,6 +498,7 @@ def get_vc(sid, to_return_protect0, to_return_protect1):
             print("clean_empty_cache")
             del net_g, n_spk, vc, hubert_model, tgt_sr  # ,cpt
             hubert_model = net_g = n_spk = vc = hubert_model = tgt_sr = None
+            index_cache.clear()
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             ###楼下不这么折腾清理不干净
@@ -773,10 +778,14 @@ def extract_f0_feature(gpus, n_p, f0method, if_f0, exp_dir, version19, echl):
     """
     leng = len(gpus)
     ps = []
+    # 清掉上次中断留下的认领记录, 各part在这里动态认领文件
+    shutil.rmtree(
+        "%s/logs/%s/.feature_claims" % (now_dir, exp_dir), ignore_errors=True
+    )
     for idx, n_g in enumerate(gpus):
         cmd = (
             config.python_cmd
-            + " extract_feature_print.py %s %s %s %s %s/logs/%s %s"
+            + " extract_feature_print.py %s %s %s %s %s/logs/%s %s %s %s"
             % (
                 config.device,
                 leng,
@@ -785,6 +794,8 @@ def extract_f0_feature(gpus, n_p, f0method, if_f0, exp_dir, version19, echl):
                 now_dir,
                 exp_dir,
                 version19,
+                config.extract_batch_size,
+                0,
             )
         )
         print(cmd)
@@ -1049,6 +1060,14 @@ def click_train(
     with open("%s/filelist.txt" % exp_dir, "w") as f:
         f.write("\n".join(opt))
     print("write filelist done")
+    # 打包成每个字段一个连续文件, 训练时memmap读; 源文件没变过就直接跳过
+    cmd = config.python_cmd + ' pack_trainset_print.py "%s" %s %s' % (
+        exp_dir,
+        sr2,
+        version19,
+    )
+    print(cmd)
+    Popen(cmd, shell=True, cwd=now_dir).wait()
     # 生成config#无需生成config
     # cmd = python_cmd + " train_nsf_sim_cache_sid_load_pretrain.py -e mi-test -sr 40k -f0 1 -bs 4 -g 0 -te 10 -se 5 -pg pretrained/f0G40k.pth -pd pretrained/f0D40k.pth -l 1 -c 0"
     print("use gpus:", gpus16)
@@ -1127,70 +1146,21 @@ def train_index(exp_dir1, version19):
     if len(listdir_res) == 0:
         return "请先进行特征提取！"
     infos = []
-    npys = []
-    for name in sorted(listdir_res):
-        phone = np.load("%s/%s" % (feature_dir, name))
-        npys.append(phone)
-    big_npy = np.concatenate(npys, 0)
-    big_npy_idx = np.arange(big_npy.shape[0])
-    np.random.shuffle(big_npy_idx)
-    big_npy = big_npy[big_npy_idx]
-    if big_npy.shape[0] > 2e5:
-        # if(1):
-        infos.append("Trying doing kmeans %s shape to 10k centers." % big_npy.shape[0])
+    # 分块流式读特征, 内存占用受config.index_mem_mb限制
+    for info in update_index(
+        feature_dir,
+        exp_dir,
+        exp_dir1,
+        version19,
+        n_cpu=config.n_cpu,
+        mem_budget_mb=config.index_mem_mb,
+        family=config.index_family,
+        target_recall=config.index_recall,
+        drift_threshold=config.index_drift,
+        full_rebuild=config.index_full_rebuild,
+    ):
+        infos.append(info)
         yield "\n".join(infos)
-        try:
-            big_npy = (
-                MiniBatchKMeans(
-                    n_clusters=10000,
-                    verbose=True,
-                    batch_size=256 * config.n_cpu,
-                    compute_labels=False,
-                    init="random",
-                )
-                .fit(big_npy)
-                .cluster_centers_
-            )
-        except:
-            info = traceback.format_exc()
-            print(info)
-            infos.append(info)
-            yield "\n".join(infos)
-
-    np.save("%s/total_fea.npy" % exp_dir, big_npy)
-    n_ivf = min(int(16 * np.sqrt(big_npy.shape[0])), big_npy.shape[0] // 39)
-    infos.append("%s,%s" % (big_npy.shape, n_ivf))
-    yield "\n".join(infos)
-    index = faiss.index_factory(256 if version19 == "v1" else 768, "IVF%s,Flat" % n_ivf)
-    # index = faiss.index_factory(256if version19=="v1"else 768, "IVF%s,PQ128x4fs,RFlat"%n_ivf)
-    infos.append("training")
-    yield "\n".join(infos)
-    index_ivf = faiss.extract_index_ivf(index)  #
-    index_ivf.nprobe = 1
-    index.train(big_npy)
-    faiss.write_index(
-        index,
-        "%s/trained_IVF%s_Flat_nprobe_%s_%s_%s.index"
-        % (exp_dir, n_ivf, index_ivf.nprobe, exp_dir1, version19),
-    )
-    # faiss.write_index(index, '%s/trained_IVF%s_Flat_FastScan_%s.index'%(exp_dir,n_ivf,version19))
-    infos.append("adding")
-    yield "\n".join(infos)
-    batch_size_add = 8192
-    for i in range(0, big_npy.shape[0], batch_size_add):
-        index.add(big_npy[i : i + batch_size_add])
-    faiss.write_index(
-        index,
-        "%s/added_IVF%s_Flat_nprobe_%s_%s_%s.index"
-        % (exp_dir, n_ivf, index_ivf.nprobe, exp_dir1, version19),
-    )
-    infos.append(
-        "Successful Index Construction，added_IVF%s_Flat_nprobe_%s_%s_%s.index"
-        % (n_ivf, index_ivf.nprobe, exp_dir1, version19)
-    )
-    # faiss.write_index(index, '%s/added_IVF%s_Flat_FastScan_%s.index'%(exp_dir,n_ivf,version19))
-    # infos.append("成功构建索引，added_IVF%s_Flat_FastScan_%s.index"%(n_ivf,version19))
-    yield "\n".join(infos)
 
 
 # def setBoolean(status): #true to false and vice versa / not implemented yet, dont touch!!!!!!!
@@ -1272,14 +1242,21 @@ def train1key(
     gpus = gpus16.split("-")
     leng = len(gpus)
     ps = []
+    shutil.rmtree("%s/.feature_claims" % model_log_dir, ignore_errors=True)
     for idx, n_g in enumerate(gpus):
-        cmd = config.python_cmd + " extract_feature_print.py %s %s %s %s %s %s" % (
-            config.device,
-            leng,
-            idx,
-            n_g,
-            model_log_dir,
-            version19,
+        cmd = (
+            config.python_cmd
+            + " extract_feature_print.py %s %s %s %s %s %s %s %s"
+            % (
+                config.device,
+                leng,
+                idx,
+                n_g,
+                model_log_dir,
+                version19,
+                config.extract_batch_size,
+                0,
+            )
         )
         yield get_info_str(cmd)
         p = Popen(
@@ -1351,6 +1328,13 @@ def train1key(
     with open("%s/filelist.txt" % model_log_dir, "w") as f:
         f.write("\n".join(opt))
     yield get_info_str("write filelist done")
+    cmd = config.python_cmd + ' pack_trainset_print.py "%s" %s %s' % (
+        model_log_dir,
+        sr2,
+        version19,
+    )
+    yield get_info_str(cmd)
+    Popen(cmd, shell=True, cwd=now_dir).wait()
     if gpus16:
         cmd = (
             config.python_cmd
@@ -1395,67 +1379,19 @@ def train1key(
     p.wait()
     yield get_info_str(i18n("训练结束, 您可查看控制台训练日志或实验文件夹下的train.log"))
     #######step3b:训练索引
-    npys = []
-    listdir_res = list(os.listdir(feature_dir))
-    for name in sorted(listdir_res):
-        phone = np.load("%s/%s" % (feature_dir, name))
-        npys.append(phone)
-    big_npy = np.concatenate(npys, 0)
-
-    big_npy_idx = np.arange(big_npy.shape[0])
-    np.random.shuffle(big_npy_idx)
-    big_npy = big_npy[big_npy_idx]
-
-    if big_npy.shape[0] > 2e5:
-        # if(1):
-        info = "Trying doing kmeans %s shape to 10k centers." % big_npy.shape[0]
-        print(info)
+    for info in update_index(
+        feature_dir,
+        model_log_dir,
+        exp_dir1,
+        version19,
+        n_cpu=config.n_cpu,
+        mem_budget_mb=config.index_mem_mb,
+        family=config.index_family,
+        target_recall=config.index_recall,
+        drift_threshold=config.index_drift,
+        full_rebuild=config.index_full_rebuild,
+    ):
         yield get_info_str(info)
-        try:
-            big_npy = (
-                MiniBatchKMeans(
-                    n_clusters=10000,
-                    verbose=True,
-                    batch_size=256 * config.n_cpu,
-                    compute_labels=False,
-                    init="random",
-                )
-                .fit(big_npy)
-                .cluster_centers_
-            )
-        except:
-            info = traceback.format_exc()
-            print(info)
-            yield get_info_str(info)
-
-    np.save("%s/total_fea.npy" % model_log_dir, big_npy)
-
-    # n_ivf =  big_npy.shape[0] // 39
-    n_ivf = min(int(16 * np.sqrt(big_npy.shape[0])), big_npy.shape[0] // 39)
-    yield get_info_str("%s,%s" % (big_npy.shape, n_ivf))
-    index = faiss.index_factory(256 if version19 == "v1" else 768, "IVF%s,Flat" % n_ivf)
-    yield get_info_str("training index")
-    index_ivf = faiss.extract_index_ivf(index)  #
-    index_ivf.nprobe = 1
-    index.train(big_npy)
-    faiss.write_index(
-        index,
-        "%s/trained_IVF%s_Flat_nprobe_%s_%s_%s.index"
-        % (model_log_dir, n_ivf, index_ivf.nprobe, exp_dir1, version19),
-    )
-    yield get_info_str("adding index")
-    batch_size_add = 8192
-    for i in range(0, big_npy.shape[0], batch_size_add):
-        index.add(big_npy[i : i + batch_size_add])
-    faiss.write_index(
-        index,
-        "%s/added_IVF%s_Flat_nprobe_%s_%s_%s.index"
-        % (model_log_dir, n_ivf, index_ivf.nprobe, exp_dir1, version19),
-    )
-    yield get_info_str(
-        "成功构建索引, added_IVF%s_Flat_nprobe_%s_%s_%s.index"
-        % (n_ivf, index_ivf.nprobe, exp_dir1, version19)
-    )
     yield get_info_str(i18n("全流程结束！"))
 
 
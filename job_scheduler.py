@@ -0,0 +1,107 @@
+import os, shutil, multiprocessing, traceback
+
+
+def file_weight(path):
+    # 文件大小当作时长估计, 只用来排序
+    try:
+        return os.path.getsize(path)
+    except:
+        return 0
+
+
+class WorkQueue(object):
+    """
+    Shared longest-first job queue for the multiprocessing.Process workers of the
+    dataset stages. Workers pull the next job as soon as they are free instead of
+    getting a fixed jobs[i::n] slice, so the tail is bounded by one job.
+    Create it before starting the workers and pass it to them.
+    """
+
+    def __init__(self, jobs, n_workers, weight=None):
+        weights = [weight(job) if weight else 1 for job in jobs]
+        self.n_jobs = len(jobs)
+        self.total_work = float(sum(weights)) or 1.0
+        self.queue = multiprocessing.Queue()
+        for i in sorted(range(len(jobs)), key=lambda i: weights[i], reverse=True):
+            self.queue.put((jobs[i], weights[i]))
+        for _ in range(n_workers):
+            self.queue.put(None)
+        # 每个worker只写自己那一格, 不用加锁
+        self.done_jobs = multiprocessing.Array("l", n_workers, lock=False)
+        self.done_work = multiprocessing.Array("d", n_workers, lock=False)
+
+    def jobs(self, worker_id):
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                return
+            job, weight = item
+            yield job
+            self.done_jobs[worker_id] += 1
+            self.done_work[worker_id] += weight
+
+    def progress(self):
+        return "progress %s/%s (%.1f%%) | %s" % (
+            sum(self.done_jobs),
+            self.n_jobs,
+            100 * sum(self.done_work) / self.total_work,
+            " ".join(
+                "w%s:%s" % (i, n_done) for i, n_done in enumerate(self.done_jobs)
+            ),
+        )
+
+    def join(self, ps, log=print, interval=30):
+        """join worker processes, logging progress every interval seconds"""
+        for p in ps:
+            while 1:
+                p.join(interval)
+                if not p.is_alive():
+                    break
+                log(self.progress())
+        log(self.progress())
+
+
+class FileClaimQueue(object):
+    """
+    Longest-first job list shared by independently launched processes (the
+    extract_feature_print parts started by infer-web.py). Every part walks the
+    same order and takes a job by creating its claim file with O_EXCL, so the
+    parts pull work dynamically instead of using a fixed [i_part::n_part] slice.
+    The last part to finish removes claim_dir.
+    """
+
+    def __init__(self, jobs, claim_dir, i_part, n_part, weight=None):
+        weights = [weight(job) if weight else 1 for job in jobs]
+        order = sorted(range(len(jobs)), key=lambda i: weights[i], reverse=True)
+        self.jobs_sorted = [jobs[i] for i in order]
+        self.claim_dir = claim_dir
+        self.i_part = i_part
+        self.n_part = n_part
+        os.makedirs(claim_dir, exist_ok=True)
+
+    def claim(self, name):
+        try:
+            fd = os.open(
+                os.path.join(self.claim_dir, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+            )
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+    def jobs(self):
+        for idx, job in enumerate(self.jobs_sorted):
+            if self.n_part == 1 or self.claim("job_%s" % idx):
+                yield job
+        self.finish()
+
+    def finish(self):
+        self.claim("done_%s" % self.i_part)
+        try:
+            n_done = len(
+                [i for i in os.listdir(self.claim_dir) if i.startswith("done_")]
+            )
+            if n_done >= self.n_part:
+                shutil.rmtree(self.claim_dir, ignore_errors=True)
+        except:
+            traceback.print_exc()
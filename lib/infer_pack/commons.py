@@ -41,22 +41,20 @@ def rand_gumbel_like(x):
     return g
 
 
+def segment_indices(x, ids_str, segment_size):
+    # (b, segment_size): 每条样本[ids_str, ids_str + segment_size)的下标
+    ids_str = torch.as_tensor(ids_str, device=x.device).view(-1, 1)
+    return ids_str + torch.arange(segment_size, device=x.device)
+
+
 def slice_segments(x, ids_str, segment_size=4):
-    ret = torch.zeros_like(x[:, :, :segment_size])
-    for i in range(x.size(0)):
-        idx_str = ids_str[i]
-        idx_end = idx_str + segment_size
-        ret[i] = x[i, :, idx_str:idx_end]
-    return ret
+    # 一次gather取出整个batch的片段, 不再逐条切
+    idx = segment_indices(x, ids_str, segment_size).unsqueeze(1)
+    return torch.gather(x, 2, idx.expand(-1, x.size(1), -1))
 
 
 def slice_segments2(x, ids_str, segment_size=4):
-    ret = torch.zeros_like(x[:, :segment_size])
-    for i in range(x.size(0)):
-        idx_str = ids_str[i]
-        idx_end = idx_str + segment_size
-        ret[i] = x[i, idx_str:idx_end]
-    return ret
+    return torch.gather(x, 1, segment_indices(x, ids_str, segment_size))
 
 
 def rand_slice_segments(x, x_lengths=None, segment_size=4):
@@ -164,3 +162,14 @@ def clip_grad_value_(parameters, clip_value, norm_type=2):
             p.grad.data.clamp_(min=-clip_value, max=clip_value)
     total_norm = total_norm ** (1.0 / norm_type)
     return total_norm
+
+
+# hubert卷积特征提取层的(kernel, stride)
+hubert_conv_layers = [(10, 5)] + [(3, 2)] * 4 + [(2, 2)] * 2
+
+
+def hubert_frames(n_samples):
+    """number of hubert frames for n_samples of 16k audio"""
+    for kernel, stride in hubert_conv_layers:
+        n_samples = (n_samples - kernel) // stride + 1
+    return n_samples
@@ -0,0 +1,129 @@
+"""
+把filelist.txt里的每条样本(wav, 特征, f0, spec)打包成每个字段一个连续文件 + 偏移索引,
+训练时用np.memmap切片读取, 不再每条样本开五个小文件
+python pack_trainset_print.py exp_dir sr version
+"""
+import os, sys, json, shutil, traceback
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append(os.path.join(now_dir, "train"))
+exp_dir = sys.argv[1]
+sr = sys.argv[2]
+version = sys.argv[3]
+import numpy as np, torch
+from mel_processing import spectrogram_torch
+from utils import load_wav_to_torch, load_filepaths_and_text, get_hparams_from_file
+from data_utils import filelist_digest, get_packed_dir
+
+f = open("%s/pack_trainset.log" % exp_dir, "a+")
+
+
+def printt(strr):
+    print(strr)
+    f.write("%s\n" % strr)
+    f.flush()
+
+
+class FieldWriter(object):
+    def __init__(self, packed_dir, name, dtype):
+        self.packed_dir = packed_dir
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.shape = None
+        self.offsets = [0]
+        self.f = open(os.path.join(packed_dir, "%s.bin" % name), "wb")
+
+    def append(self, arr):
+        arr = np.ascontiguousarray(arr, dtype=self.dtype)
+        if self.shape is None:
+            self.shape = list(arr.shape[1:])
+        assert list(arr.shape[1:]) == self.shape, (self.name, arr.shape, self.shape)
+        self.f.write(arr.tobytes())
+        self.offsets.append(self.offsets[-1] + arr.shape[0])
+
+    def close(self):
+        self.f.close()
+        np.save(
+            os.path.join(self.packed_dir, "%s.idx.npy" % self.name),
+            np.array(self.offsets, dtype=np.int64),
+        )
+        return {"dtype": self.dtype.name, "shape": self.shape or []}
+
+
+def pack(filelist, packed_dir, hps):
+    entries = load_filepaths_and_text(filelist)
+    if_f0 = len(entries[0]) == 5
+    names = ["wav", "spec", "phone"] + (["pitch", "pitchf"] if if_f0 else [])
+    dtypes = ["float32", "float32", "float32", "int64", "float32"]
+    writers = [
+        FieldWriter(packed_dir, name, dtype) for name, dtype in zip(names, dtypes)
+    ]
+    sids = []
+    lengths = []
+    n = max(1, len(entries) // 10)  # 最多打印十条
+    for idx, entry in enumerate(entries):
+        audiopath = entry[0]
+        audio, sampling_rate = load_wav_to_torch(audiopath)
+        if sampling_rate != hps.data.sampling_rate:
+            raise ValueError(
+                "{} SR doesn't match target {} SR".format(
+                    sampling_rate, hps.data.sampling_rate
+                )
+            )
+        spec_path = audiopath.replace(".wav", ".spec.npy")
+        if os.path.exists(spec_path):  # extract_spec_print算过的直接用
+            spec = np.load(spec_path)
+        else:
+            spec = spectrogram_torch(
+                audio.unsqueeze(0),
+                hps.data.filter_length,
+                hps.data.sampling_rate,
+                hps.data.hop_length,
+                hps.data.win_length,
+                center=False,
+            )
+            spec = torch.squeeze(spec, 0).numpy()
+        fields = [audio.numpy(), spec.T, np.load(entry[1])]
+        if if_f0:
+            fields += [np.load(entry[2]), np.load(entry[3])]
+        for writer, field in zip(writers, fields):
+            writer.append(field)
+        sids.append(entry[-1])
+        # 和load_spec_lengths给TextAudioLoader的分桶长度一致
+        lengths.append(min(audio.shape[0] // hps.data.hop_length, 900))
+        if idx % n == 0:
+            printt("now-%s,all-%s,%s" % (idx, len(entries), audiopath))
+    meta = {
+        "filelist": filelist_digest(filelist),
+        "fields": {writer.name: writer.close() for writer in writers},
+        "sids": sids,
+        "lengths": lengths,
+    }
+    with open(os.path.join(packed_dir, "meta.json"), "w") as f_meta:
+        json.dump(meta, f_meta)
+
+
+if __name__ == "__main__":
+    printt(sys.argv)
+    if version == "v1" or sr == "40k":
+        config_path = "configs/%s.json" % sr
+    else:
+        config_path = "configs/%s_v2.json" % sr
+    hps = get_hparams_from_file(config_path)
+    packed_dir = "%s/packed" % exp_dir
+    # 源文件都没变过就不重打包(infer-web每次点训练都会跑这一步)
+    if get_packed_dir("%s/filelist.txt" % exp_dir, 0) is not None:
+        printt("pack-trainset-up-to-date")
+        sys.exit(0)
+    tmp_dir = "%s/packed.tmp" % exp_dir
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        pack("%s/filelist.txt" % exp_dir, tmp_dir, hps)
+        # 写完再换上去, 训练不会读到半截的目录
+        shutil.rmtree(packed_dir, ignore_errors=True)
+        os.replace(tmp_dir, packed_dir)
+        printt("pack-trainset-done")
+    except:
+        printt(traceback.format_exc())
@@ -328,7 +328,14 @@ class MelSpectrogram(torch.nn.Module):
 
 
 class RMVPE:
-    def __init__(self, model_path, is_half, device=None):
+    def __init__(
+        self,
+        model_path,
+        is_half,
+        device=None,
+        chunk_frames=32 * 250,
+        overlap_frames=32 * 16,
+    ):
         self.resample_kernel = {}
         model = E2E(4, 1, (2, 2))
         ckpt = torch.load(model_path, map_location="cpu")
@@ -348,6 +355,13 @@ class RMVPE:
         self.model = self.model.to(device)
         cents_mapping = 20 * np.arange(360) + 1997.3794084376191
         self.cents_mapping = np.pad(cents_mapping, (4, 4))  # 368
+        self.cents_mapping_torch = (
+            torch.from_numpy(self.cents_mapping).float().to(device)
+        )
+        # 长音频按chunk_frames帧分段推理, 前后各带overlap_frames帧上下文再裁掉;
+        # 都取32的倍数, 中间的段送进mel2hidden时不需要再pad. chunk_frames=0关闭分段
+        self.chunk_frames = 32 * ((chunk_frames + 31) // 32) if chunk_frames else 0
+        self.overlap_frames = 32 * ((overlap_frames + 31) // 32)
 
     def mel2hidden(self, mel):
         with torch.no_grad():
@@ -365,7 +379,17 @@ class RMVPE:
         # f0 = np.array([10 * (2 ** (cent_pred / 1200)) if cent_pred else 0 for cent_pred in cents_pred])
         return f0
 
-    def infer_from_audio(self, audio, thred=0.03):
+    def decode_torch(self, hidden, thred=0.03):
+        # hidden留在模型所在设备上解码, 只把最后的f0拷回host
+        cents_pred = self.to_local_average_cents_torch(hidden.float(), thred=thred)
+        f0 = 10 * (2 ** (cents_pred / 1200))
+        f0[f0 == 10] = 0
+        return f0.cpu().numpy()
+
+    def infer_from_audio(self, audio, thred=0.03, decode_on_device=True):
+        n_frames = audio.shape[0] // 160 + 1
+        if self.chunk_frames and n_frames > self.chunk_frames + 2 * self.overlap_frames:
+            return self.infer_from_audio_chunked(audio, thred, decode_on_device)
         audio = torch.from_numpy(audio).float().to(self.device).unsqueeze(0)
         # torch.cuda.synchronize()
         # t0=ttime()
@@ -375,6 +399,8 @@ class RMVPE:
         hidden = self.mel2hidden(mel)
         # torch.cuda.synchronize()
         # t2=ttime()
+        if decode_on_device:
+            return self.decode_torch(hidden.squeeze(0), thred=thred)
         hidden = hidden.squeeze(0).cpu().numpy()
         if self.is_half == True:
             hidden = hidden.astype("float32")
@@ -384,22 +410,68 @@ class RMVPE:
         # print("hmvpe:%s\t%s\t%s\t%s"%(t1-t0,t2-t1,t3-t2,t3-t0))
         return f0
 
+    def infer_from_audio_batch(self, audios, thred=0.03):
+        """
+        audios: list of 1-d arrays, zero-padded to the longest one and run as a
+        single batch. Returns one f0 array per input, cut to its own frame count.
+        The BiGRU sees the padding, so callers should batch similar lengths.
+        """
+        n_frames = [audio.shape[0] // 160 + 1 for audio in audios]
+        batch = np.zeros(
+            (len(audios), max(audio.shape[0] for audio in audios)), dtype=np.float32
+        )
+        for i, audio in enumerate(audios):
+            batch[i, : audio.shape[0]] = audio
+        batch = torch.from_numpy(batch).to(self.device)
+        mel = self.mel_extractor(batch, center=True)
+        hidden = self.mel2hidden(mel)
+        return [
+            self.decode_torch(hidden[i, :n], thred=thred)
+            for i, n in enumerate(n_frames)
+        ]
+
+    def infer_from_audio_chunked(self, audio, thred=0.03, decode_on_device=True):
+        """
+        Same output as infer_from_audio, but mel, hidden and decoding are done one
+        chunk at a time, so peak memory depends on chunk_frames, not on duration.
+        The BiGRU sees overlap_frames of context on each side of every chunk; the
+        context frames are dropped before decoding.
+        """
+        hop = 160
+        n_frames = audio.shape[0] // hop + 1
+        f0s = []
+        for start in range(0, n_frames, self.chunk_frames):
+            end = min(start + self.chunk_frames, n_frames)
+            ctx_start = max(0, start - self.overlap_frames)
+            ctx_end = min(n_frames, end + self.overlap_frames)
+            if ctx_end == n_frames:
+                x = audio[ctx_start * hop :]
+            else:  # center=True下正好出ctx_end-ctx_start帧
+                x = audio[ctx_start * hop : (ctx_end - 1) * hop + 1]
+            x = torch.from_numpy(np.ascontiguousarray(x)).float().to(self.device)
+            mel = self.mel_extractor(x.unsqueeze(0), center=True)
+            hidden = self.mel2hidden(mel)[0, start - ctx_start : end - ctx_start]
+            if decode_on_device:
+                f0 = self.decode_torch(hidden, thred=thred)
+            else:
+                hidden = hidden.cpu().numpy()
+                if self.is_half == True:
+                    hidden = hidden.astype("float32")
+                f0 = self.decode(hidden, thred=thred)
+            f0s.append(f0)
+            del x, mel, hidden
+        return np.concatenate(f0s)
+
     def to_local_average_cents(self, salience, thred=0.05):
         # t0 = ttime()
         center = np.argmax(salience, axis=1)  # 帧长#index
         salience = np.pad(salience, ((0, 0), (4, 4)))  # 帧长,368
         # t1 = ttime()
-        center += 4
-        todo_salience = []
-        todo_cents_mapping = []
-        starts = center - 4
-        ends = center + 5
-        for idx in range(salience.shape[0]):
-            todo_salience.append(salience[:, starts[idx] : ends[idx]][idx])
-            todo_cents_mapping.append(self.cents_mapping[starts[idx] : ends[idx]])
+        # pad后center+4-4就是窗口起点, 每帧取[center, center+9)
+        idx = center[:, None] + np.arange(9)[None, :]  # 帧长，9
+        todo_salience = np.take_along_axis(salience, idx, axis=1)  # 帧长，9
+        todo_cents_mapping = self.cents_mapping[idx]  # 帧长，9
         # t2 = ttime()
-        todo_salience = np.array(todo_salience)  # 帧长，9
-        todo_cents_mapping = np.array(todo_cents_mapping)  # 帧长，9
         product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
         weight_sum = np.sum(todo_salience, 1)  # 帧长
         devided = product_sum / weight_sum  # 帧长
@@ -410,6 +482,19 @@ class RMVPE:
         # print("decode:%s\t%s\t%s\t%s" % (t1 - t0, t2 - t1, t3 - t2, t4 - t3))
         return devided
 
+    def to_local_average_cents_torch(self, salience, thred=0.05):
+        center = torch.argmax(salience, dim=1)  # 帧长#index
+        salience = F.pad(salience, (4, 4))  # 帧长,368
+        idx = center.unsqueeze(1) + torch.arange(9, device=salience.device)  # 帧长，9
+        todo_salience = torch.gather(salience, 1, idx)
+        todo_cents_mapping = self.cents_mapping_torch.to(salience.device)[idx]
+        product_sum = torch.sum(todo_salience * todo_cents_mapping, 1)
+        weight_sum = torch.sum(todo_salience, 1)  # 帧长
+        devided = product_sum / weight_sum  # 帧长
+        maxx = torch.max(salience, dim=1).values  # 帧长
+        devided[maxx <= thred] = 0
+        return devided
+
 
 # if __name__ == '__main__':
 #     audio, sampling_rate = sf.read("卢本伟语录~1.wav")
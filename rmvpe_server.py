@@ -0,0 +1,159 @@
+import multiprocessing, threading, traceback
+from queue import Empty
+from time import sleep, time as ttime
+
+
+class RMVPEServer(multiprocessing.Process):
+    """
+    Owns the only RMVPE model for a run of extract_f0_print.
+    Clients put (client_id, key, audio) on inp_q and get (key, f0, err) back on
+    opt_qs[client_id]. Pending requests are sorted by length and run in batches
+    of up to batch_size utterances and max_batch_samples padded samples, with
+    no utterance padded by more than max_pad_ratio of the longest one (the
+    BiGRU and the reflect padding of the mel see the zeros, so the f0 near
+    the end of a padded clip drifts from the unbatched result).
+    If the model can't be loaded every request is answered with that error.
+    The server bumps a shared heartbeat every second, so clients (siblings,
+    which can't call is_alive() on it) notice when it died.
+    Put None on inp_q to stop the server.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        inp_q,
+        opt_qs,
+        device=None,
+        is_half=False,
+        batch_size=32,
+        max_batch_samples=16000 * 120,
+        max_pad_ratio=0.1,
+        max_wait=0.05,
+    ):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.model_path = model_path
+        self.inp_q = inp_q
+        self.opt_qs = opt_qs
+        self.device = device
+        self.is_half = is_half
+        self.batch_size = batch_size
+        self.max_batch_samples = max_batch_samples
+        self.max_pad_ratio = max_pad_ratio
+        self.max_wait = max_wait
+        # 进程还没起来时按创建时间算, 给启动和import torch留出时间
+        self.heartbeat = multiprocessing.Value("d", ttime(), lock=False)
+
+    def beat(self):
+        while 1:
+            self.heartbeat.value = ttime()
+            sleep(1)
+
+    def run(self):
+        threading.Thread(target=self.beat, daemon=True).start()
+        try:
+            import torch
+            from rmvpe import RMVPE
+
+            device = self.device
+            if device is None:
+                device = "cuda:0" if torch.cuda.is_available() else "cpu"
+            is_half = self.is_half and device.startswith("cuda")
+            print("rmvpe server: loading rmvpe model on %s" % device)
+            model = RMVPE(self.model_path, is_half=is_half, device=device)
+        except:
+            err = traceback.format_exc()
+            print("rmvpe server: failed to load %s\n%s" % (self.model_path, err))
+            self.reply_error(err)
+            return
+        stop = False
+        while not stop:
+            req = self.inp_q.get()
+            if req is None:
+                break
+            reqs = [req]
+            # 多等一小会儿, 攒够几个batch再按长度排序切分
+            deadline = ttime() + self.max_wait
+            while len(reqs) < self.batch_size * 4:
+                timeout = deadline - ttime()
+                if timeout <= 0:
+                    break
+                try:
+                    req = self.inp_q.get(timeout=timeout)
+                except Empty:
+                    break
+                if req is None:
+                    stop = True
+                    break
+                reqs.append(req)
+            reqs.sort(key=lambda req: req[2].shape[0])
+            for batch in self.split(reqs):
+                self.run_batch(model, batch)
+
+    def reply_error(self, err):
+        # 模型都没有, 每个请求都回同一个错误, worker照常记f0fail
+        while 1:
+            req = self.inp_q.get()
+            if req is None:
+                return
+            client_id, key, _ = req
+            self.opt_qs[client_id].put((key, None, err))
+
+    def split(self, reqs):
+        batch = []
+        for req in reqs:  # 已按长度升序, 最后一条就是最长的
+            if batch and (
+                len(batch) >= self.batch_size
+                or (len(batch) + 1) * req[2].shape[0] > self.max_batch_samples
+                or batch[0][2].shape[0] < req[2].shape[0] * (1 - self.max_pad_ratio)
+            ):
+                yield batch
+                batch = []
+            batch.append(req)
+        if batch:
+            yield batch
+
+    def run_batch(self, model, batch):
+        try:
+            f0s = model.infer_from_audio_batch([req[2] for req in batch], thred=0.03)
+        except:
+            err = traceback.format_exc()
+            for client_id, key, _ in batch:
+                self.opt_qs[client_id].put((key, None, err))
+            return
+        for (client_id, key, _), f0 in zip(batch, f0s):
+            self.opt_qs[client_id].put((key, f0, None))
+
+
+class RMVPEServerDied(RuntimeError):
+    pass
+
+
+class RMVPEClient(object):
+    def __init__(self, client_id, inp_q, opt_q, heartbeat, dead_after=60, poll=5):
+        self.client_id = client_id
+        self.inp_q = inp_q
+        self.opt_q = opt_q
+        self.heartbeat = heartbeat  # RMVPEServer.heartbeat
+        self.dead_after = dead_after
+        self.poll = poll
+
+    def server_alive(self):
+        return ttime() - self.heartbeat.value < self.dead_after
+
+    def submit(self, key, audio):
+        self.inp_q.put((self.client_id, key, audio))
+
+    def get(self):
+        """
+        (key, f0, err) of the next finished request, err is None on success.
+        Raises RMVPEServerDied once the server stopped beating.
+        """
+        while 1:
+            try:
+                return self.opt_q.get(timeout=self.poll)
+            except Empty:
+                if not self.server_alive():
+                    raise RMVPEServerDied(
+                        "rmvpe server stopped responding for %ss" % self.dead_after
+                    )
@@ -14,23 +14,19 @@ import scipy.signal as signal
 now_dir = os.getcwd()
 sys.path.append(now_dir)
 from config import Config
-from multiprocessing import Manager as M
+from index_cache import index_cache
+from f0_pool import harvest_parallel
 
-mm = M()
 config = Config()
 
 
 class RVC:
-    def __init__(
-        self, key, pth_path, index_path, index_rate, n_cpu, inp_q, opt_q, device
-    ) -> None:
+    def __init__(self, key, pth_path, index_path, index_rate, n_cpu, device) -> None:
         """
         初始化
         """
         try:
             global config
-            self.inp_q = inp_q
-            self.opt_q = opt_q
             self.device = device
             self.f0_up_key = key
             self.time_step = 160 / 16000 * 1000
@@ -42,8 +38,7 @@ class RVC:
             self.window = 160
             self.n_cpu = n_cpu
             if index_rate != 0:
-                self.index = faiss.read_index(index_path)
-                self.big_npy = self.index.reconstruct_n(0, self.index.ntotal)
+                self.index, self.big_npy = index_cache.get(index_path)
                 print("index search enabled")
             self.index_rate = index_rate
             models, _, _ = checkpoint_utils.load_model_ensemble_and_task(
@@ -131,48 +126,21 @@ class RVC:
 
             f0 *= pow(2, f0_up_key / 12)
             return self.get_f0_post(f0)
-        if n_cpu == 1:
-            f0, t = pyworld.harvest(
-                x.astype(np.double),
-                fs=16000,
-                f0_ceil=1100,
-                f0_floor=50,
-                frame_period=10,
-            )
-            f0 = signal.medfilt(f0, 3)
-            f0 *= pow(2, f0_up_key / 12)
-            return self.get_f0_post(f0)
-        f0bak = np.zeros(x.shape[0] // 160, dtype=np.float64)
-        length = len(x)
-        part_length = int(length / n_cpu / 160) * 160
-        ts = ttime()
-        res_f0 = mm.dict()
-        for idx in range(n_cpu):
-            tail = part_length * (idx + 1) + 320
-            if idx == 0:
-                self.inp_q.put((idx, x[:tail], res_f0, n_cpu, ts))
-            else:
-                self.inp_q.put(
-                    (idx, x[part_length * idx - 320 : tail], res_f0, n_cpu, ts)
-                )
-        while 1:
-            res_ts = self.opt_q.get()
-            if res_ts == ts:
-                break
-        f0s = [i[1] for i in sorted(res_f0.items(), key=lambda x: x[0])]
-        for idx, f0 in enumerate(f0s):
-            if idx == 0:
-                f0 = f0[:-3]
-            elif idx != n_cpu - 1:
-                f0 = f0[2:-3]
-            else:
-                f0 = f0[2:-1]
-            f0bak[
-                part_length * idx // 160 : part_length * idx // 160 + f0.shape[0]
-            ] = f0
-        f0bak = signal.medfilt(f0bak, 3)
-        f0bak *= pow(2, f0_up_key / 12)
-        return self.get_f0_post(f0bak)
+        # 和之前的Harvest进程一样: 每段两边带2帧重叠, 不做stonemask
+        f0 = harvest_parallel(
+            x,
+            16000,
+            1100,
+            50,
+            10,
+            n_parts=n_cpu,
+            overlap_frames=2,
+            min_part_frames=1,
+            refine=False,
+        )
+        f0 = signal.medfilt(f0, 3)
+        f0 *= pow(2, f0_up_key / 12)
+        return self.get_f0_post(f0)
 
     def get_f0_crepe(self, x, f0_up_key):
         audio = torch.tensor(np.copy(x))[None].float()
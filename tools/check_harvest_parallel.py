@@ -0,0 +1,34 @@
+"""
+对比单进程harvest和f0_pool.harvest_parallel的输出
+python tools/check_harvest_parallel.py xxx.wav [n_parts]
+"""
+import os, sys
+from time import time as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+import numpy as np
+from my_utils import load_audio
+from f0_pool import compute_harvest_f0, harvest_parallel
+
+if __name__ == "__main__":
+    audio = load_audio(sys.argv[1], 16000, False, 0.0, 0.0).astype(np.double)
+    n_parts = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    t0 = ttime()
+    f0_single = compute_harvest_f0(audio, 16000, 1100, 50, 10)
+    t1 = ttime()
+    f0_parallel = harvest_parallel(audio, 16000, 1100, 50, 10, n_parts=n_parts)
+    t2 = ttime()
+    assert f0_single.shape == f0_parallel.shape, (f0_single.shape, f0_parallel.shape)
+    voiced = (f0_single > 0) & (f0_parallel > 0)
+    cents = 1200 * np.abs(np.log2(f0_parallel[voiced] / f0_single[voiced]))
+    print("single: %.2fs, parallel: %.2fs" % (t1 - t0, t2 - t1))
+    print(
+        "voicing mismatch: %.4f%%, cents p50/p99/max: %.2f/%.2f/%.2f"
+        % (
+            100 * np.mean((f0_single > 0) != (f0_parallel > 0)),
+            np.percentile(cents, 50),
+            np.percentile(cents, 99),
+            cents.max(),
+        )
+    )
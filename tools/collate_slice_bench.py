@@ -0,0 +1,140 @@
+"""
+训练step里collate和随机切片的逐条循环版和向量化版对比
+python tools/collate_slice_bench.py [device] [n_iter]
+"""
+import os, sys
+from time import time as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append(os.path.join(now_dir, "train"))
+import torch
+from lib.infer_pack import commons
+from data_utils import TextAudioCollateMultiNSFsid
+
+
+def collate_loop(batch):
+    # 原来的逐行实现, 只用来对比
+    _, ids_sorted_decreasing = torch.sort(
+        torch.LongTensor([x[0].size(1) for x in batch]), dim=0, descending=True
+    )
+    max_spec_len = max([x[0].size(1) for x in batch])
+    max_wave_len = max([x[1].size(1) for x in batch])
+    max_phone_len = max([x[2].size(0) for x in batch])
+    spec_lengths = torch.LongTensor(len(batch))
+    wave_lengths = torch.LongTensor(len(batch))
+    phone_lengths = torch.LongTensor(len(batch))
+    spec_padded = torch.zeros(len(batch), batch[0][0].size(0), max_spec_len)
+    wave_padded = torch.zeros(len(batch), 1, max_wave_len)
+    phone_padded = torch.zeros(len(batch), max_phone_len, batch[0][2].shape[1])
+    pitch_padded = torch.zeros(len(batch), max_phone_len, dtype=torch.long)
+    pitchf_padded = torch.zeros(len(batch), max_phone_len)
+    sid = torch.LongTensor(len(batch))
+    for i in range(len(ids_sorted_decreasing)):
+        row = batch[ids_sorted_decreasing[i]]
+        spec_padded[i, :, : row[0].size(1)] = row[0]
+        spec_lengths[i] = row[0].size(1)
+        wave_padded[i, :, : row[1].size(1)] = row[1]
+        wave_lengths[i] = row[1].size(1)
+        phone_padded[i, : row[2].size(0), :] = row[2]
+        phone_lengths[i] = row[2].size(0)
+        pitch_padded[i, : row[3].size(0)] = row[3]
+        pitchf_padded[i, : row[4].size(0)] = row[4]
+        sid[i] = row[5]
+    return (
+        phone_padded,
+        phone_lengths,
+        pitch_padded,
+        pitchf_padded,
+        spec_padded,
+        spec_lengths,
+        wave_padded,
+        wave_lengths,
+        sid,
+    )
+
+
+def slice_segments_loop(x, ids_str, segment_size=4):
+    ret = torch.zeros_like(x[:, :, :segment_size])
+    for i in range(x.size(0)):
+        idx_str = ids_str[i]
+        ret[i] = x[i, :, idx_str : idx_str + segment_size]
+    return ret
+
+
+def make_batch(batch_size, hop_length=400):
+    batch = []
+    for _ in range(batch_size):
+        n = int(torch.randint(200, 900, (1,)))
+        batch.append(
+            (
+                torch.rand(1025, n),
+                torch.rand(1, n * hop_length),
+                torch.rand(n, 768),
+                torch.randint(1, 255, (n,)),
+                torch.rand(n),
+                torch.LongTensor([0]),
+            )
+        )
+    return batch
+
+
+def sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def timeit(fn, n_iter, device):
+    fn()
+    sync(device)
+    t0 = ttime()
+    for _ in range(n_iter):
+        out = fn()
+    sync(device)
+    return (ttime() - t0) / n_iter * 1000, out
+
+
+if __name__ == "__main__":
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    n_iter = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    hop_length = 400
+    segment_size = 12800 // hop_length
+    collate = TextAudioCollateMultiNSFsid()
+    for batch_size in [4, 8, 16, 32]:
+        batch = make_batch(batch_size, hop_length)
+        t_loop, ref = timeit(lambda: collate_loop(batch), n_iter, "cpu")
+        t_vec, out = timeit(lambda: collate(batch), n_iter, "cpu")
+        diff = max(
+            [float((a.float() - b.float()).abs().max()) for a, b in zip(ref, out)]
+        )
+        print(
+            "bs %2d collate: loop %.2fms, pad_sequence %.2fms (x%.1f), max diff %s"
+            % (batch_size, t_loop, t_vec, t_loop / t_vec, diff)
+        )
+
+        spec, spec_lengths = out[4].to(device), out[5].to(device)
+        wave = out[6].to(device)
+        ids_str = (
+            torch.rand(batch_size, device=device) * (spec_lengths - segment_size + 1)
+        ).long()
+        for name, x, ids, size in [
+            ("spec", spec, ids_str, segment_size),
+            ("wave", wave, ids_str * hop_length, segment_size * hop_length),
+        ]:
+            t_loop, ref = timeit(
+                lambda: slice_segments_loop(x, ids, size), n_iter, device
+            )
+            t_vec, out_slice = timeit(
+                lambda: commons.slice_segments(x, ids, size), n_iter, device
+            )
+            print(
+                "bs %2d slice %s: loop %.3fms, gather %.3fms (x%.1f), max diff %s"
+                % (
+                    batch_size,
+                    name,
+                    t_loop,
+                    t_vec,
+                    t_loop / t_vec,
+                    float((ref - out_slice).abs().max()),
+                )
+            )
@@ -0,0 +1,110 @@
+"""
+几种检索索引在本实验特征上的对比: 搜索耗时、内存占用、相对精确搜索的recall@8
+python tools/infer/index_bench.py exp_name v1/v2 [ivf_flat ivf_pq opq_ivf_pq hnsw]
+"""
+import os, sys, glob, shutil, tempfile
+from time import time as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+import numpy as np, faiss
+from index_builder import (
+    SEARCH_K,
+    build_index,
+    exact_knn,
+    feature_paths,
+    feature_shape,
+    recall_at_k,
+    reservoir_sample,
+)
+from index_cache import apply_search_params, read_index_meta
+
+CHUNK_ROWS = 65536
+
+
+def timed_search(index, queries):
+    index.search(queries[:100], SEARCH_K)  # 预热
+    t0 = ttime()
+    _, ids = index.search(queries, SEARCH_K)
+    return ttime() - t0, ids
+
+
+if __name__ == "__main__":
+    exp_name = sys.argv[1]
+    version = sys.argv[2]
+    families = sys.argv[3:] or ["ivf_flat", "ivf_pq", "opq_ivf_pq", "hnsw"]
+    feature_dir = "logs/%s/3_feature%s" % (exp_name, 256 if version == "v1" else 768)
+    paths = feature_paths(feature_dir)
+    n_rows, dim = feature_shape(paths)
+    # 和build_index调参用的查询(seed=0)错开
+    queries = reservoir_sample(paths, 2000, dim, CHUNK_ROWS, seed=1)
+    print("frames: %s, dim: %s, queries: %s" % (n_rows, dim, queries.shape[0]))
+
+    rows = []
+    out_root = tempfile.mkdtemp()
+    try:
+        for family in families:
+            out_dir = os.path.join(out_root, family)
+            os.makedirs(out_dir)
+            t0 = ttime()
+            for info in build_index(
+                feature_dir,
+                out_dir,
+                exp_name,
+                version,
+                n_cpu=os.cpu_count(),
+                family=family,
+            ):
+                print(info)
+            t_build = ttime() - t0
+            index_path = glob.glob(os.path.join(out_dir, "added_*.index"))[0]
+            index = faiss.read_index(index_path)
+            meta = read_index_meta(index_path)
+            apply_search_params(index, meta)
+
+            # 索引里存的向量(帧或kmeans中心)上的精确top-k作为标准答案
+            base = np.load(os.path.join(out_dir, "total_fea.npy"), mmap_mode="r")
+            chunks = [base[i : i + CHUNK_ROWS] for i in range(0, len(base), CHUNK_ROWS)]
+            gt_ids = exact_knn(queries, chunks)
+            if not rows:
+                flat = faiss.IndexFlatL2(dim)
+                for chunk in chunks:
+                    flat.add(np.ascontiguousarray(chunk, dtype=np.float32))
+                t_search, _ = timed_search(flat, queries)
+                rows.append(
+                    ("exact", "Flat", "-", 0, t_search, base.nbytes, 1.0, len(base))
+                )
+                del flat
+            t_search, ids = timed_search(index, queries)
+            rows.append(
+                (
+                    family,
+                    meta["factory"],
+                    meta["search_params"],
+                    t_build,
+                    t_search,
+                    faiss.serialize_index(index).nbytes,
+                    recall_at_k(ids, gt_ids),
+                    index.ntotal,
+                )
+            )
+            del base, index
+    finally:
+        shutil.rmtree(out_root, ignore_errors=True)
+
+    header = ["family", "factory", "params", "build s", "us/frame", "MB", "recall@8"]
+    print("%-11s %-28s %-13s %8s %10s %9s %9s %9s" % tuple(header + ["ntotal"]))
+    for family, factory, params, t_build, t_search, n_bytes, recall, ntotal in rows:
+        print(
+            "%-11s %-28s %-13s %8.1f %10.1f %9.1f %9.3f %9s"
+            % (
+                family,
+                factory,
+                params,
+                t_build,
+                1e6 * t_search / queries.shape[0],
+                n_bytes / 1024**2,
+                recall,
+                ntotal,
+            )
+        )
@@ -0,0 +1,53 @@
+"""
+对比RMVPE一次性推理和分段推理的f0, 以及两者的显存峰值
+python tools/rmvpe_chunk_check.py xxx.wav [chunk_frames] [overlap_frames]
+"""
+import os, sys
+from time import time as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+import numpy as np, torch
+from my_utils import load_audio
+from rmvpe import RMVPE
+
+
+def run(rmvpe, audio, chunked):
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    t0 = ttime()
+    if chunked:
+        f0 = rmvpe.infer_from_audio_chunked(audio, thred=0.03)
+    else:
+        f0 = rmvpe.infer_from_audio(audio, thred=0.03)
+    t1 = ttime()
+    peak = torch.cuda.max_memory_allocated() / 1024**2 if torch.cuda.is_available() else 0
+    return f0, t1 - t0, peak
+
+
+if __name__ == "__main__":
+    audio = load_audio(sys.argv[1], 16000, False, 0.0, 0.0)
+    chunk_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 32 * 250
+    overlap_frames = int(sys.argv[3]) if len(sys.argv) > 3 else 32 * 16
+    rmvpe = RMVPE(
+        "rmvpe.pt",
+        is_half=False,
+        chunk_frames=chunk_frames,
+        overlap_frames=overlap_frames,
+    )
+    f0_chunked, t_chunked, peak_chunked = run(rmvpe, audio, True)
+    rmvpe.chunk_frames = 0
+    f0_full, t_full, peak_full = run(rmvpe, audio, False)
+    assert f0_full.shape == f0_chunked.shape, (f0_full.shape, f0_chunked.shape)
+    voiced = (f0_full > 0) & (f0_chunked > 0)
+    cents = 1200 * np.abs(np.log2(f0_chunked[voiced] / f0_full[voiced]))
+    print("one-shot: %.2fs %.0fMB" % (t_full, peak_full))
+    print("chunked: %.2fs %.0fMB" % (t_chunked, peak_chunked))
+    print(
+        "voicing mismatch: %.4f%%, cents p99/max: %.3f/%.3f"
+        % (
+            100 * np.mean((f0_full > 0) != (f0_chunked > 0)),
+            np.percentile(cents, 99),
+            cents.max(),
+        )
+    )
@@ -0,0 +1,71 @@
+"""
+RMVPE解码(to_local_average_cents)的逐帧循环版和向量化版对比
+python tools/rmvpe_decode_bench.py [minutes] [device]
+"""
+import os, sys
+from time import time as ttime
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+import numpy as np, torch
+from rmvpe import RMVPE
+
+
+def to_local_average_cents_loop(cents_mapping, salience, thred=0.05):
+    # 原来的逐帧实现, 只用来对比
+    center = np.argmax(salience, axis=1)
+    salience = np.pad(salience, ((0, 0), (4, 4)))
+    center += 4
+    todo_salience = []
+    todo_cents_mapping = []
+    starts = center - 4
+    ends = center + 5
+    for idx in range(salience.shape[0]):
+        todo_salience.append(salience[:, starts[idx] : ends[idx]][idx])
+        todo_cents_mapping.append(cents_mapping[starts[idx] : ends[idx]])
+    todo_salience = np.array(todo_salience)
+    todo_cents_mapping = np.array(todo_cents_mapping)
+    product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
+    weight_sum = np.sum(todo_salience, 1)
+    devided = product_sum / weight_sum
+    maxx = np.max(salience, axis=1)
+    devided[maxx <= thred] = 0
+    return devided
+
+
+def sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+if __name__ == "__main__":
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    # 只测解码, 不加载模型权重
+    rmvpe = RMVPE.__new__(RMVPE)
+    cents_mapping = 20 * np.arange(360) + 1997.3794084376191
+    rmvpe.cents_mapping = np.pad(cents_mapping, (4, 4))
+    rmvpe.cents_mapping_torch = torch.from_numpy(rmvpe.cents_mapping).float().to(device)
+
+    n_frames = int(minutes * 60 * 100)
+    salience = np.random.rand(n_frames, 360).astype("float32") ** 8
+    salience_torch = torch.from_numpy(salience).to(device)
+
+    t0 = ttime()
+    ref = to_local_average_cents_loop(rmvpe.cents_mapping, salience, thred=0.03)
+    t1 = ttime()
+    out = rmvpe.to_local_average_cents(salience, thred=0.03)
+    t2 = ttime()
+    sync(device)
+    t3 = ttime()
+    out_torch = rmvpe.to_local_average_cents_torch(salience_torch, thred=0.03)
+    sync(device)
+    t4 = ttime()
+    out_torch = out_torch.cpu().numpy()
+
+    print("frames: %s" % n_frames)
+    print("loop: %.3fs" % (t1 - t0))
+    print("numpy: %.3fs (x%.1f)" % (t2 - t1, (t1 - t0) / (t2 - t1)))
+    print("torch-%s: %.3fs (x%.1f)" % (device, t4 - t3, (t1 - t0) / (t4 - t3)))
+    print("max abs diff numpy: %s" % np.abs(out - ref).max())
+    print("max abs diff torch: %s" % np.abs(out_torch - ref).max())
@@ -1,12 +1,49 @@
-import os, traceback
+import os, traceback, json, hashlib
 import numpy as np
 import torch
 import torch.utils.data
+from torch.nn.utils.rnn import pad_sequence
+import soundfile as sf
 
 from mel_processing import spectrogram_torch
 from utils import load_wav_to_torch, load_filepaths_and_text
 
 
+def load_spec_lengths(audiopaths, hop_length, index_path, max_len=900):
+    """
+    Spectrogram frame count of every wav, capped at max_len like get_labels.
+    Read from the wav header; cached in index_path keyed by (size, mtime).
+    """
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index["hop_length"] != hop_length:
+            raise ValueError("hop_length changed")
+    except:
+        index = {"hop_length": hop_length, "files": {}}
+    files = index["files"]
+    lengths = []
+    changed = False
+    for audiopath in audiopaths:
+        stat = os.stat(audiopath)
+        entry = files.get(audiopath)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            # center=False的spectrogram_torch正好出n_samples // hop_length帧
+            n_frames = sf.info(audiopath).frames // hop_length
+            entry = files[audiopath] = [stat.st_size, stat.st_mtime_ns, n_frames]
+            changed = True
+        lengths.append(min(entry[2], max_len))
+    if changed:
+        tmp_path = "%s.%s.tmp" % (index_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        except:
+            traceback.print_exc()
+    return lengths
+
+
 class TextAudioLoaderMultiNSFsid(torch.utils.data.Dataset):
     """
     1) loads audio, text pairs
@@ -15,6 +52,7 @@ class TextAudioLoaderMultiNSFsid(torch.utils.data.Dataset):
     """
 
     def __init__(self, audiopaths_and_text, hparams):
+        self.filelist = audiopaths_and_text
         self.audiopaths_and_text = load_filepaths_and_text(audiopaths_and_text)
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
@@ -31,16 +69,17 @@ class TextAudioLoaderMultiNSFsid(torch.utils.data.Dataset):
         Filter text & store spec lengths
         """
         # Store spectrogram lengths for Bucketing
-        # wav_length ~= file_size / (wav_channels * Bytes per dim) = file_size / (1 * 2)
-        # spec_length = wav_length // hop_length
+        # 0_gt_wavs是float32的wav, 按文件大小估的长度偏差很大, 改成读wav头, 缓存在filelist旁边
         audiopaths_and_text_new = []
-        lengths = []
         for audiopath, text, pitch, pitchf, dv in self.audiopaths_and_text:
             if self.min_text_len <= len(text) and len(text) <= self.max_text_len:
                 audiopaths_and_text_new.append([audiopath, text, pitch, pitchf, dv])
-                lengths.append(os.path.getsize(audiopath) // (3 * self.hop_length))
         self.audiopaths_and_text = audiopaths_and_text_new
-        self.lengths = lengths
+        self.lengths = load_spec_lengths(
+            [i[0] for i in self.audiopaths_and_text],
+            self.hop_length,
+            os.path.join(os.path.dirname(self.filelist), "lengths.json"),
+        )
 
     def get_sid(self, sid):
         sid = torch.LongTensor([int(sid)])
@@ -103,6 +142,12 @@ class TextAudioLoaderMultiNSFsid(torch.utils.data.Dataset):
         #        audio_norm = audio / np.abs(audio).max()
 
         audio_norm = audio_norm.unsqueeze(0)
+        npy_filename = filename.replace(".wav", ".spec.npy")
+        if os.path.exists(npy_filename):  # extract_spec_print预先算好的
+            try:
+                return torch.from_numpy(np.load(npy_filename)), audio_norm
+            except:
+                print(npy_filename, traceback.format_exc())
         spec_filename = filename.replace(".wav", ".spec.pt")
         if os.path.exists(spec_filename):
             try:
@@ -155,51 +200,24 @@ class TextAudioCollateMultiNSFsid:
         _, ids_sorted_decreasing = torch.sort(
             torch.LongTensor([x[0].size(1) for x in batch]), dim=0, descending=True
         )
-
-        max_spec_len = max([x[0].size(1) for x in batch])
-        max_wave_len = max([x[1].size(1) for x in batch])
-        spec_lengths = torch.LongTensor(len(batch))
-        wave_lengths = torch.LongTensor(len(batch))
-        spec_padded = torch.FloatTensor(len(batch), batch[0][0].size(0), max_spec_len)
-        wave_padded = torch.FloatTensor(len(batch), 1, max_wave_len)
-        spec_padded.zero_()
-        wave_padded.zero_()
-
-        max_phone_len = max([x[2].size(0) for x in batch])
-        phone_lengths = torch.LongTensor(len(batch))
-        phone_padded = torch.FloatTensor(
-            len(batch), max_phone_len, batch[0][2].shape[1]
-        )  # (spec, wav, phone, pitch)
-        pitch_padded = torch.LongTensor(len(batch), max_phone_len)
-        pitchf_padded = torch.FloatTensor(len(batch), max_phone_len)
-        phone_padded.zero_()
-        pitch_padded.zero_()
-        pitchf_padded.zero_()
+        batch = [batch[i] for i in ids_sorted_decreasing]
+
+        # pad_sequence一次拼好整个batch, 不再逐行往预先分配的张量里拷
+        spec_lengths = torch.LongTensor([x[0].size(1) for x in batch])
+        wave_lengths = torch.LongTensor([x[1].size(1) for x in batch])
+        phone_lengths = torch.LongTensor([x[2].size(0) for x in batch])
+        spec_padded = (
+            pad_sequence([x[0].transpose(0, 1) for x in batch], batch_first=True)
+            .transpose(1, 2)
+            .contiguous()
+        )
+        wave_padded = pad_sequence([x[1][0] for x in batch], batch_first=True)
+        wave_padded = wave_padded.unsqueeze(1)
+        phone_padded = pad_sequence([x[2] for x in batch], batch_first=True)
+        pitch_padded = pad_sequence([x[3] for x in batch], batch_first=True)
+        pitchf_padded = pad_sequence([x[4] for x in batch], batch_first=True)
         # dv = torch.FloatTensor(len(batch), 256)#gin=256
-        sid = torch.LongTensor(len(batch))
-
-        for i in range(len(ids_sorted_decreasing)):
-            row = batch[ids_sorted_decreasing[i]]
-
-            spec = row[0]
-            spec_padded[i, :, : spec.size(1)] = spec
-            spec_lengths[i] = spec.size(1)
-
-            wave = row[1]
-            wave_padded[i, :, : wave.size(1)] = wave
-            wave_lengths[i] = wave.size(1)
-
-            phone = row[2]
-            phone_padded[i, : phone.size(0), :] = phone
-            phone_lengths[i] = phone.size(0)
-
-            pitch = row[3]
-            pitch_padded[i, : pitch.size(0)] = pitch
-            pitchf = row[4]
-            pitchf_padded[i, : pitchf.size(0)] = pitchf
-
-            # dv[i] = row[5]
-            sid[i] = row[5]
+        sid = torch.cat([x[5] for x in batch])
 
         return (
             phone_padded,
@@ -223,6 +241,7 @@ class TextAudioLoader(torch.utils.data.Dataset):
     """
 
     def __init__(self, audiopaths_and_text, hparams):
+        self.filelist = audiopaths_and_text
         self.audiopaths_and_text = load_filepaths_and_text(audiopaths_and_text)
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
@@ -239,16 +258,16 @@ class TextAudioLoader(torch.utils.data.Dataset):
         Filter text & store spec lengths
         """
         # Store spectrogram lengths for Bucketing
-        # wav_length ~= file_size / (wav_channels * Bytes per dim) = file_size / (1 * 2)
-        # spec_length = wav_length // hop_length
         audiopaths_and_text_new = []
-        lengths = []
         for audiopath, text, dv in self.audiopaths_and_text:
             if self.min_text_len <= len(text) and len(text) <= self.max_text_len:
                 audiopaths_and_text_new.append([audiopath, text, dv])
-                lengths.append(os.path.getsize(audiopath) // (3 * self.hop_length))
         self.audiopaths_and_text = audiopaths_and_text_new
-        self.lengths = lengths
+        self.lengths = load_spec_lengths(
+            [i[0] for i in self.audiopaths_and_text],
+            self.hop_length,
+            os.path.join(os.path.dirname(self.filelist), "lengths.json"),
+        )
 
     def get_sid(self, sid):
         sid = torch.LongTensor([int(sid)])
@@ -295,6 +314,12 @@ class TextAudioLoader(torch.utils.data.Dataset):
         #        audio_norm = audio / np.abs(audio).max()
 
         audio_norm = audio_norm.unsqueeze(0)
+        npy_filename = filename.replace(".wav", ".spec.npy")
+        if os.path.exists(npy_filename):  # extract_spec_print预先算好的
+            try:
+                return torch.from_numpy(np.load(npy_filename)), audio_norm
+            except:
+                print(npy_filename, traceback.format_exc())
         spec_filename = filename.replace(".wav", ".spec.pt")
         if os.path.exists(spec_filename):
             try:
@@ -347,40 +372,20 @@ class TextAudioCollate:
         _, ids_sorted_decreasing = torch.sort(
             torch.LongTensor([x[0].size(1) for x in batch]), dim=0, descending=True
         )
-
-        max_spec_len = max([x[0].size(1) for x in batch])
-        max_wave_len = max([x[1].size(1) for x in batch])
-        spec_lengths = torch.LongTensor(len(batch))
-        wave_lengths = torch.LongTensor(len(batch))
-        spec_padded = torch.FloatTensor(len(batch), batch[0][0].size(0), max_spec_len)
-        wave_padded = torch.FloatTensor(len(batch), 1, max_wave_len)
-        spec_padded.zero_()
-        wave_padded.zero_()
-
-        max_phone_len = max([x[2].size(0) for x in batch])
-        phone_lengths = torch.LongTensor(len(batch))
-        phone_padded = torch.FloatTensor(
-            len(batch), max_phone_len, batch[0][2].shape[1]
+        batch = [batch[i] for i in ids_sorted_decreasing]
+
+        spec_lengths = torch.LongTensor([x[0].size(1) for x in batch])
+        wave_lengths = torch.LongTensor([x[1].size(1) for x in batch])
+        phone_lengths = torch.LongTensor([x[2].size(0) for x in batch])
+        spec_padded = (
+            pad_sequence([x[0].transpose(0, 1) for x in batch], batch_first=True)
+            .transpose(1, 2)
+            .contiguous()
         )
-        phone_padded.zero_()
-        sid = torch.LongTensor(len(batch))
-
-        for i in range(len(ids_sorted_decreasing)):
-            row = batch[ids_sorted_decreasing[i]]
-
-            spec = row[0]
-            spec_padded[i, :, : spec.size(1)] = spec
-            spec_lengths[i] = spec.size(1)
-
-            wave = row[1]
-            wave_padded[i, :, : wave.size(1)] = wave
-            wave_lengths[i] = wave.size(1)
-
-            phone = row[2]
-            phone_padded[i, : phone.size(0), :] = phone
-            phone_lengths[i] = phone.size(0)
-
-            sid[i] = row[3]
+        wave_padded = pad_sequence([x[1][0] for x in batch], batch_first=True)
+        wave_padded = wave_padded.unsqueeze(1)
+        phone_padded = pad_sequence([x[2] for x in batch], batch_first=True)
+        sid = torch.cat([x[3] for x in batch])
 
         return (
             phone_padded,
@@ -393,6 +398,139 @@ class TextAudioCollate:
         )
 
 
+def filelist_digest(filelist):
+    # 按行排序后再hash, infer-web每次重新shuffle filelist.txt也能对上;
+    # 每个源文件的大小和mtime也算进去, 重新提f0/特征时filelist不变也能发现
+    with open(filelist, encoding="utf-8") as f:
+        lines = sorted(line.strip() for line in f if line.strip())
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(line.encode("utf-8"))
+        for path in line.split("|")[:-1]:  # 最后一列是speaker id
+            try:
+                st = os.stat(path)
+                digest.update(("|%s|%s" % (st.st_size, st.st_mtime_ns)).encode())
+            except OSError:
+                digest.update(b"|missing")
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def get_packed_dir(filelist, if_f0):
+    """
+    The packed dir next to filelist.txt, or None if it is missing or was
+    written from a different filelist.
+    """
+    packed_dir = os.path.join(os.path.dirname(filelist), "packed")
+    try:
+        with open(os.path.join(packed_dir, "meta.json")) as f:
+            meta = json.load(f)
+    except:
+        return None
+    if meta["filelist"] != filelist_digest(filelist):
+        print("packed dataset is stale, reading per-utterance files")
+        return None
+    if if_f0 == 1 and "pitch" not in meta["fields"]:
+        return None
+    return packed_dir
+
+
+class PackedShards(object):
+    """
+    Reader for the packed layout written by pack_trainset_print.py:
+    meta.json, and for every field a <field>.bin holding all samples back to
+    back as rows of a fixed trailing shape, plus <field>.idx.npy with the N+1
+    row offsets. The memmaps are opened lazily in each DataLoader worker.
+    """
+
+    def __init__(self, packed_dir):
+        self.packed_dir = packed_dir
+        with open(os.path.join(packed_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.offsets = {
+            name: np.load(os.path.join(packed_dir, "%s.idx.npy" % name))
+            for name in self.meta["fields"]
+        }
+        self.data = {}
+        self.pid = None
+
+    def _open(self):
+        self.data = {}
+        for name, info in self.meta["fields"].items():
+            self.data[name] = np.memmap(
+                os.path.join(self.packed_dir, "%s.bin" % name),
+                dtype=info["dtype"],
+                mode="r",
+                shape=tuple([int(self.offsets[name][-1])] + info["shape"]),
+            )
+        self.pid = os.getpid()
+
+    def get(self, name, i):
+        if self.pid != os.getpid():
+            self._open()
+        offsets = self.offsets[name]
+        return self.data[name][offsets[i] : offsets[i + 1]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = {}
+        state["pid"] = None
+        return state
+
+
+class PackedTextAudioLoaderMultiNSFsid(TextAudioLoaderMultiNSFsid):
+    """
+    Same samples as TextAudioLoaderMultiNSFsid, read from a packed dir.
+    Entries are [i, i, i, i, sid], so the inherited get_audio_text_pair hands
+    the sample index to get_labels/get_audio.
+    """
+
+    def __init__(self, packed_dir, hparams):
+        self.shards = PackedShards(packed_dir)
+        self.hop_length = hparams.hop_length
+        self.audiopaths_and_text = [
+            [i, i, i, i, sid] for i, sid in enumerate(self.shards.meta["sids"])
+        ]
+        self.lengths = self.shards.meta["lengths"]
+
+    def get_labels(self, phone, pitch, pitchf):
+        phone = np.repeat(self.shards.get("phone", phone), 2, axis=0)
+        pitch = self.shards.get("pitch", pitch)
+        pitchf = self.shards.get("pitchf", pitchf)
+        n_num = min(phone.shape[0], 900)  # DistributedBucketSampler
+        phone = torch.from_numpy(phone[:n_num, :])
+        pitch = torch.from_numpy(np.array(pitch[:n_num], dtype=np.int64))
+        pitchf = torch.from_numpy(np.array(pitchf[:n_num], dtype=np.float32))
+        return phone, pitch, pitchf
+
+    def get_audio(self, i):
+        audio_norm = torch.from_numpy(np.array(self.shards.get("wav", i))).unsqueeze(0)
+        spec = torch.from_numpy(np.array(self.shards.get("spec", i).T))
+        return spec, audio_norm
+
+
+class PackedTextAudioLoader(TextAudioLoader):
+    """Same samples as TextAudioLoader, read from a packed dir"""
+
+    def __init__(self, packed_dir, hparams):
+        self.shards = PackedShards(packed_dir)
+        self.hop_length = hparams.hop_length
+        self.audiopaths_and_text = [
+            [i, i, sid] for i, sid in enumerate(self.shards.meta["sids"])
+        ]
+        self.lengths = self.shards.meta["lengths"]
+
+    def get_labels(self, phone):
+        phone = np.repeat(self.shards.get("phone", phone), 2, axis=0)
+        n_num = min(phone.shape[0], 900)  # DistributedBucketSampler
+        return torch.from_numpy(phone[:n_num, :])
+
+    def get_audio(self, i):
+        audio_norm = torch.from_numpy(np.array(self.shards.get("wav", i))).unsqueeze(0)
+        spec = torch.from_numpy(np.array(self.shards.get("spec", i).T))
+        return spec, audio_norm
+
+
 class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
     """
     Maintain similar input lengths in a batch.
@@ -401,6 +539,7 @@ class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
 
     It removes samples which are not included in the boundaries.
     Ex) boundaries = [b1, b2, b3] -> any x s.t. length(x) <= b1 or length(x) > b3 are discarded.
+    boundaries=None derives them from the length histogram of the dataset.
     """
 
     def __init__(
@@ -415,12 +554,33 @@ class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
         super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
         self.lengths = dataset.lengths
         self.batch_size = batch_size
+        if boundaries is None:
+            boundaries = self.boundaries_from_lengths(
+                self.lengths, self.num_replicas * batch_size
+            )
         self.boundaries = boundaries
+        self.padding_waste = None
 
         self.buckets, self.num_samples_per_bucket = self._create_buckets()
         self.total_size = sum(self.num_samples_per_bucket)
         self.num_samples = self.total_size // self.num_replicas
 
+    @staticmethod
+    def boundaries_from_lengths(lengths, total_batch_size, max_buckets=8):
+        """
+        Equal-count buckets from the length quantiles, every bucket holding at
+        least a few global batches. Nothing is dropped: the first boundary is
+        just below the shortest sample.
+        """
+        lengths = np.array(lengths)
+        n_buckets = max(1, min(max_buckets, len(lengths) // (4 * total_batch_size)))
+        edges = np.quantile(lengths, np.linspace(0, 1, n_buckets + 1))
+        edges = np.unique(np.ceil(edges).astype(np.int64))
+        boundaries = [int(lengths.min()) - 1] + [int(i) for i in edges[1:]]
+        if len(boundaries) == 1:  # 所有样本一样长
+            boundaries.append(int(lengths.max()))
+        return boundaries
+
     def _create_buckets(self):
         buckets = [[] for _ in range(len(self.boundaries) - 1)]
         for i in range(len(self.lengths)):
@@ -490,6 +650,13 @@ class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
             batches = [batches[i] for i in batch_ids]
         self.batches = batches
 
+        # 这一轮pad出来的帧占比, 训练日志里打印
+        n_real = sum(self.lengths[i] for batch in batches for i in batch)
+        n_padded = sum(
+            max(self.lengths[i] for i in batch) * len(batch) for batch in batches
+        )
+        self.padding_waste = 1 - n_real / max(1, n_padded)
+
         assert len(self.batches) * self.batch_size == self.num_samples
         return iter(self.batches)
 
@@ -510,3 +677,108 @@ class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
 
     def __len__(self):
         return self.num_samples // self.batch_size
+
+
+class BatchList(object):
+    """batch_sampler over a list of index batches that is refilled every epoch"""
+
+    def __init__(self):
+        self.batches = []
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class TieredSampleCache(object):
+    """
+    Drop-in for the training DataLoader that keeps per-sample tensors around
+    between epochs: on the GPU until gpu_bytes is used up, then in (pinned)
+    host memory until host_bytes is used up. Samples that fit in neither are
+    read through a DataLoader every epoch. Batches are collated from the cached
+    samples on the fly, so the batch sampler still reshuffles the buckets every
+    epoch. Batches come out on device when it is a cuda device.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_sampler,
+        collate_fn,
+        device,
+        gpu_bytes=0,
+        host_bytes=0,
+        num_workers=4,
+    ):
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+        self.device = torch.device(device)
+        self.on_gpu = self.device.type == "cuda"
+        self.budget = {"gpu": gpu_bytes if self.on_gpu else 0, "host": host_bytes}
+        self.used = {"gpu": 0, "host": 0}
+        self.count = {"gpu": 0, "host": 0}
+        self.samples = {}
+        self.n_loaded = 0  # 上一轮从DataLoader读的样本数
+        self.missing = BatchList()
+        self.loader = torch.utils.data.DataLoader(
+            dataset,
+            num_workers=num_workers,
+            collate_fn=list,
+            batch_sampler=self.missing,
+            persistent_workers=True,
+            prefetch_factor=8,
+        )
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def _store(self, index, sample):
+        if index in self.samples:  # 同一个batch里补齐用的重复样本
+            return self.samples[index]
+        n_bytes = sum(t.numel() * t.element_size() for t in sample)
+        for tier in ["gpu", "host"]:
+            if self.used[tier] + n_bytes > self.budget[tier]:
+                continue
+            if tier == "gpu":
+                sample = tuple(t.to(self.device) for t in sample)
+            elif self.on_gpu:
+                sample = tuple(t.pin_memory() for t in sample)
+            else:
+                # worker传过来的可能是整段storage的切片, 拷一份只留需要的部分
+                sample = tuple(t.clone() for t in sample)
+            self.samples[index] = sample
+            self.used[tier] += n_bytes
+            self.count[tier] += 1
+            return sample
+        return sample
+
+    def __iter__(self):
+        batches = list(self.batch_sampler)
+        # 开轮前定好每个batch缺哪些样本, 和DataLoader预取的顺序一一对应
+        todo = [[i for i in batch if i not in self.samples] for batch in batches]
+        self.missing.batches = [missing for missing in todo if missing]
+        self.n_loaded = sum(len(missing) for missing in self.missing.batches)
+        loaded = iter(self.loader) if self.missing.batches else None
+        for batch, missing in zip(batches, todo):
+            fresh = {}
+            if missing:
+                for i, sample in zip(missing, next(loaded)):
+                    fresh[i] = self._store(i, sample)
+            samples = [self.samples.get(i, fresh.get(i)) for i in batch]
+            if self.on_gpu:
+                samples = [
+                    tuple(t.to(self.device, non_blocking=True) for t in sample)
+                    for sample in samples
+                ]
+            yield self.collate_fn(samples)
+
+    def summary(self):
+        return "cache: gpu %s samples %.0fMB, host %s samples %.0fMB, loader %s" % (
+            self.count["gpu"],
+            self.used["gpu"] / 1024**2,
+            self.count["host"],
+            self.used["host"] / 1024**2,
+            self.n_loaded,
+        )
@@ -40,7 +40,10 @@ def savee(ckpt, sr, if_f0, name, epoch, version, hps):
         opt["sr"] = sr
         opt["f0"] = if_f0
         opt["version"] = version
-        torch.save(opt, "weights/%s.pth" % name)
+        # 写完再改名, 写到一半中断不会留下损坏的小模型
+        tmp_path = "weights/%s.pth.%s.tmp" % (name, os.getpid())
+        torch.save(opt, tmp_path)
+        os.replace(tmp_path, "weights/%s.pth" % name)
         return "Success."
     except:
         return traceback.format_exc()
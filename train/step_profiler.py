@@ -0,0 +1,113 @@
+import json
+from time import perf_counter
+import torch
+
+
+class StepProfiler(object):
+    """
+    Wall-clock breakdown of the training step. mark(name) closes the phase
+    that started at the previous mark, the first phase of a step starts where
+    the previous step ended (so "data" is the time spent waiting for the batch).
+    CUDA kernels run asynchronously: without sync their time shows up in the
+    phase that waits for them, with sync=True every mark synchronizes first.
+    Steps [trace_start, trace_start + trace_steps) are always synchronized and
+    dumped as a Chrome trace (chrome://tracing, ui.perfetto.dev) to trace_path.
+    report() only covers steps closed by end(), so it can be called in the
+    middle of a step; that step goes into the next report.
+    """
+
+    def __init__(
+        self, device, sync=False, trace_path=None, trace_start=0, trace_steps=0, pid=0
+    ):
+        self.cuda = torch.device(device).type == "cuda"
+        self.sync = sync
+        self.trace_path = trace_path
+        self.trace_start = trace_start
+        self.trace_end = trace_start + trace_steps if trace_path else -1
+        self.pid = pid
+        self.trace_events = []
+        self.step = -1
+        self.last = perf_counter()
+        self.current = {}  # 还没end()的这一步
+        self.reset()
+
+    def reset(self):
+        self.phases = {}  # 按第一次出现的顺序, 日志里就是step内的顺序
+        self.n_steps = 0
+        self.n_samples = 0
+        self.audio_seconds = 0.0
+
+    def tracing(self):
+        return self.trace_start <= self.step < self.trace_end
+
+    def begin_epoch(self):
+        # 两轮之间存checkpoint等的时间不算进第一步的data
+        self.last = perf_counter()
+
+    def start(self, step):
+        """call at the top of the step, before its first mark"""
+        self.step = step
+
+    def mark(self, name):
+        if self.cuda and (self.sync or self.tracing()):
+            torch.cuda.synchronize()
+        now = perf_counter()
+        self.current[name] = self.current.get(name, 0.0) + now - self.last
+        if self.tracing():
+            self.trace_events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": self.last * 1e6,
+                    "dur": (now - self.last) * 1e6,
+                    "pid": self.pid,
+                    "tid": 0,
+                    "args": {"step": self.step},
+                }
+            )
+        self.last = now
+
+    def end(self, n_samples, audio_seconds):
+        for name, seconds in self.current.items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self.current = {}
+        self.n_steps += 1
+        self.n_samples += n_samples
+        self.audio_seconds += audio_seconds
+        if self.step == self.trace_end - 1:
+            self.dump_trace()
+
+    def dump_trace(self):
+        try:
+            with open(self.trace_path, "w") as f:
+                json.dump({"traceEvents": self.trace_events}, f)
+        except OSError:
+            pass
+        self.trace_events = []
+
+    def report(self):
+        """averages since the last report as (log line, tensorboard scalars)"""
+        if self.n_steps == 0:
+            return None, {}
+        total = sum(self.phases.values())
+        scalars = {
+            "time/%s" % name: seconds / self.n_steps
+            for name, seconds in self.phases.items()
+        }
+        scalars["time/step"] = total / self.n_steps
+        scalars["perf/steps_per_sec"] = self.n_steps / max(total, 1e-9)
+        scalars["perf/samples_per_sec"] = self.n_samples / max(total, 1e-9)
+        scalars["perf/audio_sec_per_sec"] = self.audio_seconds / max(total, 1e-9)
+        line = "step %.3fs: %s | %.2f steps/s, %.1f samples/s, %.1f audio s/s" % (
+            total / self.n_steps,
+            ", ".join(
+                "%s %.3f (%.0f%%)"
+                % (name, seconds / self.n_steps, 100 * seconds / max(total, 1e-9))
+                for name, seconds in self.phases.items()
+            ),
+            scalars["perf/steps_per_sec"],
+            scalars["perf/samples_per_sec"],
+            scalars["perf/audio_sec_per_sec"],
+        )
+        self.reset()
+        return line, scalars
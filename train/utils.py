@@ -1,5 +1,6 @@
 import os, traceback
 import glob
+import queue, threading
 import sys
 import argparse
 import logging
@@ -181,6 +182,110 @@ def save_checkpoint_d(combd, sbd, optimizer, learning_rate, iteration, checkpoin
     )
 
 
+def snapshot_state(obj):
+    """copy a (nested) state_dict to cpu, training can keep updating the originals"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_state(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    # 先写临时文件再改名, 写到一半崩了也不会留下损坏的pth
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread. The calling thread only takes a
+    cpu snapshot of the state_dicts, serialization and disk I/O happen on the
+    writer thread, which writes to a temp file and renames it into place.
+    keep_last > 0 keeps only the newest keep_last G_/D_ checkpoints written by
+    this writer, except those of every keep_every-th epoch.
+    Call close() before the process exits, it waits for the pending writes.
+    """
+
+    def __init__(self, keep_last=0, keep_every=0, log=None):
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.log = log or logger.info
+        self.written = {}  # checkpoint_path前缀(G_/D_) -> 可清理的文件
+        # 最多攒两份快照, 写盘跟不上时submit会等
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while 1:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except:
+                self.log(traceback.format_exc())
+            self.queue.task_done()
+
+    def submit(self, fn, *args):
+        """run fn(*args) on the writer thread, args must already be snapshots"""
+        self.queue.put((fn, args))
+
+    def save_checkpoint(
+        self, model, optimizer, learning_rate, iteration, checkpoint_path
+    ):
+        if hasattr(model, "module"):
+            state_dict = model.module.state_dict()
+        else:
+            state_dict = model.state_dict()
+        checkpoint = snapshot_state(
+            {
+                "model": state_dict,
+                "iteration": iteration,
+                "optimizer": optimizer.state_dict(),
+                "learning_rate": learning_rate,
+            }
+        )
+        self.submit(self._write, checkpoint, iteration, checkpoint_path)
+
+    def _write(self, checkpoint, iteration, checkpoint_path):
+        atomic_save(checkpoint, checkpoint_path)
+        self.log(
+            "Saved model and optimizer state at epoch {} to {}".format(
+                iteration, checkpoint_path
+            )
+        )
+        if self.keep_last <= 0:
+            return
+        if self.keep_every > 0 and iteration % self.keep_every == 0:
+            return
+        name = os.path.basename(checkpoint_path)
+        written = self.written.setdefault(name.split("_")[0], [])
+        if checkpoint_path in written:  # if_latest覆盖写同一个文件
+            return
+        written.append(checkpoint_path)
+        while len(written) > self.keep_last:
+            old_path = written.pop(0)
+            try:
+                os.remove(old_path)
+                self.log("Removed old checkpoint {}".format(old_path))
+            except OSError:
+                pass
+
+    def wait(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
 def summarize(
     writer,
     global_step,
@@ -200,6 +305,67 @@ def summarize(
         writer.add_audio(k, v, global_step, audio_sampling_rate)
 
 
+class SummaryWorker(object):
+    """
+    Renders spectrogram images and writes tensorboard summaries on a
+    background thread. submit() takes python floats and detached cpu tensors
+    and returns at once. Scalars are always queued, they are cheap; when
+    max_pending image jobs are still waiting, the images of the new step are
+    dropped instead of stalling training.
+    """
+
+    def __init__(self, writer, max_pending=1, log=None):
+        self.writer = writer
+        self.max_pending = max_pending
+        self.log = log or logger.info
+        self.pending = 0  # 还没画完的带图任务数
+        self.n_dropped = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while 1:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            global_step, scalars, spectrograms = job
+            try:
+                images = {
+                    k: plot_spectrogram_to_numpy(v.float().numpy())
+                    for k, v in spectrograms.items()
+                }
+                summarize(
+                    writer=self.writer,
+                    global_step=global_step,
+                    images=images,
+                    scalars=scalars,
+                )
+            except:
+                self.log(traceback.format_exc())
+            if spectrograms:
+                with self.lock:
+                    self.pending -= 1
+            self.queue.task_done()
+
+    def submit(self, global_step, scalars, spectrograms={}):
+        if spectrograms:
+            with self.lock:
+                if self.pending >= self.max_pending:
+                    self.n_dropped += 1
+                    spectrograms = {}
+                else:
+                    self.pending += 1
+        self.queue.put((global_step, scalars, spectrograms))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.flush()
+
+
 def latest_checkpoint_path(dir_path, regex="G_*.pth"):
     f_list = glob.glob(os.path.join(dir_path, regex))
     f_list.sort(key=lambda f: int("".join(filter(str.isdigit, f))))
@@ -352,6 +518,90 @@ def get_hparams(init=True):
         required=True,
         help="if caching the dataset in GPU memory, 1 or 0",
     )
+    parser.add_argument(
+        "-cg",
+        "--cache_gpu_mb",
+        type=int,
+        default=-1,
+        help="GPU memory for caching samples when -c is 1, in MB, -1 for auto",
+    )
+    parser.add_argument(
+        "-ch",
+        "--cache_host_mb",
+        type=int,
+        default=0,
+        help="pinned host memory for caching samples, in MB, 0 (default) to disable, "
+        "-1 for auto (a quarter of the available RAM split across processes)",
+    )
+    parser.add_argument(
+        "-kl",
+        "--keep_last",
+        type=int,
+        default=0,
+        help="keep only the last n G/D checkpoints when -l is 0, 0 keeps all",
+    )
+    parser.add_argument(
+        "-ke",
+        "--keep_every",
+        type=int,
+        default=0,
+        help="with -kl, also keep the checkpoints of every n-th epoch",
+    )
+    parser.add_argument(
+        "-ps",
+        "--profile_sync",
+        type=int,
+        default=0,
+        help="synchronize cuda between step phases for exact step timings, 1 or 0",
+    )
+    parser.add_argument(
+        "-pt",
+        "--profile_trace",
+        type=str,
+        default="",
+        help="dump a chrome trace of steps start:count into the experiment dir",
+    )
+    parser.add_argument(
+        "-cb",
+        "--cpu_bf16",
+        type=int,
+        default=-1,
+        help="bf16 autocast when training on cpu, 1 or 0, -1 if the cpu supports it",
+    )
+    parser.add_argument(
+        "--nnodes", type=int, default=1, help="number of nodes, same as torchrun"
+    )
+    parser.add_argument(
+        "--node_rank", type=int, default=0, help="rank of this node, same as torchrun"
+    )
+    parser.add_argument(
+        "--nproc_per_node",
+        type=int,
+        default=0,
+        help="training processes on this node, 0 for one per gpu (one on cpu)",
+    )
+    parser.add_argument(
+        "--master_addr", type=str, default="localhost", help="address of node 0"
+    )
+    parser.add_argument(
+        "--master_port",
+        type=int,
+        default=0,
+        help="free port on node 0, 0 for a random one (single node only)",
+    )
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        default="",
+        help="nccl/gloo, empty for nccl on gpu and gloo otherwise",
+    )
+    parser.add_argument(
+        "-nw",
+        "--num_workers",
+        type=int,
+        default=-1,
+        help="DataLoader workers, -1 for 4 on gpu and a share of the cores on cpu",
+    )
     parser.add_argument(
         "-li", "--log_interval", type=int, required=True, help="log interval"
     )
@@ -393,6 +643,20 @@ def get_hparams(init=True):
     hparams.if_latest = args.if_latest
     hparams.save_every_weights = args.save_every_weights
     hparams.if_cache_data_in_gpu = args.if_cache_data_in_gpu
+    hparams.cache_gpu_mb = args.cache_gpu_mb
+    hparams.cache_host_mb = args.cache_host_mb
+    hparams.keep_last = args.keep_last
+    hparams.keep_every = args.keep_every
+    hparams.profile_sync = args.profile_sync
+    hparams.profile_trace = args.profile_trace
+    hparams.cpu_bf16 = args.cpu_bf16
+    hparams.num_workers = args.num_workers
+    hparams.nnodes = args.nnodes
+    hparams.node_rank = args.node_rank
+    hparams.nproc_per_node = args.nproc_per_node
+    hparams.master_addr = args.master_addr
+    hparams.master_port = args.master_port
+    hparams.dist_backend = args.dist_backend
     hparams.data.training_files = "%s/filelist.txt" % experiment_dir
 
     hparams.train.log_interval = args.log_interval
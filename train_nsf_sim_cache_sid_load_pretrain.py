@@ -31,6 +31,10 @@ from data_utils import (
     TextAudioCollateMultiNSFsid,
     TextAudioCollate,
     DistributedBucketSampler,
+    TieredSampleCache,
+    PackedTextAudioLoaderMultiNSFsid,
+    PackedTextAudioLoader,
+    get_packed_dir,
 )
 
 import csv
@@ -50,37 +54,62 @@ else:
 from losses import generator_loss, discriminator_loss, feature_loss, kl_loss
 from mel_processing import mel_spectrogram_torch, spec_to_mel_torch
 from process_ckpt import savee
+from step_profiler import StepProfiler
 
 global_step = 0
+ckpt_writer = None  # rank 0上的后台checkpoint写线程
+step_profiler = None
+summary_worker = None  # rank 0上画图/写tensorboard的后台线程
 
 
 class EpochRecorder:
     def __init__(self):
         self.last_time = ttime()
 
-    def record(self):
+    def record(self, n_steps=None):
         now_time = ttime()
         elapsed_time = now_time - self.last_time
         self.last_time = now_time
         elapsed_time_str = str(datetime.timedelta(seconds=elapsed_time))
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if n_steps is not None:  # 这一轮的平均速度, 对比cpu/gpu各种配置用
+            elapsed_time_str += ", %.2f steps/s" % (n_steps / max(elapsed_time, 1e-9))
         return f"[{current_time}] | ({elapsed_time_str})"
 
 
 def main():
+    # torchrun之类的启动器已经给每个进程设好了RANK/WORLD_SIZE/MASTER_ADDR等
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        run(
+            int(os.environ["RANK"]),
+            int(os.environ["WORLD_SIZE"]),
+            hps,
+            int(os.environ.get("LOCAL_RANK", 0)),
+            int(os.environ.get("LOCAL_WORLD_SIZE", 1)),
+        )
+        return
     n_gpus = torch.cuda.device_count()
-    if torch.cuda.is_available() == False and torch.backends.mps.is_available() == True:
-        n_gpus = 1
-    os.environ["MASTER_ADDR"] = "localhost"
-    os.environ["MASTER_PORT"] = str(randint(20000, 55555))
+    if torch.cuda.is_available() == False:
+        n_gpus = 1  # cpu(含mps机器)上单进程训练
+    if hps.nproc_per_node > 0:
+        n_gpus = hps.nproc_per_node
+    if hps.nnodes > 1 and hps.master_port <= 0:
+        raise ValueError("--master_port is required with --nnodes > 1")
+    os.environ["MASTER_ADDR"] = hps.master_addr
+    if hps.master_port > 0:
+        os.environ["MASTER_PORT"] = str(hps.master_port)
+    else:
+        os.environ["MASTER_PORT"] = str(randint(20000, 55555))
     children = []
     for i in range(n_gpus):
         subproc = mp.Process(
             target=run,
             args=(
+                hps.node_rank * n_gpus + i,
+                hps.nnodes * n_gpus,
+                hps,
                 i,
                 n_gpus,
-                hps,
             ),
         )
         children.append(subproc)
@@ -90,23 +119,149 @@ def main():
         children[i].join()
 
 
-def run(rank, n_gpus, hps):
-    global global_step
+def cache_budget(hps, n_local):
+    """样本缓存的显存/内存预算(字节), 每个进程各自缓存自己那份"""
+    gpu_bytes = host_bytes = 0
+    if hps.if_cache_data_in_gpu == 1 and torch.cuda.is_available():
+        if hps.cache_gpu_mb >= 0:
+            gpu_bytes = hps.cache_gpu_mb * 1024**2
+        else:
+            free, _ = torch.cuda.mem_get_info()
+            gpu_bytes = int(free * 0.3)  # 剩下的留给模型和激活
+    if hps.cache_host_mb >= 0:
+        host_bytes = hps.cache_host_mb * 1024**2
+    else:
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+            host_bytes = available // 4 // n_local
+        except (ValueError, OSError, AttributeError):
+            host_bytes = 0
+    return gpu_bytes, host_bytes
+
+
+def save_small_model(logger, ckpt, name, epoch, hps):
+    logger.info(
+        "saving ckpt %s_e%s:%s"
+        % (
+            hps.name,
+            epoch,
+            savee(ckpt, hps.sample_rate, hps.if_f0, name, epoch, hps.version, hps),
+        )
+    )
+
+
+def cpu_bf16_supported():
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except:
+        return False
+
+
+def amp_autocast(hps, enabled=True):
+    # cuda上按fp16_run开fp16, cpu上按cpu_bf16开bf16
+    if torch.cuda.is_available():
+        return autocast(enabled=enabled and hps.train.fp16_run)
+    return torch.cpu.amp.autocast(
+        enabled=enabled and hps.cpu_bf16, dtype=torch.bfloat16
+    )
+
+
+def setup_cpu_training(hps, n_procs):
+    """
+    fp16 needs cuda, so cpu training runs fp32 or bf16 autocast. The cores of
+    this process are split between the DataLoader workers (one thread each,
+    torch sets that in the workers) and the intra-op threads of the step.
+    Returns (DataLoader workers, intra-op threads).
+    """
+    hps.train.fp16_run = False
+    if hps.cpu_bf16 == -1:
+        hps.cpu_bf16 = cpu_bf16_supported()
+    hps.cpu_bf16 = bool(hps.cpu_bf16)
+    n_cores = max(1, (os.cpu_count() or 1) // n_procs)
+    if hps.num_workers >= 0:
+        num_workers = max(1, hps.num_workers)
+    else:
+        num_workers = max(1, min(4, n_cores // 4))
+    n_threads = max(1, n_cores - num_workers)
+    torch.set_num_threads(n_threads)
+    try:
+        torch.set_interop_threads(1)  # 模型里几乎没有可以并行的独立算子
+    except RuntimeError:  # 已经跑过并行计算就不能再改
+        pass
+    return num_workers, n_threads
+
+
+def run(rank, n_gpus, hps, local_rank=None, n_local=None):
+    """
+    rank/n_gpus are the global rank and world size, local_rank/n_local the
+    process index and process count on this node (device and core split)
+    """
+    global global_step, ckpt_writer, step_profiler, summary_worker
+    if local_rank is None:
+        local_rank, n_local = rank, n_gpus
     if rank == 0:
         logger = utils.get_logger(hps.model_dir)
         logger.info(hps)
+        ckpt_writer = utils.CheckpointWriter(
+            hps.keep_last, hps.keep_every, log=logger.info
+        )
         # utils.check_git_hash(hps.model_dir)
         writer = SummaryWriter(log_dir=hps.model_dir)
         writer_eval = SummaryWriter(log_dir=os.path.join(hps.model_dir, "eval"))
+        summary_worker = utils.SummaryWorker(writer, log=logger.info)
 
+    if torch.cuda.is_available():
+        hps.cpu_bf16 = False
+        num_workers = 4 if hps.num_workers < 0 else max(1, hps.num_workers)
+    else:
+        num_workers, n_threads = setup_cpu_training(hps, n_local)
+        if rank == 0:
+            logger.info(
+                "cpu training: %s threads, %s DataLoader workers, %s"
+                % (n_threads, num_workers, "bf16 autocast" if hps.cpu_bf16 else "fp32")
+            )
+
+    # gpu上用nccl, cpu或者没有nccl(windows)用gloo
+    if hps.dist_backend:
+        backend = hps.dist_backend
+    elif torch.cuda.is_available() and dist.is_nccl_available():
+        backend = "nccl"
+    else:
+        backend = "gloo"
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
     dist.init_process_group(
-        backend="gloo", init_method="env://", world_size=n_gpus, rank=rank
+        backend=backend, init_method="env://", world_size=n_gpus, rank=rank
     )
+    if rank == 0:
+        logger.info("%s processes, backend %s" % (n_gpus, backend))
     torch.manual_seed(hps.train.seed)
-    if torch.cuda.is_available():
-        torch.cuda.set_device(rank)
 
-    if hps.if_f0 == 1:
+    # 每步各阶段耗时, 按log_interval写进日志和tensorboard
+    trace_start, trace_steps = 0, 0
+    if hps.profile_trace and rank == 0:
+        trace_start, trace_steps = [int(i) for i in hps.profile_trace.split(":")]
+    step_profiler = StepProfiler(
+        "cuda:%s" % local_rank if torch.cuda.is_available() else "cpu",
+        sync=hps.profile_sync == 1,
+        trace_path=os.path.join(hps.model_dir, "trace_step%s.json" % trace_start)
+        if trace_steps > 0
+        else None,
+        trace_start=trace_start,
+        trace_steps=trace_steps,
+        pid=rank,
+    )
+
+    # pack_trainset_print.py打包过且和filelist对得上就读打包数据
+    packed_dir = get_packed_dir(hps.data.training_files, hps.if_f0)
+    if packed_dir is not None:
+        if rank == 0:
+            logger.info("reading packed dataset from %s" % packed_dir)
+        if hps.if_f0 == 1:
+            train_dataset = PackedTextAudioLoaderMultiNSFsid(packed_dir, hps.data)
+        else:
+            train_dataset = PackedTextAudioLoader(packed_dir, hps.data)
+    elif hps.if_f0 == 1:
         train_dataset = TextAudioLoaderMultiNSFsid(hps.data.training_files, hps.data)
     else:
         train_dataset = TextAudioLoader(hps.data.training_files, hps.data)
@@ -114,7 +269,8 @@ def run(rank, n_gpus, hps):
         train_dataset,
         hps.train.batch_size * n_gpus,
         # [100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 1200,1400],  # 16s
-        [100, 200, 300, 400, 500, 600, 700, 800, 900],  # 16s
+        # [100, 200, 300, 400, 500, 600, 700, 800, 900],  # 16s
+        None,  # 按真实长度分布自动分桶
         num_replicas=n_gpus,
         rank=rank,
         shuffle=True,
@@ -125,16 +281,34 @@ def run(rank, n_gpus, hps):
         collate_fn = TextAudioCollateMultiNSFsid()
     else:
         collate_fn = TextAudioCollate()
-    train_loader = DataLoader(
-        train_dataset,
-        num_workers=4,
-        shuffle=False,
-        pin_memory=True,
-        collate_fn=collate_fn,
-        batch_sampler=train_sampler,
-        persistent_workers=True,
-        prefetch_factor=8,
-    )
+    # 样本缓存在显存/内存里, 放不下的每轮再走DataLoader
+    gpu_bytes, host_bytes = cache_budget(hps, n_local)
+    if gpu_bytes + host_bytes > 0:
+        if rank == 0:
+            logger.info(
+                "sample cache budget: gpu %.0fMB, host %.0fMB"
+                % (gpu_bytes / 1024**2, host_bytes / 1024**2)
+            )
+        train_loader = TieredSampleCache(
+            train_dataset,
+            train_sampler,
+            collate_fn,
+            "cuda:%s" % local_rank if torch.cuda.is_available() else "cpu",
+            gpu_bytes=gpu_bytes,
+            host_bytes=host_bytes,
+            num_workers=num_workers,
+        )
+    else:
+        train_loader = DataLoader(
+            train_dataset,
+            num_workers=num_workers,
+            shuffle=False,
+            pin_memory=True,
+            collate_fn=collate_fn,
+            batch_sampler=train_sampler,
+            persistent_workers=True,
+            prefetch_factor=8,
+        )
     if hps.if_f0 == 1:
         net_g = RVC_Model_f0(
             hps.data.filter_length // 2 + 1,
@@ -151,10 +325,10 @@ def run(rank, n_gpus, hps):
             is_half=hps.train.fp16_run,
         )
     if torch.cuda.is_available():
-        net_g = net_g.cuda(rank)
+        net_g = net_g.cuda(local_rank)
     net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm)
     if torch.cuda.is_available():
-        net_d = net_d.cuda(rank)
+        net_d = net_d.cuda(local_rank)
     optim_g = torch.optim.AdamW(
         net_g.parameters(),
         hps.train.learning_rate,
@@ -170,8 +344,8 @@ def run(rank, n_gpus, hps):
     # net_g = DDP(net_g, device_ids=[rank], find_unused_parameters=True)
     # net_d = DDP(net_d, device_ids=[rank], find_unused_parameters=True)
     if torch.cuda.is_available():
-        net_g = DDP(net_g, device_ids=[rank])
-        net_d = DDP(net_d, device_ids=[rank])
+        net_g = DDP(net_g, device_ids=[local_rank])
+        net_d = DDP(net_d, device_ids=[local_rank])
     else:
         net_g = DDP(net_g)
         net_d = DDP(net_d)
@@ -219,7 +393,6 @@ def run(rank, n_gpus, hps):
 
     scaler = GradScaler(enabled=hps.train.fp16_run)
 
-    cache = []
     for epoch in range(epoch_str, hps.train.epochs + 1):
         if rank == 0:
             train_and_evaluate(
@@ -233,7 +406,6 @@ def run(rank, n_gpus, hps):
                 [train_loader, None],
                 logger,
                 [writer, writer_eval],
-                cache,
             )
         else:
             train_and_evaluate(
@@ -247,14 +419,13 @@ def run(rank, n_gpus, hps):
                 [train_loader, None],
                 None,
                 None,
-                cache,
             )
         scheduler_g.step()
         scheduler_d.step()
 
 
 def train_and_evaluate(
-    rank, epoch, hps, nets, optims, schedulers, scaler, loaders, logger, writers, cache
+    rank, epoch, hps, nets, optims, schedulers, scaler, loaders, logger, writers
 ):
     net_g, net_d = nets
     optim_g, optim_d = optims
@@ -269,91 +440,15 @@ def train_and_evaluate(
     net_d.train()
 
     # Prepare data iterator
-    if hps.if_cache_data_in_gpu == True:
-        # Use Cache
-        data_iterator = cache
-        if cache == []:
-            # Make new cache
-            for batch_idx, info in enumerate(train_loader):
-                # Unpack
-                if hps.if_f0 == 1:
-                    (
-                        phone,
-                        phone_lengths,
-                        pitch,
-                        pitchf,
-                        spec,
-                        spec_lengths,
-                        wave,
-                        wave_lengths,
-                        sid,
-                    ) = info
-                else:
-                    (
-                        phone,
-                        phone_lengths,
-                        spec,
-                        spec_lengths,
-                        wave,
-                        wave_lengths,
-                        sid,
-                    ) = info
-                # Load on CUDA
-                if torch.cuda.is_available():
-                    phone = phone.cuda(rank, non_blocking=True)
-                    phone_lengths = phone_lengths.cuda(rank, non_blocking=True)
-                    if hps.if_f0 == 1:
-                        pitch = pitch.cuda(rank, non_blocking=True)
-                        pitchf = pitchf.cuda(rank, non_blocking=True)
-                    sid = sid.cuda(rank, non_blocking=True)
-                    spec = spec.cuda(rank, non_blocking=True)
-                    spec_lengths = spec_lengths.cuda(rank, non_blocking=True)
-                    wave = wave.cuda(rank, non_blocking=True)
-                    wave_lengths = wave_lengths.cuda(rank, non_blocking=True)
-                # Cache on list
-                if hps.if_f0 == 1:
-                    cache.append(
-                        (
-                            batch_idx,
-                            (
-                                phone,
-                                phone_lengths,
-                                pitch,
-                                pitchf,
-                                spec,
-                                spec_lengths,
-                                wave,
-                                wave_lengths,
-                                sid,
-                            ),
-                        )
-                    )
-                else:
-                    cache.append(
-                        (
-                            batch_idx,
-                            (
-                                phone,
-                                phone_lengths,
-                                spec,
-                                spec_lengths,
-                                wave,
-                                wave_lengths,
-                                sid,
-                            ),
-                        )
-                    )
-        else:
-            # Load shuffled cache
-            shuffle(cache)
-    else:
-        # Loader
-        data_iterator = enumerate(train_loader)
+    # TieredSampleCache和DataLoader一样按batch_sampler出batch
+    data_iterator = enumerate(train_loader)
 
     # Run steps
     epoch_recorder = EpochRecorder()
+    step_profiler.begin_epoch()
 
     for batch_idx, info in data_iterator:
+        step_profiler.start(global_step)
         # Data
         ## Unpack
         if hps.if_f0 == 1:
@@ -370,21 +465,23 @@ def train_and_evaluate(
             ) = info
         else:
             phone, phone_lengths, spec, spec_lengths, wave, wave_lengths, sid = info
-        ## Load on CUDA
-        if (hps.if_cache_data_in_gpu == False) and torch.cuda.is_available():
-            phone = phone.cuda(rank, non_blocking=True)
-            phone_lengths = phone_lengths.cuda(rank, non_blocking=True)
+        step_profiler.mark("data")
+        ## Load on CUDA (缓存里出来的已经在卡上, .cuda不再拷贝; 卡号在run里set_device过)
+        if torch.cuda.is_available():
+            phone = phone.cuda(non_blocking=True)
+            phone_lengths = phone_lengths.cuda(non_blocking=True)
             if hps.if_f0 == 1:
-                pitch = pitch.cuda(rank, non_blocking=True)
-                pitchf = pitchf.cuda(rank, non_blocking=True)
-            sid = sid.cuda(rank, non_blocking=True)
-            spec = spec.cuda(rank, non_blocking=True)
-            spec_lengths = spec_lengths.cuda(rank, non_blocking=True)
-            wave = wave.cuda(rank, non_blocking=True)
-            # wave_lengths = wave_lengths.cuda(rank, non_blocking=True)
+                pitch = pitch.cuda(non_blocking=True)
+                pitchf = pitchf.cuda(non_blocking=True)
+            sid = sid.cuda(non_blocking=True)
+            spec = spec.cuda(non_blocking=True)
+            spec_lengths = spec_lengths.cuda(non_blocking=True)
+            wave = wave.cuda(non_blocking=True)
+            # wave_lengths = wave_lengths.cuda(non_blocking=True)
+        step_profiler.mark("h2d")
 
         # Calculate
-        with autocast(enabled=hps.train.fp16_run):
+        with amp_autocast(hps):
             if hps.if_f0 == 1:
                 (
                     y_hat,
@@ -412,7 +509,7 @@ def train_and_evaluate(
             y_mel = commons.slice_segments(
                 mel, ids_slice, hps.train.segment_size // hps.data.hop_length
             )
-            with autocast(enabled=False):
+            with amp_autocast(hps, False):
                 y_hat_mel = mel_spectrogram_torch(
                     y_hat.float().squeeze(1),
                     hps.data.filter_length,
@@ -425,37 +522,46 @@ def train_and_evaluate(
                 )
             if hps.train.fp16_run == True:
                 y_hat_mel = y_hat_mel.half()
+            elif hps.cpu_bf16:
+                y_hat_mel = y_hat_mel.to(y_mel.dtype)
             wave = commons.slice_segments(
                 wave, ids_slice * hps.data.hop_length, hps.train.segment_size
             )  # slice
+            step_profiler.mark("g_forward")
 
             # Discriminator
             y_d_hat_r, y_d_hat_g, _, _ = net_d(wave, y_hat.detach())
-            with autocast(enabled=False):
+            with amp_autocast(hps, False):
                 loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(
                     y_d_hat_r, y_d_hat_g
                 )
+        step_profiler.mark("d_forward")
         optim_d.zero_grad()
         scaler.scale(loss_disc).backward()
+        step_profiler.mark("d_backward")
         scaler.unscale_(optim_d)
         grad_norm_d = commons.clip_grad_value_(net_d.parameters(), None)
         scaler.step(optim_d)
+        step_profiler.mark("d_optim")
 
-        with autocast(enabled=hps.train.fp16_run):
+        with amp_autocast(hps):
             # Generator
             y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(wave, y_hat)
-            with autocast(enabled=False):
+            with amp_autocast(hps, False):
                 loss_mel = F.l1_loss(y_mel, y_hat_mel) * hps.train.c_mel
                 loss_kl = kl_loss(z_p, logs_q, m_p, logs_p, z_mask) * hps.train.c_kl
                 loss_fm = feature_loss(fmap_r, fmap_g)
                 loss_gen, losses_gen = generator_loss(y_d_hat_g)
                 loss_gen_all = loss_gen + loss_fm + loss_mel + loss_kl
+        step_profiler.mark("g_loss")
         optim_g.zero_grad()
         scaler.scale(loss_gen_all).backward()
+        step_profiler.mark("g_backward")
         scaler.unscale_(optim_g)
         grad_norm_g = commons.clip_grad_value_(net_g.parameters(), None)
         scaler.step(optim_g)
         scaler.update()
+        step_profiler.mark("g_optim")
 
         if rank == 0:
             if global_step % hps.train.log_interval == 0:
@@ -475,6 +581,9 @@ def train_and_evaluate(
                 logger.info(
                     f"loss_disc={loss_disc:.3f}, loss_gen={loss_gen:.3f}, loss_fm={loss_fm:.3f},loss_mel={loss_mel:.3f}, loss_kl={loss_kl:.3f}"
                 )
+                profile_line, profile_scalars = step_profiler.report()
+                if profile_line is not None:
+                    logger.info(profile_line)
                 scalar_dict = {
                     "loss/g/total": loss_gen_all,
                     "loss/d/total": loss_disc,
@@ -499,77 +608,57 @@ def train_and_evaluate(
                 scalar_dict.update(
                     {"loss/d_g/{}".format(i): v for i, v in enumerate(losses_disc_g)}
                 )
-                image_dict = {
-                    "slice/mel_org": utils.plot_spectrogram_to_numpy(
-                        y_mel[0].data.cpu().numpy()
-                    ),
-                    "slice/mel_gen": utils.plot_spectrogram_to_numpy(
-                        y_hat_mel[0].data.cpu().numpy()
-                    ),
-                    "all/mel": utils.plot_spectrogram_to_numpy(
-                        mel[0].data.cpu().numpy()
-                    ),
-                }
-                utils.summarize(
-                    writer=writer,
-                    global_step=global_step,
-                    images=image_dict,
-                    scalars=scalar_dict,
+                scalar_dict.update(profile_scalars)
+                # 画图和写tensorboard在summary_worker线程里做, 忙不过来时丢掉这次的图
+                summary_worker.submit(
+                    global_step,
+                    {k: float(v) for k, v in scalar_dict.items()},
+                    {
+                        "slice/mel_org": y_mel[0].detach().cpu(),
+                        "slice/mel_gen": y_hat_mel[0].detach().cpu(),
+                        "all/mel": mel[0].detach().cpu(),
+                    },
                 )
+        step_profiler.mark("logging")
+        step_profiler.end(
+            wave_lengths.size(0),
+            float(wave_lengths.sum()) / hps.data.sampling_rate,
+        )
         global_step += 1
     # /Run steps
 
     if epoch % hps.save_every_epoch == 0 and rank == 0:
+        # 这里只拷一份到cpu, 序列化和写盘在ckpt_writer线程里做
         if hps.if_latest == 0:
-            utils.save_checkpoint(
-                net_g,
-                optim_g,
-                hps.train.learning_rate,
-                epoch,
-                os.path.join(hps.model_dir, "G_{}.pth".format(global_step)),
-            )
-            utils.save_checkpoint(
-                net_d,
-                optim_d,
-                hps.train.learning_rate,
-                epoch,
-                os.path.join(hps.model_dir, "D_{}.pth".format(global_step)),
-            )
+            ckpt_step = global_step
         else:
-            utils.save_checkpoint(
-                net_g,
-                optim_g,
-                hps.train.learning_rate,
-                epoch,
-                os.path.join(hps.model_dir, "G_{}.pth".format(2333333)),
-            )
-            utils.save_checkpoint(
-                net_d,
-                optim_d,
-                hps.train.learning_rate,
-                epoch,
-                os.path.join(hps.model_dir, "D_{}.pth".format(2333333)),
-            )
+            ckpt_step = 2333333
+        ckpt_writer.save_checkpoint(
+            net_g,
+            optim_g,
+            hps.train.learning_rate,
+            epoch,
+            os.path.join(hps.model_dir, "G_{}.pth".format(ckpt_step)),
+        )
+        ckpt_writer.save_checkpoint(
+            net_d,
+            optim_d,
+            hps.train.learning_rate,
+            epoch,
+            os.path.join(hps.model_dir, "D_{}.pth".format(ckpt_step)),
+        )
         if rank == 0 and hps.save_every_weights == "1":
             if hasattr(net_g, "module"):
                 ckpt = net_g.module.state_dict()
             else:
                 ckpt = net_g.state_dict()
-            logger.info(
-                "saving ckpt %s_e%s:%s"
-                % (
-                    hps.name,
-                    epoch,
-                    savee(
-                        ckpt,
-                        hps.sample_rate,
-                        hps.if_f0,
-                        hps.name + "_e%s_s%s" % (epoch, global_step),
-                        epoch,
-                        hps.version,
-                        hps,
-                    ),
-                )
+            ckpt_writer.submit(
+                save_small_model,
+                logger,
+                utils.snapshot_state(ckpt),
+                hps.name + "_e%s_s%s" % (epoch, global_step),
+                epoch,
+                hps,
             )
 
     try:
@@ -590,6 +679,9 @@ def train_and_evaluate(
 
     if stopbtn:
         logger.info("Stop Button was pressed. The program is closed.")
+        if ckpt_writer is not None:
+            ckpt_writer.close()  # 等排队的checkpoint写完再退出
+            summary_worker.close()
         if hasattr(net_g, "module"):
             ckpt = net_g.module.state_dict()
         else:
@@ -615,9 +707,22 @@ def train_and_evaluate(
         os._exit(2333333)
 
     if rank == 0:
-        logger.info("====> Epoch: {} {}".format(epoch, epoch_recorder.record()))
+        logger.info(
+            "====> Epoch: {} {}".format(epoch, epoch_recorder.record(len(train_loader)))
+        )
+        padding_waste = train_loader.batch_sampler.padding_waste
+        if padding_waste is not None:
+            logger.info("padding waste: {:.1%}".format(padding_waste))
+        if isinstance(train_loader, TieredSampleCache):
+            logger.info(train_loader.summary())
+        if summary_worker.n_dropped > 0:
+            logger.info(
+                "dropped spectrogram images of %s steps" % summary_worker.n_dropped
+            )
     if epoch >= hps.total_epoch and rank == 0:
         logger.info("Training is done. The program is closed.")
+        ckpt_writer.close()
+        summary_worker.close()
 
         if hasattr(net_g, "module"):
             ckpt = net_g.module.state_dict()
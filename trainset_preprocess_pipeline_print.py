@@ -15,6 +15,7 @@ import librosa, traceback
 from scipy.io import wavfile
 import multiprocessing
 from my_utils import load_audio
+from job_scheduler import WorkQueue, file_weight
 import tqdm
 
 DoFormant = False
@@ -105,9 +106,13 @@ class PreProcess:
         except:
             println("%s->%s" % (path, traceback.format_exc()))
 
-    def pipeline_mp(self, infos, thread_n):
+    def pipeline_mp(self, work_queue, thread_n):
+        # 从共享队列里按文件大小从大到小取, 谁空了谁取
         for path, idx0 in tqdm.tqdm(
-            infos, position=thread_n, leave=True, desc="thread:%s" % thread_n
+            work_queue.jobs(thread_n),
+            position=thread_n,
+            leave=True,
+            desc="thread:%s" % thread_n,
         ):
             self.pipeline(path, idx0)
 
@@ -117,19 +122,19 @@ class PreProcess:
                 ("%s/%s" % (inp_root, name), idx)
                 for idx, name in enumerate(sorted(list(os.listdir(inp_root))))
             ]
+            work_queue = WorkQueue(infos, n_p, weight=lambda info: file_weight(info[0]))
             if noparallel:
                 for i in range(n_p):
-                    self.pipeline_mp(infos[i::n_p])
+                    self.pipeline_mp(work_queue, i)
             else:
                 ps = []
                 for i in range(n_p):
                     p = multiprocessing.Process(
-                        target=self.pipeline_mp, args=(infos[i::n_p], i)
+                        target=self.pipeline_mp, args=(work_queue, i)
                     )
                     ps.append(p)
                     p.start()
-                for i in range(n_p):
-                    ps[i].join()
+                work_queue.join(ps, println)
         except:
             println("Fail. %s" % traceback.format_exc())
 
@@ -139,6 +144,10 @@ def preprocess_trainset(inp_root, sr, n_p, exp_dir):
     println("start preprocess")
     println(sys.argv)
     pp.pipeline_mp_inp_dir(inp_root, n_p)
+    # 切片完再统一算好线性谱, 训练时直接读.spec.npy
+    from extract_spec_print import precompute_specs
+
+    precompute_specs(exp_dir, sr, n_p, noparallel, println)
     println("end preprocess")
 
 
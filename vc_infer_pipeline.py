@@ -6,28 +6,25 @@ from torch import Tensor
 import scipy.signal as signal
 import pyworld, os, traceback, faiss, librosa, torchcrepe
 from scipy import signal
-from functools import lru_cache
+from index_cache import load_index
+from lib.infer_pack.commons import hubert_frames
+from f0_cache import f0_cache
+from f0_pool import (
+    compute_pm_f0,
+    compute_harvest_f0,
+    compute_dio_f0,
+    harvest_parallel,
+    run_f0_jobs,
+    median_f0,
+)
 
 now_dir = os.getcwd()
 sys.path.append(now_dir)
 
 bh, ah = signal.butter(N=5, Wn=48, btype="high", fs=16000)
 
-input_audio_path2wav = {}
-
-
-@lru_cache
-def cache_harvest_f0(input_audio_path, fs, f0max, f0min, frame_period):
-    audio = input_audio_path2wav[input_audio_path]
-    f0, t = pyworld.harvest(
-        audio,
-        fs=fs,
-        f0_ceil=f0max,
-        f0_floor=f0min,
-        frame_period=frame_period,
-    )
-    f0 = pyworld.stonemask(audio, f0, t, fs)
-    return f0
+# 检索融合每次处理的帧数, v2下一块的(帧, 8, 768)gather约50MB
+retrieval_chunk = 2048
 
 
 def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出音频,rate是2的占比
@@ -70,6 +67,16 @@ class VC(object):
         self.t_center = self.sr * self.x_center  # 查询切点位置
         self.t_max = self.sr * self.x_max  # 免查询时长阈值
         self.device = config.device
+        self.hubert_batch_size = getattr(config, "hubert_batch_size", 1)
+        # 第一层卷积的GroupNorm会把pad进去的0也算进统计量, 长度差太多的段不拼在一起
+        self.hubert_max_pad_ratio = 0.1
+        if getattr(config, "f0_cache_dir", None):
+            f0_cache.set_dir(config.f0_cache_dir)
+        # 检索用的特征矩阵放到显卡上, gather和加权求和都在卡上做; 小显存的卡不放
+        gpu_mem = getattr(config, "gpu_mem", None)
+        self.index_on_device = torch.device(self.device).type != "cpu" and not (
+            gpu_mem != None and gpu_mem <= 4
+        )
 
     # Fork Feature: Get the best torch device to use for f0 algorithms that require a torch device. Will return the type (torch.device)
     def get_optimal_torch_device(self, index: int = 0) -> torch.device:
@@ -156,6 +163,16 @@ class VC(object):
         f0 = f0[0].cpu().numpy()
         return f0
 
+    def get_f0_rmvpe_computation(self, x):
+        if hasattr(self, "model_rmvpe") == False:
+            from rmvpe import RMVPE
+
+            print("loading rmvpe model")
+            self.model_rmvpe = RMVPE(
+                "rmvpe.pt", is_half=self.is_half, device=self.device
+            )
+        return self.model_rmvpe.infer_from_audio(x, thred=0.03)
+
     # Fork Feature: Compute pYIN f0 method
     def get_f0_pyin_computation(self, x, f0_min, f0_max):
         y, sr = librosa.load("saudio/Sidney.wav", self.sr, mono=True)
@@ -181,93 +198,99 @@ class VC(object):
         s = s.split("hybrid")[1]
         s = s.replace("[", "").replace("]", "")
         methods = s.split("+")
-        f0_computation_stack = []
+        f0_methods = []
 
         print("Calculating f0 pitch estimations for methods: %s" % str(methods))
+        audio = x.astype(np.double)
         x = x.astype(np.float32)
         x /= np.quantile(np.abs(x), 0.999)
-        # Get f0 calculations for all methods specified
+        # pm/harvest/dio进进程池, crepe/rmvpe在当前线程里同时跑
+        jobs = []
         for method in methods:
-            f0 = None
             if method == "pm":
-                f0 = (
-                    parselmouth.Sound(x, self.sr)
-                    .to_pitch_ac(
-                        time_step=time_step / 1000,
-                        voicing_threshold=0.6,
-                        pitch_floor=f0_min,
-                        pitch_ceiling=f0_max,
-                    )
-                    .selected_array["frequency"]
+                jobs.append(
+                    (compute_pm_f0, (x, self.sr, time_step, f0_min, f0_max, p_len), True)
                 )
-                pad_size = (p_len - len(f0) + 1) // 2
-                if pad_size > 0 or p_len - len(f0) - pad_size > 0:
-                    f0 = np.pad(
-                        f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
-                    )
             elif method == "crepe":
-                f0 = self.get_f0_official_crepe_computation(x, f0_min, f0_max)
-                f0 = f0[1:]  # Get rid of extra first frame
+                jobs.append(
+                    (self.get_f0_official_crepe_computation, (x, f0_min, f0_max), False)
+                )
             elif method == "crepe-tiny":
-                f0 = self.get_f0_official_crepe_computation(x, f0_min, f0_max, "tiny")
-                f0 = f0[1:]  # Get rid of extra first frame
+                jobs.append(
+                    (
+                        self.get_f0_official_crepe_computation,
+                        (x, f0_min, f0_max, "tiny"),
+                        False,
+                    )
+                )
             elif method == "mangio-crepe":
-                f0 = self.get_f0_crepe_computation(
-                    x, f0_min, f0_max, p_len, crepe_hop_length
+                jobs.append(
+                    (
+                        self.get_f0_crepe_computation,
+                        (x, f0_min, f0_max, p_len, crepe_hop_length),
+                        False,
+                    )
                 )
             elif method == "mangio-crepe-tiny":
-                f0 = self.get_f0_crepe_computation(
-                    x, f0_min, f0_max, p_len, crepe_hop_length, "tiny"
+                jobs.append(
+                    (
+                        self.get_f0_crepe_computation,
+                        (x, f0_min, f0_max, p_len, crepe_hop_length, "tiny"),
+                        False,
+                    )
                 )
+            elif method == "rmvpe":
+                jobs.append((self.get_f0_rmvpe_computation, (audio,), False))
+            elif method == "harvest":
+                jobs.append(
+                    (compute_harvest_f0, (audio, self.sr, f0_max, f0_min, 10), True)
+                )
+            elif method == "dio":  # Potentially buggy?
+                jobs.append(
+                    (
+                        compute_dio_f0,
+                        (x.astype(np.double), self.sr, f0_max, f0_min, 10),
+                        True,
+                    )
+                )
+            # elif method == "pyin": Not Working just yet
+            #    f0 = self.get_f0_pyin_computation(x, f0_min, f0_max)
+            else:
+                print("Unknown f0 method in hybrid: %s" % method)
+                continue
+            f0_methods.append(method)
+        f0_computation_stack = run_f0_jobs(jobs)
+
+        for i, (method, f0) in enumerate(zip(f0_methods, f0_computation_stack)):
+            if method in ["crepe", "crepe-tiny"]:
+                f0 = f0[1:]  # Get rid of extra first frame
             elif method == "harvest":
-                f0 = cache_harvest_f0(input_audio_path, self.sr, f0_max, f0_min, 10)
                 if filter_radius > 2:
                     f0 = signal.medfilt(f0, 3)
                 f0 = f0[1:]  # Get rid of first frame.
-            elif method == "dio":  # Potentially buggy?
-                f0, t = pyworld.dio(
-                    x.astype(np.double),
-                    fs=self.sr,
-                    f0_ceil=f0_max,
-                    f0_floor=f0_min,
-                    frame_period=10,
-                )
-                f0 = pyworld.stonemask(x.astype(np.double), f0, t, self.sr)
+            elif method == "dio":
                 f0 = signal.medfilt(f0, 3)
                 f0 = f0[1:]
-            # elif method == "pyin": Not Working just yet
-            #    f0 = self.get_f0_pyin_computation(x, f0_min, f0_max)
-            # Push method to the stack
-            f0_computation_stack.append(f0)
+            f0_computation_stack[i] = f0
 
         for fc in f0_computation_stack:
             print(len(fc))
 
-        print("Calculating hybrid median f0 from the stack of: %s" % str(methods))
-        f0_median_hybrid = None
-        if len(f0_computation_stack) == 1:
-            f0_median_hybrid = f0_computation_stack[0]
-        else:
-            f0_median_hybrid = np.nanmedian(f0_computation_stack, axis=0)
-        return f0_median_hybrid
+        print("Calculating hybrid median f0 from the stack of: %s" % str(f0_methods))
+        return median_f0(f0_computation_stack, p_len)
 
-    def get_f0(
+    def compute_f0(
         self,
         input_audio_path,
         x,
         p_len,
-        f0_up_key,
         f0_method,
         filter_radius,
         crepe_hop_length,
-        inp_f0=None,
+        f0_min,
+        f0_max,
     ):
-        global input_audio_path2wav
         time_step = self.window / self.sr * 1000
-        f0_min = 50
-        f0_max = 1100
-        f0_mel_min = 1127 * np.log(1 + f0_min / 700)
-        f0_mel_max = 1127 * np.log(1 + f0_max / 700)
         if f0_method == "pm":
             f0 = (
                 parselmouth.Sound(x, self.sr)
@@ -285,8 +308,7 @@ class VC(object):
                     f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
                 )
         elif f0_method == "harvest":
-            input_audio_path2wav[input_audio_path] = x.astype(np.double)
-            f0 = cache_harvest_f0(input_audio_path, self.sr, f0_max, f0_min, 10)
+            f0 = harvest_parallel(x.astype(np.double), self.sr, f0_max, f0_min, 10)
             if filter_radius > 2:
                 f0 = signal.medfilt(f0, 3)
         elif f0_method == "dio":  # Potentially Buggy?
@@ -312,18 +334,10 @@ class VC(object):
                 x, f0_min, f0_max, p_len, crepe_hop_length, "tiny"
             )
         elif f0_method == "rmvpe":
-            if hasattr(self, "model_rmvpe") == False:
-                from rmvpe import RMVPE
-
-                print("loading rmvpe model")
-                self.model_rmvpe = RMVPE(
-                    "rmvpe.pt", is_half=self.is_half, device=self.device
-                )
-            f0 = self.model_rmvpe.infer_from_audio(x, thred=0.03)
+            f0 = self.get_f0_rmvpe_computation(x)
 
         elif "hybrid" in f0_method:
             # Perform hybrid median pitch estimation
-            input_audio_path2wav[input_audio_path] = x.astype(np.double)
             f0 = self.get_f0_hybrid_computation(
                 f0_method,
                 input_audio_path,
@@ -335,8 +349,49 @@ class VC(object):
                 crepe_hop_length,
                 time_step,
             )
+        return f0
 
-        f0 *= pow(2, f0_up_key / 12)
+    def get_f0(
+        self,
+        input_audio_path,
+        x,
+        p_len,
+        f0_up_key,
+        f0_method,
+        filter_radius,
+        crepe_hop_length,
+        inp_f0=None,
+    ):
+        f0_min = 50
+        f0_max = 1100
+        f0_mel_min = 1127 * np.log(1 + f0_min / 700)
+        f0_mel_max = 1127 * np.log(1 + f0_max / 700)
+        # 缓存的是未变调的f0, 改变调/index_rate重跑同一段音频时不用再提音高
+        key = f0_cache.make_key(
+            x,
+            f0_method,
+            f0_min,
+            f0_max,
+            self.window,
+            filter_radius,
+            crepe_hop_length if "mangio-crepe" in f0_method else None,
+        )
+        f0 = f0_cache.get(key)
+        if f0 is None:
+            f0 = f0_cache.put(
+                key,
+                self.compute_f0(
+                    input_audio_path,
+                    x,
+                    p_len,
+                    f0_method,
+                    filter_radius,
+                    crepe_hop_length,
+                    f0_min,
+                    f0_max,
+                ),
+            )
+        f0 = f0 * pow(2, f0_up_key / 12)
         # with open("test.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
         tf0 = self.sr // self.window  # 每秒f0点数
         if inp_f0 is not None:
@@ -362,6 +417,80 @@ class VC(object):
 
         return f0_coarse, f0bak  # 1-0
 
+    def extract_features(self, model, audios, version):
+        """
+        Run hubert over several 16k segments in one padded batch.
+        Returns one (1, frames, C) tensor per segment, trimmed to its own length.
+        """
+        lengths = [audio.shape[0] for audio in audios]
+        feats = torch.zeros(len(audios), max(lengths))
+        padding_mask = torch.ones(len(audios), max(lengths), dtype=torch.bool)
+        for i, audio in enumerate(audios):
+            wav = torch.from_numpy(audio).float()
+            if wav.dim() == 2:  # double channels
+                wav = wav.mean(-1)
+            assert wav.dim() == 1, wav.dim()
+            feats[i, : lengths[i]] = wav
+            padding_mask[i, : lengths[i]] = False
+        if self.is_half:
+            feats = feats.half()
+        inputs = {
+            "source": feats.to(self.device),
+            "padding_mask": padding_mask.to(self.device),
+            "output_layer": 9 if version == "v1" else 12,
+        }
+        with torch.no_grad():
+            logits = model.extract_features(**inputs)
+            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        return [
+            feats[i : i + 1, : hubert_frames(length)] for i, length in enumerate(lengths)
+        ]
+
+    def extract_features_batched(self, model, audios, version):
+        # 按长度排序后分组, 每组最多hubert_batch_size段
+        order = sorted(range(len(audios)), key=lambda i: audios[i].shape[0])
+        groups = []
+        for i in order:
+            if (
+                groups
+                and len(groups[-1]) < self.hubert_batch_size
+                and audios[i].shape[0]
+                <= audios[groups[-1][0]].shape[0] * (1 + self.hubert_max_pad_ratio)
+            ):
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+        feats = [None] * len(audios)
+        for group in groups:
+            group_feats = self.extract_features(
+                model, [audios[i] for i in group], version
+            )
+            for i, feat in zip(group, group_feats):
+                feats[i] = feat
+        return feats
+
+    def retrieval_blend(self, index, big_npy, feats):
+        """
+        Weighted mean of the 8 nearest index features of every frame of feats
+        (1, T, C), computed retrieval_chunk frames at a time. big_npy is either
+        the host array or a tensor on self.device (see load_index).
+        """
+        npy = feats[0].float().cpu().numpy()
+        blend = torch.empty_like(feats[0])
+        for i in range(0, npy.shape[0], retrieval_chunk):
+            score, ix = index.search(npy[i : i + retrieval_chunk], k=8)
+            weight = np.square(1 / score)
+            weight /= weight.sum(axis=1, keepdims=True)
+            if torch.is_tensor(big_npy):
+                ix = torch.from_numpy(ix).to(self.device)
+                weight = torch.from_numpy(weight).to(self.device, big_npy.dtype)
+                chunk = torch.sum(big_npy[ix] * weight.unsqueeze(2), dim=1)
+            else:
+                chunk = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+                chunk = torch.from_numpy(chunk).to(self.device)
+            blend[i : i + retrieval_chunk] = chunk
+        return blend.unsqueeze(0)
+
     def vc(
         self,
         model,
@@ -376,27 +505,11 @@ class VC(object):
         index_rate,
         version,
         protect,
+        feats=None,
     ):  # ,file_index,file_big_npy
-        feats = torch.from_numpy(audio0)
-        if self.is_half:
-            feats = feats.half()
-        else:
-            feats = feats.float()
-        if feats.dim() == 2:  # double channels
-            feats = feats.mean(-1)
-        assert feats.dim() == 1, feats.dim()
-        feats = feats.view(1, -1)
-        padding_mask = torch.BoolTensor(feats.shape).to(self.device).fill_(False)
-
-        inputs = {
-            "source": feats.to(self.device),
-            "padding_mask": padding_mask,
-            "output_layer": 9 if version == "v1" else 12,
-        }
         t0 = ttime()
-        with torch.no_grad():
-            logits = model.extract_features(**inputs)
-            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        if feats is None:
+            feats = self.extract_features(model, [audio0], version)[0]
         if protect < 0.5 and pitch != None and pitchf != None:
             feats0 = feats.clone()
         if (
@@ -404,22 +517,11 @@ class VC(object):
             and isinstance(big_npy, type(None)) == False
             and index_rate != 0
         ):
-            npy = feats[0].cpu().numpy()
-            if self.is_half:
-                npy = npy.astype("float32")
-
             # _, I = index.search(npy, 1)
             # npy = big_npy[I.squeeze()]
 
-            score, ix = index.search(npy, k=8)
-            weight = np.square(1 / score)
-            weight /= weight.sum(axis=1, keepdims=True)
-            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
-
-            if self.is_half:
-                npy = npy.astype("float16")
             feats = (
-                torch.from_numpy(npy).unsqueeze(0).to(self.device) * index_rate
+                self.retrieval_blend(index, big_npy, feats) * index_rate
                 + (1 - index_rate) * feats
             )
 
@@ -456,7 +558,7 @@ class VC(object):
                 audio1 = (
                     (net_g.infer(feats, p_len, sid)[0][0, 0]).data.cpu().float().numpy()
                 )
-        del feats, p_len, padding_mask
+        del feats, p_len
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         t2 = ttime()
@@ -494,13 +596,15 @@ class VC(object):
             and os.path.exists(file_index) == True
             and index_rate != 0
         ):
-            try:
-                index = faiss.read_index(file_index)
-                # big_npy = np.load(file_big_npy)
-                big_npy = index.reconstruct_n(0, index.ntotal)
-            except:
-                traceback.print_exc()
-                index = big_npy = None
+            # big_npy = np.load(file_big_npy)
+            if self.index_on_device:
+                index, big_npy = load_index(
+                    file_index,
+                    self.device,
+                    torch.float16 if self.is_half else torch.float32,
+                )
+            else:
+                index, big_npy = load_index(file_index)
         else:
             index = big_npy = None
         audio = signal.filtfilt(bh, ah, audio)
@@ -557,75 +661,45 @@ class VC(object):
             pitchf = torch.tensor(pitchf, device=self.device).unsqueeze(0).float()
         t2 = ttime()
         times[1] += t2 - t1
+        segments = []
         for t in opt_ts:
             t = t // self.window * self.window
+            segments.append((s, t))
+            s = t
+        segments.append((t if t is not None else 0, None))
+        audios = [
+            audio_pad[s : t + self.t_pad2 + self.window]
+            if t is not None
+            else audio_pad[s:]
+            for s, t in segments
+        ]
+        feats = [None] * len(audios)
+        if self.hubert_batch_size > 1 and len(audios) > 1:
+            t0 = ttime()
+            feats = self.extract_features_batched(model, audios, version)
+            times[0] += ttime() - t0
+        for (s, t), audio0, feats0 in zip(segments, audios, feats):
             if if_f0 == 1:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        pitch[:, s // self.window : (t + self.t_pad2) // self.window],
-                        pitchf[:, s // self.window : (t + self.t_pad2) // self.window],
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
+                end = (t + self.t_pad2) // self.window if t is not None else None
+                pitch0 = pitch[:, s // self.window : end]
+                pitchf0 = pitchf[:, s // self.window : end]
             else:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        None,
-                        None,
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
-            s = t
-        if if_f0 == 1:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    pitch[:, t // self.window :] if t is not None else pitch,
-                    pitchf[:, t // self.window :] if t is not None else pitchf,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
-        else:
+                pitch0 = pitchf0 = None
             audio_opt.append(
                 self.vc(
                     model,
                     net_g,
                     sid,
-                    audio_pad[t:],
-                    None,
-                    None,
+                    audio0,
+                    pitch0,
+                    pitchf0,
                     times,
                     index,
                     big_npy,
                     index_rate,
                     version,
                     protect,
+                    feats0,
                 )[self.t_pad_tgt : -self.t_pad_tgt]
             )
         audio_opt = np.concatenate(audio_opt)